@@ -0,0 +1,66 @@
+'''
+bench_collisions.py
+Measures how Level.update scales with the number of BouncingEnemyBlocks, using
+the SpatialHash broad phase and, for comparison, the brute-force spritecollide
+checks against the whole enemy_block_list that it replaced.
+
+Usage: python benchmarks/bench_collisions.py [--seconds S]
+'''
+
+import argparse
+import time
+
+from synthetic import BouncingArena
+
+ENEMY_COUNTS = [26, 100, 1000, 10000, 20000]
+
+# The brute-force check is O(n^2) per tick, so it is skipped for large levels.
+BRUTE_FORCE_MAX_ENEMIES = 2000
+
+class BruteForceIndex(object):
+    """ Answers enemy index queries by checking every enemy, like spritecollide did """
+    def __init__(self, group):
+        self.group = group
+
+    def move(self, sprite):
+        pass
+
+    def query(self, rect):
+        return [sprite for sprite in self.group if rect.colliderect(sprite.rect)]
+
+    def collides(self, rect):
+        return rect.collidelist([sprite.rect for sprite in self.group]) != -1
+
+class BruteForceArena(BouncingArena):
+    def get_enemy_index(self):
+        if self.enemy_index is None:
+            self.enemy_index = BruteForceIndex(self.enemy_block_list)
+        return self.enemy_index
+
+def ticks_per_second(level, seconds):
+    """ Updates the level repeatedly for about the specified number of seconds """
+    ticks = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < seconds:
+        level.update()
+        ticks += 1
+        elapsed = time.perf_counter() - start
+    return ticks / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[1])
+    parser.add_argument("--seconds", type=float, default=2.0, help="time spent on each measurement")
+    args = parser.parse_args()
+
+    print("{:>8} {:>16} {:>16}".format("enemies", "spatial hash", "brute force"))
+    for num_enemies in ENEMY_COUNTS:
+        indexed = ticks_per_second(BouncingArena(num_enemies), args.seconds)
+        if num_enemies <= BRUTE_FORCE_MAX_ENEMIES:
+            brute_force = "{:16.1f}".format(ticks_per_second(BruteForceArena(num_enemies), args.seconds))
+        else:
+            brute_force = "{:>16}".format("skipped")
+        print("{:8d} {:16.1f} {}".format(num_enemies, indexed, brute_force))
+
+if __name__ == '__main__':
+    main()
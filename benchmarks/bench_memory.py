@@ -0,0 +1,100 @@
+'''
+bench_memory.py
+Measures the memory taken per enemy by large synthetic Levels, for each way of
+storing the enemies: EnemyBlock sprites that share their images, the same
+sprites each with an image of their own (as every sprite had before images
+were shared), sprites moved by a VectorizedEnemyPhysics, and EnemyArrays,
+which have no sprites at all. Every measurement runs in a fresh process with
+Python's small-object allocator turned off (PYTHONMALLOC=malloc), so that
+every allocation, including those made by pygame's C code, goes through the
+C library's malloc(), and counts the bytes that are still allocated after the
+Level has been built and played for a few ticks. Where glibc's mallinfo2()
+is not available, the growth of the resident set size is counted instead,
+which is less precise.
+
+Usage: python benchmarks/bench_memory.py [--enemies N [N ...]]
+'''
+
+import argparse
+import ctypes
+import gc
+import os
+import subprocess
+import sys
+
+from synthetic import BouncingArena
+
+ENEMY_COUNTS = [1000, 10000, 100000]
+
+MODELS = ["sprites", "own images", "vectorized", "compact"]
+
+# Ticks that the Level is played for before measuring, so that indexes and
+# caches built on the first update are counted
+WARM_UP_TICKS = 5
+
+class MallInfo2(ctypes.Structure):
+    """ glibc's struct mallinfo2 """
+    _fields_ = [(name, ctypes.c_size_t) for name in ("arena", "ordblks", "smblks", "hblks", "hblkhd", "usmblks",
+                                                     "fsmblks", "uordblks", "fordblks", "keepcost")]
+
+def memory_in_use():
+    """
+    Returns the number of bytes allocated with malloc() and not yet freed,
+    or this process's resident set size where mallinfo2() is unavailable
+    """
+    mallinfo2 = getattr(ctypes.CDLL(None), "mallinfo2", None)
+    if mallinfo2 is not None:
+        mallinfo2.restype = MallInfo2
+        info = mallinfo2()
+        return info.uordblks + info.hblkhd
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def build_level(model, num_enemies):
+    """ Builds a BouncingArena whose enemies are stored as specified by model """
+    if model == "compact":
+        return BouncingArena(num_enemies, compact=True)
+
+    level = BouncingArena(num_enemies)
+    if model == "own images":
+        for enemy_block in level.enemy_block_list:
+            enemy_block.image = enemy_block.image.copy()
+    elif model == "vectorized":
+        from enemy_physics import VectorizedEnemyPhysics
+        level.enemy_physics = VectorizedEnemyPhysics(level)
+    return level
+
+def measure(model, num_enemies):
+    """ Returns the number of bytes per enemy taken by a Level (run in a fresh process) """
+    gc.collect()
+    start = memory_in_use()
+    level = build_level(model, num_enemies)
+    for _ in range(WARM_UP_TICKS):
+        level.update()
+    level.get_moving_sprites()
+    gc.collect()
+    return (memory_in_use() - start) / float(num_enemies)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[1])
+    parser.add_argument("--enemies", type=int, nargs="+", default=ENEMY_COUNTS, help="numbers of enemies to measure")
+    parser.add_argument("--measure", nargs=2, metavar=("MODEL", "ENEMIES"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        print(measure(args.measure[0], int(args.measure[1])))
+        return
+
+    print("bytes per enemy")
+    print("{:>8}".format("enemies") + "".join("{:>12}".format(model) for model in MODELS))
+    for num_enemies in args.enemies:
+        row = "{:8d}".format(num_enemies)
+        for model in MODELS:
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                              "--measure", model, str(num_enemies)],
+                                             env=dict(os.environ, PYTHONMALLOC="malloc"))
+            row += "{:12.0f}".format(float(output.decode().split()[-1]))
+        print(row)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+'''
+run_benchmarks.py
+The benchmark suite. Runs under the SDL dummy video driver and measures:
+    update.<level>      ticks/sec of Level.update
+    draw.<level>        milliseconds per Level.draw onto the screen
+    main_loop           milliseconds per frame of the main() loop, uncapped
+    startup.<n>_levels  milliseconds from calling main() to its first frame,
+                        with n Levels in the game
+    construct_levels    milliseconds to construct all four Levels
+for Level_01 to Level_04 and for synthetic arenas with 10x, 100x and 1000x
+as many enemies as Level_04 (see synthetic.py).
+
+Results are saved as JSON so that commits can be compared:
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+
+import pygame
+
+from synthetic import BouncingArena
+import worlds_hardest_game
+
+# Number of enemies in Level_04, which the synthetic arenas are scaled from
+LEVEL_04_ENEMIES = 26
+
+SCALES = [10, 100, 1000]
+
+# Numbers of Levels that startup time is measured with. Levels are built on
+# demand, so it should not depend on how many there are.
+STARTUP_LEVEL_COUNTS = [4, 400]
+
+# Frame counts that main() is run for. The main loop's cost per frame is the
+# difference between the two runs, which cancels out startup and shutdown.
+MAIN_LOOP_FRAMES = (60, 360)
+
+def measure(function, seconds):
+    """
+    Calls function repeatedly for about the specified number of seconds (at
+    least once). Returns the number of calls per second.
+    """
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while calls == 0 or elapsed < seconds:
+        function()
+        calls += 1
+        elapsed = time.perf_counter() - start
+    return calls / elapsed
+
+def benchmark_levels():
+    """ Returns a list of (name, zero-argument Level constructor) pairs to benchmark """
+    levels = [(level_class.__name__, level_class) for level_class in worlds_hardest_game.LEVELS]
+    for scale in SCALES:
+        levels.append(("synthetic_{}x".format(scale),
+                       lambda num_enemies=scale * LEVEL_04_ENEMIES: BouncingArena(num_enemies)))
+    return levels
+
+def run(seconds):
+    """ Runs every benchmark and returns a dict mapping each result's name to its value and unit """
+    results = {}
+
+    def record(name, value, unit):
+        results[name] = {"value": value, "unit": unit}
+        print("{:28} {:12.3f} {}".format(name, value, unit))
+
+    pygame.init()
+    screen = pygame.display.set_mode((worlds_hardest_game.SCREEN_WIDTH, worlds_hardest_game.SCREEN_HEIGHT))
+
+    record("construct_levels",
+           1000.0 / measure(lambda: [level_class() for level_class in worlds_hardest_game.LEVELS], seconds),
+           "ms")
+
+    for name, make_level in benchmark_levels():
+        level = make_level()
+        record("update." + name, measure(level.update, seconds), "ticks/s")
+        record("draw." + name, 1000.0 / measure(lambda: level.draw(screen), seconds), "ms")
+
+    # main() shuts pygame down when it returns.
+    durations = []
+    for frames in MAIN_LOOP_FRAMES:
+        start = time.perf_counter()
+        worlds_hardest_game.main(max_frames=frames, fps=0, lockstep=True)
+        durations.append(time.perf_counter() - start)
+    record("main_loop", 1000.0 * (durations[1] - durations[0]) / (MAIN_LOOP_FRAMES[1] - MAIN_LOOP_FRAMES[0]), "ms")
+
+    for num_levels in STARTUP_LEVEL_COUNTS:
+        level_classes = [worlds_hardest_game.LEVELS[i % len(worlds_hardest_game.LEVELS)] for i in range(num_levels)]
+        startup_times = [worlds_hardest_game.main(max_frames=1, fps=0, level_classes=level_classes, lockstep=True).startup_time
+                         for _ in range(5)]
+        record("startup.{}_levels".format(num_levels), 1000.0 * min(startup_times), "ms")
+
+    return results
+
+def commit():
+    """ Returns the hash of the checked-out commit, or None outside a git repository """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """ Prints how each result changed relative to the results in baseline """
+    print()
+    print("{:28} {:>12} {:>12} {:>8}".format("compared to baseline", "before", "after", "change"))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]["value"]
+        after = result["value"]
+        # Rates get better as they go up; durations get better as they go down.
+        if result["unit"] == "ms":
+            change = before / after if after else float("inf")
+        else:
+            change = after / before if before else float("inf")
+        print("{:28} {:12.3f} {:12.3f} {:7.2f}x".format(name, before, after, change))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark simulation, rendering and startup.")
+    parser.add_argument("--seconds", type=float, default=1.0, help="time spent on each measurement")
+    parser.add_argument("--output", help="file to save the results to as JSON")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results to compare against")
+    args = parser.parse_args()
+
+    results = run(args.seconds)
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump({
+                "commit": commit(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "pygame": pygame.version.ver,
+                "results": results,
+            }, output_file, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file)["results"])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''
+synthetic.py
+Generates synthetic Levels with arbitrarily many enemies for benchmarking.
+'''
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from enemy_physics import EnemyArrays
+from worlds_hardest_game import (BouncingEnemyBlock, Goal, Level, Player, RectWall,
+                                 CYAN, SCREEN_HEIGHT, SCREEN_WIDTH)
+
+# Open floor area per enemy in Level_04 (a 700x500 area shared by 26 enemies).
+# Synthetic arenas grow with the number of enemies so that the density matches.
+LEVEL_04_AREA_PER_ENEMY = (SCREEN_WIDTH - 100) * (SCREEN_HEIGHT - 100) // 26
+
+class BouncingArena(Level):
+    """
+    A Level containing num_enemies BouncingEnemyBlocks at random positions,
+    moving horizontally or vertically at 5 pixels per tick like the ones in
+    Level_04. The arena keeps Level_04's aspect ratio and enemy density.
+    If compact is True, the enemies are enemy_physics.EnemyArrays instead of
+    sprites.
+    """
+    def __init__(self, num_enemies, seed=0, compact=False):
+        super(BouncingArena, self).__init__()
+
+        rng = random.Random(seed)
+
+        scale = (num_enemies * LEVEL_04_AREA_PER_ENEMY / float((SCREEN_WIDTH - 100) * (SCREEN_HEIGHT - 100))) ** 0.5
+        width = int((SCREEN_WIDTH - 100) * max(scale, 1)) + 100
+        height = int((SCREEN_HEIGHT - 100) * max(scale, 1)) + 100
+
+        # (bouncing, x, y, velocity_x, velocity_y) of every enemy, as in a level_format.LevelData
+        enemies = []
+        for i in range(num_enemies):
+            if rng.random() < 0.5:
+                velocity_x, velocity_y = rng.choice((-5, 5)), 0
+            else:
+                velocity_x, velocity_y = 0, rng.choice((-5, 5))
+            enemies.append((True, rng.randrange(60, width - 70), rng.randrange(60, height - 70), velocity_x, velocity_y))
+
+        if not compact:
+            for bouncing, x, y, velocity_x, velocity_y in enemies:
+                enemy_block = BouncingEnemyBlock(self, velocity_x, velocity_y)
+                enemy_block.rect.x = x
+                enemy_block.rect.y = y
+                self.enemy_block_list.add(enemy_block)
+
+        left_boundary = RectWall(0, 0, 50, height, CYAN)
+        right_boundary = RectWall(width - 50, 0, 50, height, CYAN)
+        top_boundary = RectWall(0, 0, width, 50, CYAN)
+        bottom_boundary = RectWall(0, height - 50, width, 50, CYAN)
+
+        self.goal = Goal(width - 100, height - 100, 20, 20)
+
+        self.wall_list.add(self.goal, left_boundary, right_boundary, top_boundary, bottom_boundary)
+
+        self.player = Player(self, 55, 55, 10, 10)
+        self.all_sprites_list.add(self.enemy_block_list, self.wall_list, self.player)
+
+        if compact:
+            self.enemy_physics = EnemyArrays(self, enemies)
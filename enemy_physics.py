@@ -0,0 +1,317 @@
+'''
+enemy_physics.py
+A struct-of-arrays physics backend for the EnemyBlocks in a Level. Every
+enemy's position and velocity is stored in NumPy arrays, and the move, the
+wall bounce and the enemy-enemy bounce are computed for the whole Level in
+one batched step. The results are identical to calling update() on every
+EnemyBlock and BouncingEnemyBlock one at a time.
+
+EnemyArrays goes one step further for very large Levels: the enemies exist
+only as rows of the arrays, with no sprites at all, and the Level draws,
+snapshots, restores and clones them through it.
+
+Usage:
+    level = Level_04()
+    level.enemy_physics = VectorizedEnemyPhysics(level)
+
+    level = Level_04(compact=True)     # a DataLevel whose enemies are EnemyArrays
+'''
+
+import collections
+import copy
+
+import numpy as np
+import pygame
+
+from worlds_hardest_game import ENEMY_SIZE, EnemyBlock, BouncingEnemyBlock, get_image
+
+# Used to combine a cell's x and y coordinates into a single sort key.
+_CELL_KEY_STRIDE = 1 << 32
+
+class VectorizedEnemyPhysics(object):
+    """
+    Moves all of the EnemyBlocks in a Level at once. While a Level has a
+    VectorizedEnemyPhysics, the arrays are the authoritative copy of the
+    enemies' state; the sprites' rects are only brought up to date by
+    sync_sprites(), which Level.draw() calls before drawing.
+    """
+    def __init__(self, level):
+        """
+        Copies the positions and velocities of the EnemyBlocks in the
+        specified Level into arrays. The enemies are stored in the order
+        that Level.update() would update them in.
+        """
+        self.level = level
+
+        self.sprites = [sprite for sprite in level.all_sprites_list if sprite in level.enemy_block_list]
+        if len(self.sprites) != len(level.enemy_block_list):
+            raise ValueError("every EnemyBlock must also be in the Level's all_sprites_list")
+        for sprite in self.sprites:
+            if type(sprite).update not in (EnemyBlock.update, BouncingEnemyBlock.update):
+                raise ValueError(type(sprite).__name__ + " overrides update() and cannot be vectorized")
+
+        self.x = np.array([sprite.rect.x for sprite in self.sprites], dtype=np.int64)
+        self.y = np.array([sprite.rect.y for sprite in self.sprites], dtype=np.int64)
+        self.width = np.array([sprite.rect.width for sprite in self.sprites], dtype=np.int64)
+        self.height = np.array([sprite.rect.height for sprite in self.sprites], dtype=np.int64)
+        self.velocity_x = np.array([sprite.velocity_x for sprite in self.sprites], dtype=np.int64)
+        self.velocity_y = np.array([sprite.velocity_y for sprite in self.sprites], dtype=np.int64)
+
+        # Indices (in update order) of the enemies that bounce off of other enemies.
+        self.bouncing = np.flatnonzero([isinstance(sprite, BouncingEnemyBlock) for sprite in self.sprites])
+
+        self._read_walls(level)
+
+    def _read_walls(self, level):
+        """ Copies the rects of the Level's walls into arrays """
+        walls = level.wall_list.sprites()
+        self.wall_x = np.array([wall.rect.x for wall in walls], dtype=np.int64)
+        self.wall_y = np.array([wall.rect.y for wall in walls], dtype=np.int64)
+        self.wall_width = np.array([wall.rect.width for wall in walls], dtype=np.int64)
+        self.wall_height = np.array([wall.rect.height for wall in walls], dtype=np.int64)
+
+        # Enemies that overlap each other always lie in neighbouring cells of
+        # a grid whose cells are at least as large as the largest enemy.
+        self.cell_size = int(max(self.width.max(initial=1), self.height.max(initial=1)))
+
+    def update(self):
+        """ Moves every enemy by one tick, bouncing them off walls and each other """
+        old_x = self.x.copy()
+        old_y = self.y.copy()
+
+        self.x += self.velocity_x
+        self.y += self.velocity_y
+
+        self._bounce_off_walls()
+
+        if len(self.bouncing) > 0:
+            hit = self._bouncing_enemies_hit(old_x, old_y)
+            self.velocity_x[hit] *= -1
+            self.velocity_y[hit] *= -1
+
+    def _bounce_off_walls(self):
+        """ Applies the wall bounce of EnemyBlock.update() to every enemy """
+        if len(self.wall_x) == 0:
+            return
+
+        x = self.x[:, None]
+        y = self.y[:, None]
+        walls_hit = ((x < self.wall_x + self.wall_width) & (self.wall_x < x + self.width[:, None])
+                     & (y < self.wall_y + self.wall_height) & (self.wall_y < y + self.height[:, None]))
+        num_walls_hit = walls_hit.sum(axis=1)
+
+        # The only wall that was hit (only meaningful where num_walls_hit == 1)
+        wall = walls_hit.argmax(axis=1)
+        wall_x = self.wall_x[wall]
+        wall_y = self.wall_y[wall]
+        wall_right = wall_x + self.wall_width[wall]
+        wall_bottom = wall_y + self.wall_height[wall]
+
+        vx = self.velocity_x
+        vy = self.velocity_y
+        right = self.x + self.width
+        bottom = self.y + self.height
+
+        flip_x = ((vx > 0) & (wall_x <= right) & (right <= wall_x + vx)
+                  | (vx < 0) & (wall_right + vx <= self.x) & (self.x <= wall_right))
+        flip_y = ((vy > 0) & (wall_y <= bottom) & (bottom <= wall_y + vy)
+                  | (vy < 0) & (wall_bottom + vy <= self.y) & (self.y <= wall_bottom))
+
+        # Two walls hit means the enemy hit a corner, so both velocities flip.
+        corner = num_walls_hit == 2
+        flip_x = flip_x & (num_walls_hit == 1) | corner
+        flip_y = flip_y & (num_walls_hit == 1) | corner
+
+        vx[flip_x] *= -1
+        vy[flip_y] *= -1
+
+    def _bouncing_enemies_hit(self, old_x, old_y):
+        """
+        Returns a boolean array telling which BouncingEnemyBlocks collided with
+        another enemy this tick. To match the per-sprite rules, a bouncing enemy
+        sees the enemies that come before it in update order at their new
+        positions and the enemies that come after it at their old positions.
+        """
+        hit_counts = np.zeros(len(self.x), dtype=np.int64)
+
+        for other_x, other_y, earlier in ((self.x, self.y, True), (old_x, old_y, False)):
+            queries, others = self._candidate_pairs(other_x, other_y)
+            if earlier:
+                keep = others < queries
+            else:
+                keep = others > queries
+            queries = queries[keep]
+            others = others[keep]
+
+            overlap = ((self.x[queries] < other_x[others] + self.width[others])
+                       & (other_x[others] < self.x[queries] + self.width[queries])
+                       & (self.y[queries] < other_y[others] + self.height[others])
+                       & (other_y[others] < self.y[queries] + self.height[queries]))
+            hit_counts += np.bincount(queries[overlap], minlength=len(self.x))
+
+        hit = np.zeros(len(self.x), dtype=bool)
+        hit[self.bouncing] = hit_counts[self.bouncing] > 0
+        return hit
+
+    def _candidate_pairs(self, other_x, other_y):
+        """
+        Uses a uniform grid to find every (bouncing enemy, other enemy) pair whose
+        positions are close enough to overlap. The bouncing enemies are taken at
+        their current positions and the others at (other_x, other_y).
+        Returns two index arrays.
+        """
+        cell_size = self.cell_size
+        other_keys = (other_x // cell_size) * _CELL_KEY_STRIDE + other_y // cell_size
+        order = np.argsort(other_keys, kind="stable")
+        sorted_keys = other_keys[order]
+
+        bouncing = self.bouncing
+        query_keys = (self.x[bouncing] // cell_size) * _CELL_KEY_STRIDE + self.y[bouncing] // cell_size
+
+        queries = []
+        others = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                neighbour_keys = query_keys + dx * _CELL_KEY_STRIDE + dy
+                start = np.searchsorted(sorted_keys, neighbour_keys, side="left")
+                counts = np.searchsorted(sorted_keys, neighbour_keys, side="right") - start
+                total = counts.sum()
+                if total == 0:
+                    continue
+                # Expand each [start, start + count) range into individual indices.
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                queries.append(np.repeat(bouncing, counts))
+                others.append(order[np.repeat(start, counts) + offsets])
+
+        if not queries:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        return np.concatenate(queries), np.concatenate(others)
+
+    def collides(self, rect):
+        """ Returns True if the specified rect overlaps any enemy """
+        return bool(np.any((self.x < rect.x + rect.width) & (rect.x < self.x + self.width)
+                           & (self.y < rect.y + rect.height) & (rect.y < self.y + self.height)))
+
+    def read_sprites(self):
+        """
+        Copies the positions and velocities of the enemies' sprites into the
+        arrays, after the sprites have been moved by other means (such as
+        Level.restore()).
+        """
+        self.x[:] = [sprite.rect.x for sprite in self.sprites]
+        self.y[:] = [sprite.rect.y for sprite in self.sprites]
+        self.velocity_x[:] = [sprite.velocity_x for sprite in self.sprites]
+        self.velocity_y[:] = [sprite.velocity_y for sprite in self.sprites]
+
+    def sync_sprites(self):
+        """ Copies the enemies' positions and velocities back into their sprites """
+        for sprite, x, y, velocity_x, velocity_y in zip(self.sprites, self.x.tolist(), self.y.tolist(),
+                                                         self.velocity_x.tolist(), self.velocity_y.tolist()):
+            sprite.rect.x = x
+            sprite.rect.y = y
+            sprite.velocity_x = velocity_x
+            sprite.velocity_y = velocity_y
+
+# An enemy drawn by EnemyArrays.draw(), standing in for its sprite when a
+# DirtyRenderer redraws the sprites under its overlays
+EnemyView = collections.namedtuple("EnemyView", ["image", "rect"])
+
+class EnemyArrays(VectorizedEnemyPhysics):
+    """
+    The EnemyBlocks of a Level, stored only as arrays. An enemy has no sprite,
+    Rect or image of its own: it is one row of the x, y and velocity arrays
+    (plus a flag for whether it bounces off other enemies), and every enemy
+    of a colour is drawn with the same shared image. The Level's
+    enemy_block_list stays empty, so code that reads the enemies' sprites
+    (such as seek(), VectorEnv and spectator.py) sees no enemies.
+    """
+    def __init__(self, level, enemies):
+        """
+        Builds the arrays from (bouncing, x, y, velocity_x, velocity_y) tuples
+        in update order, like the enemies of a level_format.LevelData. The
+        walls must already be in the specified Level's wall_list.
+        """
+        self.level = level
+        self.sprites = []
+
+        enemies = np.array(enemies, dtype=np.int64).reshape(-1, 5)
+        self.is_bouncing = enemies[:, 0].astype(bool)
+        self.x = enemies[:, 1].copy()
+        self.y = enemies[:, 2].copy()
+        self.velocity_x = enemies[:, 3].copy()
+        self.velocity_y = enemies[:, 4].copy()
+        # Every enemy is the same size, so these are read-only views of a
+        # single number rather than full arrays.
+        self.width = np.broadcast_to(np.int64(ENEMY_SIZE), self.x.shape)
+        self.height = np.broadcast_to(np.int64(ENEMY_SIZE), self.x.shape)
+        self.bouncing = np.flatnonzero(self.is_bouncing)
+
+        self._read_walls(level)
+        self.cell_size = ENEMY_SIZE
+
+        # The images of an EnemyBlock and a BouncingEnemyBlock, indexed by is_bouncing
+        self.images = (get_image(ENEMY_SIZE, ENEMY_SIZE, EnemyBlock.colour),
+                       get_image(ENEMY_SIZE, ENEMY_SIZE, BouncingEnemyBlock.colour))
+
+        # The EnemyViews drawn by the last call to draw()
+        self.drawn = []
+
+    def __len__(self):
+        return len(self.x)
+
+    def __iter__(self):
+        """ Iterates over the enemies drawn by the last call to draw(), as EnemyViews """
+        return iter(self.drawn)
+
+    def read_sprites(self):
+        """ There are no sprites; the arrays are the only copy of the enemies """
+        pass
+
+    def sync_sprites(self):
+        pass
+
+    def snapshot_enemies(self):
+        """ Returns the x, y, x velocity and y velocity of every enemy as C ints, in the format of Level.snapshot() """
+        return np.stack((self.x, self.y, self.velocity_x, self.velocity_y), axis=1).astype(np.intc).tobytes()
+
+    def restore_enemies(self, enemies):
+        """ Loads the enemies from a buffer of C ints in the format of snapshot_enemies() """
+        state = np.frombuffer(enemies, dtype=np.intc).reshape(-1, 4)
+        self.x[:] = state[:, 0]
+        self.y[:] = state[:, 1]
+        self.velocity_x[:] = state[:, 2]
+        self.velocity_y[:] = state[:, 3]
+
+    def clone(self, level):
+        """ Returns a copy of the EnemyArrays for the specified copy of its Level """
+        enemy_arrays = copy.copy(self)
+        enemy_arrays.level = level
+        enemy_arrays.x = self.x.copy()
+        enemy_arrays.y = self.y.copy()
+        enemy_arrays.velocity_x = self.velocity_x.copy()
+        enemy_arrays.velocity_y = self.velocity_y.copy()
+        enemy_arrays.drawn = []
+        return enemy_arrays
+
+    def draw(self, surface):
+        """
+        Draws the enemies that are inside the surface's clipping area, like
+        RenderUpdates.draw(). Returns the rects of the enemies drawn by the
+        previous call and by this one.
+        """
+        clip = surface.get_clip()
+        visible = np.flatnonzero((self.x < clip.right) & (clip.x < self.x + ENEMY_SIZE)
+                                 & (self.y < clip.bottom) & (clip.y < self.y + ENEMY_SIZE))
+        dirty_rects = [view.rect for view in self.drawn]
+        images = self.images
+        self.drawn = [EnemyView(images[bouncing], pygame.Rect(x, y, ENEMY_SIZE, ENEMY_SIZE))
+                      for x, y, bouncing in zip(self.x[visible].tolist(), self.y[visible].tolist(),
+                                                self.is_bouncing[visible].tolist())]
+        surface.blits(self.drawn, doreturn=False)
+        dirty_rects.extend(view.rect for view in self.drawn)
+        return dirty_rects
+
+    def clear(self, surface, background):
+        """ Erases the enemies drawn by the last call to draw(), like RenderUpdates.clear() """
+        surface.blits([(background, view.rect, view.rect) for view in self.drawn], doreturn=False)
@@ -0,0 +1,372 @@
+'''
+export.py
+Offline export of replays (see replay.py) to an animated GIF or a directory of
+PNG frames, without a display and without playing the run in real time.
+
+The run is simulated once, headless, in the main process, which takes a
+Level.snapshot() at the start of every chunk of CHUNK_FRAMES frames. Each
+chunk is then rendered and encoded by a pool of worker processes: a worker
+restores the Level from the chunk's snapshot, replays the chunk's inputs and
+draws its frames off-screen. PNG frames are written by the workers
+themselves; GIF chunks are returned as encoded bytes and written to the file
+in order. Only a few chunks per worker are submitted ahead of the one that
+is written next, so only those are ever held in memory.
+
+GIFs are encoded without any imaging library. Every frame stores only the
+rectangle that changed since the previous frame, with a local colour table
+of the colours in that rectangle (the game uses only a handful), compressed
+with GIF's variable-width LZW.
+
+Run this file to export a replay:
+    python export.py run.whgr --output run.gif
+    python export.py run.whgr --level 3 --output frames/
+'''
+
+import argparse
+import collections
+import multiprocessing
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+import pygame
+
+import replay
+import worlds_hardest_game
+from worlds_hardest_game import FPS, SCREEN_WIDTH, SCREEN_HEIGHT, DirtyRenderer
+
+# Number of frames that a worker renders and encodes at once
+CHUNK_FRAMES = 60
+
+# Number of chunks per worker process that may be submitted but not yet
+# written, which bounds how many encoded chunks wait in memory behind a slow one
+CHUNKS_IN_FLIGHT_PER_PROCESS = 2
+
+# Default frames per second of each output format. GIF frame delays are
+# whole hundredths of a second and most viewers slow down delays shorter than
+# 2/100 s, so GIFs cannot play at 60 FPS.
+DEFAULT_GIF_FPS = 30
+DEFAULT_PNG_FPS = FPS
+
+# Longest LZW code in a GIF
+MAX_LZW_CODE_SIZE = 12
+
+def frame_delays(first_frame, num_frames, fps):
+    """
+    Returns the GIF delays (in hundredths of a second) of the specified
+    frames, rounded so that they never drift from the true frame times
+    """
+    return [round((frame + 1) * 100.0 / fps) - round(frame * 100.0 / fps)
+            for frame in range(first_frame, first_frame + num_frames)]
+
+def lzw_compress(indices, min_code_size):
+    """ Compresses a bytes object of colour indices with GIF's LZW, returning the code stream """
+    clear_code = 1 << min_code_size
+    end_code = clear_code + 1
+
+    output = bytearray()
+    # Codes are packed into bit_buffer, low bits first, and written out a
+    # few bytes at a time.
+    bit_buffer = clear_code
+    bit_count = min_code_size + 1
+
+    # The table maps (prefix code << 8 | next index) to a code.
+    table = {}
+    lookup = table.get
+    next_code = end_code + 1
+    code_size = min_code_size + 1
+    next_size_code = 1 << code_size
+
+    prefix = indices[0]
+    for index in indices[1:]:
+        key = prefix << 8 | index
+        code = lookup(key)
+        if code is not None:
+            prefix = code
+            continue
+
+        bit_buffer |= prefix << bit_count
+        bit_count += code_size
+        if bit_count >= 32:
+            output += (bit_buffer & 0xffffffff).to_bytes(4, "little")
+            bit_buffer >>= 32
+            bit_count -= 32
+
+        if next_code < 1 << MAX_LZW_CODE_SIZE:
+            table[key] = next_code
+            # The decoder widens its codes once its table reaches the next
+            # power of two, one code after the encoder adds the same entry.
+            if next_code == next_size_code:
+                code_size += 1
+                next_size_code <<= 1
+            next_code += 1
+        else:
+            # The table is full, so start a new one.
+            bit_buffer |= clear_code << bit_count
+            bit_count += code_size
+            table = {}
+            lookup = table.get
+            next_code = end_code + 1
+            code_size = min_code_size + 1
+            next_size_code = 1 << code_size
+        prefix = index
+
+    for code in (prefix, end_code):
+        bit_buffer |= code << bit_count
+        bit_count += code_size
+    output += bit_buffer.to_bytes((bit_count + 7) // 8, "little")
+    return bytes(output)
+
+def encode_gif_frame(pixels, previous, delay):
+    """
+    Returns the GIF blocks (graphic control extension, image descriptor, local
+    colour table and image data) of a frame given as a (height, width, 3)
+    uint8 array. Only the rectangle that differs from previous (the frame
+    before it, or None) is stored.
+    """
+    height, width = pixels.shape[:2]
+    left, top, right, bottom = 0, 0, width, height
+    if previous is not None:
+        changed = np.any(pixels != previous, axis=2)
+        rows = np.flatnonzero(changed.any(axis=1))
+        if len(rows) == 0:
+            # Nothing changed, but the frame still has to take up its delay.
+            right, bottom = 1, 1
+        else:
+            columns = np.flatnonzero(changed.any(axis=0))
+            left, top, right, bottom = int(columns[0]), int(rows[0]), int(columns[-1]) + 1, int(rows[-1]) + 1
+    region = pixels[top:bottom, left:right]
+
+    packed = (region[:, :, 0].astype(np.uint32) << 16) | (region[:, :, 1].astype(np.uint32) << 8) | region[:, :, 2]
+    colours, indices = np.unique(packed, return_inverse=True)
+    if len(colours) > 256:
+        # Too many colours for one table, so fall back to 3-3-2 bit RGB.
+        indices = (region[:, :, 0] & 0xe0) | ((region[:, :, 1] & 0xe0) >> 3) | (region[:, :, 2] >> 6)
+        colours = np.arange(256, dtype=np.uint32)
+        colours = ((colours & 0xe0) << 16) | ((colours & 0x1c) << 11) | ((colours & 0x03) << 6)
+
+    table_bits = max(1, int(len(colours) - 1).bit_length())
+    palette = np.zeros((1 << table_bits, 3), dtype=np.uint8)
+    palette[:len(colours), 0] = colours >> 16
+    palette[:len(colours), 1] = (colours >> 8) & 0xff
+    palette[:len(colours), 2] = colours & 0xff
+
+    min_code_size = max(2, table_bits)
+    data = lzw_compress(indices.astype(np.uint8).tobytes(), min_code_size)
+
+    # Graphic control extension: do not dispose of the frame, so that the next
+    # frame's rectangle is drawn on top of it.
+    blocks = [struct.pack("<BBBBHBB", 0x21, 0xf9, 4, 1 << 2, delay, 0, 0),
+              struct.pack("<BHHHHB", 0x2c, left, top, right - left, bottom - top, 0x80 | (table_bits - 1)),
+              palette.tobytes(),
+              bytes([min_code_size])]
+    for offset in range(0, len(data), 255):
+        sub_block = data[offset:offset + 255]
+        blocks.append(bytes([len(sub_block)]))
+        blocks.append(sub_block)
+    blocks.append(b"\x00")
+    return b"".join(blocks)
+
+class GifWriter(object):
+    """ Writes an endlessly looping animated GIF one encoded frame at a time """
+    def __init__(self, path, width, height):
+        self.file = open(path, "wb")
+        # Header and logical screen descriptor without a global colour table
+        self.file.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0, 0, 0))
+        # NETSCAPE2.0 application extension: loop forever
+        self.file.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", 0) + b"\x00")
+
+    def write(self, frames):
+        """ Writes frames encoded by encode_gif_frame() """
+        self.file.write(frames)
+
+    def close(self):
+        self.file.write(b"\x3b")
+        self.file.close()
+
+# A chunk of frames for a worker to render. snapshot is the state of the
+# Level at the chunk's first frame, inputs holds the input bitmasks of the
+# ticks between its first and last frames, and first_frame is the number of
+# its first frame in the whole export. PNG frames are written to output_dir;
+# if it is None, the frames are encoded for a GIF playing at fps.
+Chunk = collections.namedtuple("Chunk", ["level_index", "snapshot", "inputs", "ticks_per_frame",
+                                         "first_frame", "num_frames", "fps", "output_dir"])
+
+class Exporter(object):
+    """
+    Renders frames of a Level off-screen. Each worker process has one,
+    which keeps the Levels that it has built so far.
+    """
+    def __init__(self, scale):
+        pygame.font.init()
+        self.scale = scale
+        self.screen = pygame.Surface([SCREEN_WIDTH, SCREEN_HEIGHT])
+        self.renderer = DirtyRenderer(self.screen)
+        self.levels = {}
+
+    def frame(self, level):
+        """ Draws the Level and returns the frame as a Surface, which is only valid until the next frame """
+        self.renderer.draw(level, [])
+        if self.scale == 1:
+            return self.screen
+        # Nearest-neighbour scaling adds no colours, which keeps GIF colour tables small.
+        return pygame.transform.scale(self.screen, [round(SCREEN_WIDTH * self.scale),
+                                                    round(SCREEN_HEIGHT * self.scale)])
+
+    def render(self, chunk):
+        """
+        Yields the frames of a Chunk as Surfaces: the Level starts from the
+        Chunk's snapshot and is stepped ticks_per_frame ticks between frames
+        """
+        level = self.levels.get(chunk.level_index)
+        if level is None:
+            level = self.levels[chunk.level_index] = worlds_hardest_game.LEVELS[chunk.level_index]()
+        level.restore(chunk.snapshot)
+
+        ticks_per_frame = chunk.ticks_per_frame
+        for frame in range(chunk.num_frames):
+            if frame > 0:
+                for mask in chunk.inputs[(frame - 1) * ticks_per_frame:frame * ticks_per_frame]:
+                    level.step(mask)
+            yield self.frame(level)
+
+# The Exporter of this worker process, created by _init_worker()
+_exporter = None
+
+def _init_worker(scale):
+    global _exporter
+    _exporter = Exporter(scale)
+
+def _export_chunk(chunk):
+    """
+    Renders a Chunk in a worker process. Writes its frames as PNG files if
+    it has an output_dir, or else encodes them for a GIF. Returns the number
+    of frames and the encoded frames (None for PNG files).
+    """
+    if chunk.output_dir is not None:
+        for i, surface in enumerate(_exporter.render(chunk)):
+            pygame.image.save(surface, os.path.join(chunk.output_dir,
+                                                    "frame_{:06d}.png".format(chunk.first_frame + i)))
+        return chunk.num_frames, None
+
+    encoded = []
+    previous = None
+    delays = frame_delays(chunk.first_frame, chunk.num_frames, chunk.fps)
+    for surface, delay in zip(_exporter.render(chunk), delays):
+        pixels = pygame.surfarray.array3d(surface).swapaxes(0, 1)
+        encoded.append(encode_gif_frame(pixels, previous, delay))
+        previous = pixels
+    return chunk.num_frames, b"".join(encoded)
+
+def chunks(levels, ticks_per_frame, fps, output_dir, deaths=0):
+    """
+    Simulates the specified LevelRecords headless, starting with the
+    specified number of deaths, and yields a Chunk for every CHUNK_FRAMES
+    frames. The frames of a Level show it every ticks_per_frame ticks, from
+    when it starts to its last recorded tick.
+    """
+    first_frame = 0
+    for record in levels:
+        level = worlds_hardest_game.LEVELS[record.level_index]()
+        # The number of deaths carries over from the previous Level.
+        level.player.deaths = deaths
+        num_frames = record.ticks // ticks_per_frame + 1
+        chunk_ticks = CHUNK_FRAMES * ticks_per_frame
+
+        for chunk_start in range(0, num_frames, CHUNK_FRAMES):
+            chunk_frames = min(CHUNK_FRAMES, num_frames - chunk_start)
+            tick = chunk_start * ticks_per_frame
+            inputs = record.inputs[tick:tick + (chunk_frames - 1) * ticks_per_frame]
+            yield Chunk(record.level_index, level.snapshot(), inputs, ticks_per_frame,
+                        first_frame + chunk_start, chunk_frames, fps, output_dir)
+            worlds_hardest_game.simulate(level, record.inputs[tick:tick + chunk_ticks])
+
+        first_frame += num_frames
+        deaths = level.player.deaths
+
+def export(levels, output_path, fps=None, scale=1, processes=None, deaths=0):
+    """
+    Exports the specified LevelRecords to an animated GIF if output_path ends
+    in .gif, or else to PNG frames in the directory output_path. fps must
+    divide FPS; deaths is the number of deaths before the first record.
+    Returns the number of frames exported.
+    """
+    gif = output_path.lower().endswith(".gif")
+    if fps is None:
+        fps = DEFAULT_GIF_FPS if gif else DEFAULT_PNG_FPS
+    if fps <= 0 or FPS % fps != 0:
+        raise ValueError("the frame rate must divide {}".format(FPS))
+
+    output_dir = None
+    if not gif:
+        output_dir = output_path
+        os.makedirs(output_dir, exist_ok=True)
+
+    writer = None
+    if gif:
+        writer = GifWriter(output_path, round(SCREEN_WIDTH * scale), round(SCREEN_HEIGHT * scale))
+
+    max_in_flight = CHUNKS_IN_FLIGHT_PER_PROCESS * (processes or os.cpu_count() or 1)
+    num_frames = 0
+    try:
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(scale,)) as pool:
+            # Each encoded chunk is written as soon as it and every chunk
+            # before it are done. New chunks are only simulated and submitted
+            # once there is room for them, so neither the snapshots nor the
+            # encoded chunks pile up if writing falls behind.
+            in_flight = collections.deque()
+            for chunk in chunks(levels, FPS // fps, fps, output_dir, deaths):
+                in_flight.append(pool.apply_async(_export_chunk, (chunk,)))
+                while len(in_flight) >= max_in_flight or (in_flight and in_flight[0].ready()):
+                    num_frames += _write_chunk(writer, in_flight.popleft().get())
+            while in_flight:
+                num_frames += _write_chunk(writer, in_flight.popleft().get())
+    finally:
+        if writer is not None:
+            writer.close()
+    return num_frames
+
+def _write_chunk(writer, result):
+    """ Writes a chunk returned by _export_chunk() to the GifWriter (if any). Returns its number of frames. """
+    chunk_frames, encoded = result
+    if writer is not None:
+        writer.write(encoded)
+    return chunk_frames
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a replay to an animated GIF or PNG frames.")
+    parser.add_argument("path", help="replay file recorded with worlds_hardest_game.py --record")
+    parser.add_argument("--output", required=True, help="GIF file (ending in .gif) or directory of PNG frames")
+    parser.add_argument("--level", type=int, default=None, help="export only this Level of the replay (1 to 4)")
+    parser.add_argument("--fps", type=int, default=None,
+                        help="frames per second (default {} for GIFs, {} for PNG frames)".format(
+                            DEFAULT_GIF_FPS, DEFAULT_PNG_FPS))
+    parser.add_argument("--scale", type=float, default=1, help="scale factor of the frames")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    try:
+        levels = replay.load(args.path)
+    except (replay.ReplayError, struct.error, IndexError) as error:
+        print("{}: invalid replay ({})".format(args.path, error))
+        return 2
+    deaths = 0
+    if args.level is not None:
+        positions = [i for i, record in enumerate(levels) if record.level_index == args.level - 1]
+        if not positions:
+            print("{}: the replay does not include Level {}".format(args.path, args.level))
+            return 2
+        # The deaths counter starts from the deaths claimed by the Level before.
+        if positions[0] > 0:
+            deaths = levels[positions[0] - 1].deaths
+        levels = levels[positions[0]:positions[0] + 1]
+
+    start = time.perf_counter()
+    num_frames = export(levels, args.output, args.fps, args.scale, args.processes, deaths)
+    print("exported {} frames to {} in {:.1f} s".format(num_frames, args.output, time.perf_counter() - start))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+'''
+leaderboard.py
+Bulk verification of submitted replays (see replay.py). Every replay in a
+directory is played back headless, and the death count and completion tick
+that it claims for each Level are checked against what the playback
+produces. Results are written to a CSV table as they come in.
+
+Replays are verified in batches by a pool of worker processes. Enemies never
+react to the Player, so every replay of a Level sees the same enemies at the
+same tick; each worker therefore plays a whole batch of replays of a Level at
+once in a vector_env.VectorEnv, whose enemy timeline is simulated only once
+per worker and shared by every replay it verifies.
+
+Run this file to verify a directory of replays:
+    python leaderboard.py submissions/ --output results.csv
+'''
+
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+import replay
+import worlds_hardest_game
+from vector_env import VectorEnv
+
+# Number of replays that a worker verifies at once
+BATCH_SIZE = 256
+
+# Replays of a Level longer than this (in ticks) are rejected while they are
+# decoded, so that one submission cannot make the workers simulate enemies
+# indefinitely.
+MAX_LEVEL_TICKS = replay.MAX_LEVEL_TICKS
+
+# Values of the status column
+OK = "ok"                   # a complete run whose claims all match
+MISMATCH = "mismatch"       # the playback does not match what the replay claims
+INCOMPLETE = "incomplete"   # the claims match, but not every Level was completed in order
+INVALID = "invalid"         # the file is not a valid replay
+
+COLUMNS = ["file", "status", "claimed_ticks", "ticks", "claimed_deaths", "deaths", "detail"]
+
+# The VectorEnv of each Level in this worker process, created when a batch first needs it
+_envs = {}
+
+def _get_env(level_index):
+    if level_index not in _envs:
+        _envs[level_index] = VectorEnv(worlds_hardest_game.LEVELS[level_index], BATCH_SIZE)
+    return _envs[level_index]
+
+def play_level_batch(level_index, records, deaths):
+    """
+    Plays the specified LevelRecords (at most BATCH_SIZE, all of the same
+    Level) back at once. deaths holds each replay's death count from its
+    earlier Levels. Returns a list with one (ticks, deaths, completed) tuple
+    per record, which are the same as replay.play() would produce.
+    """
+    env = _get_env(level_index)
+    num_records = len(records)
+    num_ticks = max([record.ticks for record in records] + [0])
+
+    # Input bitmasks are 4 bits, so a byte each keeps a batch of hour-long
+    # replays to about BATCH_SIZE * MAX_LEVEL_TICKS bytes.
+    inputs = np.zeros((env.num_envs, num_ticks), dtype=np.uint8)
+    for i, record in enumerate(records):
+        inputs[i, :record.ticks] = record.inputs
+
+    env.reset()
+    # Copies stop being stepped once they reach the goal or run out of
+    # inputs, by marking them as having reached the goal. Copies that are not
+    # used by this batch are stopped from the start.
+    lengths = np.zeros(env.num_envs, dtype=np.int64)
+    lengths[:num_records] = [record.ticks for record in records]
+    active = lengths > 0
+    env.reached_goal |= ~active
+
+    ticks = np.zeros(env.num_envs, dtype=np.int64)
+    completed = np.zeros(env.num_envs, dtype=bool)
+    for tick in range(num_ticks):
+        if not active.any():
+            break
+        env.step(inputs[:, tick])
+        completed |= active & env.reached_goal
+        ticks[active] = tick + 1
+        active &= ~env.reached_goal & (lengths > tick + 1)
+        env.reached_goal |= ~active
+
+    return [(int(ticks[i]), deaths[i] + int(env.deaths[i]), bool(completed[i])) for i in range(num_records)]
+
+def verify_batch(paths):
+    """
+    Verifies the replay files at the specified paths. Runs in a worker
+    process. Returns a list with one row of the results table per file.
+    """
+    replays = []
+    rows = []
+    for path in paths:
+        try:
+            with open(path, "rb") as replay_file:
+                records = replay.decode(replay_file.read())
+        except Exception as error:
+            # Any failure to read or decode one file makes only that file
+            # invalid, rather than losing the rows of the rest of the batch.
+            rows.append([path, INVALID, "", "", "", "", str(error)])
+            continue
+        for record in records:
+            if record.level_index >= len(worlds_hardest_game.LEVELS):
+                rows.append([path, INVALID, "", "", "", "", "no Level {}".format(record.level_index + 1)])
+                break
+        else:
+            replays.append((path, records))
+
+    # results[i] holds the (ticks, deaths, completed) of each Level of replay i
+    # played so far. Deaths carry over from one Level to the next, so the
+    # replays are played one Level position at a time.
+    results = [[] for _ in replays]
+    position = 0
+    while True:
+        by_level = {}
+        for i, (path, records) in enumerate(replays):
+            if position < len(records):
+                by_level.setdefault(records[position].level_index, []).append(i)
+        if not by_level:
+            break
+        for level_index, indices in sorted(by_level.items()):
+            deaths = [results[i][-1][1] if results[i] else 0 for i in indices]
+            level_results = play_level_batch(level_index, [replays[i][1][position] for i in indices], deaths)
+            for i, result in zip(indices, level_results):
+                results[i].append(result)
+        position += 1
+
+    for (path, records), level_results in zip(replays, results):
+        rows.append(_result_row(path, records, level_results))
+    return rows
+
+def _result_row(path, records, level_results):
+    """ Returns the row of the results table for one replay """
+    claimed_ticks = sum(record.ticks for record in records)
+    claimed_deaths = records[-1].deaths if records else 0
+    ticks = sum(result[0] for result in level_results)
+    deaths = level_results[-1][1] if level_results else 0
+
+    detail = ""
+    for record, (level_ticks, level_deaths, completed) in zip(records, level_results):
+        if (level_ticks, level_deaths, completed) != (record.ticks, record.deaths, record.completed):
+            detail = "Level {}: claims {} ticks, {} deaths, {}; playback gives {} ticks, {} deaths, {}".format(
+                record.level_index + 1, record.ticks, record.deaths,
+                "completed" if record.completed else "not completed",
+                level_ticks, level_deaths, "completed" if completed else "not completed")
+            break
+
+    if detail:
+        status = MISMATCH
+    elif ([record.level_index for record in records] != list(range(len(worlds_hardest_game.LEVELS)))
+            or not all(record.completed for record in records)):
+        status = INCOMPLETE
+        detail = "not every Level was completed in order"
+    else:
+        status = OK
+    return [path, status, claimed_ticks, ticks, claimed_deaths, deaths, detail]
+
+def find_replays(directory):
+    """ Yields the paths of the files in the specified directory, in no particular order """
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            yield entry.path
+
+def batches(paths, batch_size=BATCH_SIZE):
+    """ Groups an iterable of paths into lists of at most batch_size paths """
+    batch = []
+    for path in paths:
+        batch.append(path)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def verify_directory(directory, processes=None):
+    """
+    Verifies every replay in the specified directory in a pool of worker
+    processes. Yields rows of the results table as batches finish.
+    """
+    with multiprocessing.Pool(processes) as pool:
+        for rows in pool.imap_unordered(verify_batch, batches(find_replays(directory))):
+            for row in rows:
+                yield row
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify a directory of submitted replays.")
+    parser.add_argument("directory", help="directory of replay files recorded with worlds_hardest_game.py --record")
+    parser.add_argument("--output", help="CSV file to write the results to (default: standard output)")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    output_file = sys.stdout if args.output is None else open(args.output, "w", newline="")
+    counts = dict.fromkeys([OK, MISMATCH, INCOMPLETE, INVALID], 0)
+    start = time.perf_counter()
+    try:
+        writer = csv.writer(output_file)
+        writer.writerow(COLUMNS)
+        for row in verify_directory(args.directory, args.processes):
+            writer.writerow(row)
+            counts[row[1]] += 1
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    print("verified {} replays in {:.1f} s ({:.0f} per minute): {}".format(
+        total, elapsed, 60 * total / elapsed if elapsed else 0,
+        ", ".join("{} {}".format(count, status) for status, count in counts.items())), file=sys.stderr)
+    return 0 if counts[MISMATCH] == counts[INVALID] == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+'''
+level_format.py
+Declarative level files. A Level is described by a JSON file listing its
+walls, goal, spawn point, rows of enemies and text; load_level() compiles it
+into a LevelData (with every enemy row expanded into individual enemies) and
+caches the result in a compact binary file, so that later loads skip parsing
+and validation entirely. worlds_hardest_game.DataLevel builds a Level from a
+LevelData.
+
+Level file format:
+{
+    "format": 1,
+    "walls": [{"rect": [left, top, width, height], "colour": [r, g, b]}, ...],
+    "goal": [left, top, width, height],
+    "spawn": [x, y],
+    "player_size": [width, height],                       (optional, default [10, 10])
+    "enemies": [{"start": [x, y], "velocity": [x, y],
+                 "count": n, "spacing": [x, y],          (optional, default 1 and [0, 0])
+                 "bouncing": false}, ...],               (optional, default false)
+    "texts": [{"text": "...", "font": "Arial", "size": 32, "bold": false,
+               "colour": [r, g, b], "position": [x, y],
+               "anchor": "topleft"}, ...]                (optional; any pygame.Rect
+                                                          corner or midpoint)
+}
+Enemies are updated in the order they are listed, which matters for enemies
+that bounce off each other.
+
+Run this file to validate and precompile level files:
+    python level_format.py levels/*.json
+'''
+
+import collections
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+
+# Version of the level file format that this module reads
+FORMAT_VERSION = 1
+
+# Bump this when the binary cache format changes so that old cache files are not used.
+CACHE_VERSION = 1
+
+CACHE_MAGIC = b"WHGL"
+
+DEFAULT_PLAYER_SIZE = [10, 10]
+
+TEXT_ANCHORS = {"topleft", "topright", "bottomleft", "bottomright",
+                "midtop", "midbottom", "midleft", "midright", "center"}
+
+# A compiled Level. walls holds (left, top, width, height, colour) tuples, the
+# goal and player are (left, top, width, height) tuples, enemies holds
+# (bouncing, x, y, velocity_x, velocity_y) tuples in update order and texts
+# holds (text, font, size, bold, colour, anchor, x, y) tuples.
+LevelData = collections.namedtuple("LevelData", ["walls", "goal", "player", "enemies", "texts"])
+
+_HEADER = struct.Struct("<4sBHIH")
+_RECT = struct.Struct("<4i")
+_WALL = struct.Struct("<4i3B")
+_ENEMY = struct.Struct("<B4i")
+_TEXT = struct.Struct("<HB3B2i")
+_STRING_LENGTH = struct.Struct("<H")
+
+def _ints(value, length, what):
+    """ Checks that value is a list of length integers and returns it as a tuple """
+    if (not isinstance(value, list) or len(value) != length
+            or not all(isinstance(item, int) and not isinstance(item, bool) for item in value)):
+        raise ValueError("{} must be a list of {} integers, not {!r}".format(what, length, value))
+    return tuple(value)
+
+def _colour(value, what):
+    colour = _ints(value, 3, what)
+    if not all(0 <= component <= 255 for component in colour):
+        raise ValueError("{} must have components between 0 and 255, not {!r}".format(what, value))
+    return colour
+
+def compile_level(definition):
+    """
+    Validates a level definition (the parsed JSON of a level file) and
+    returns it as a LevelData. Raises ValueError if the definition is invalid.
+    """
+    if definition.get("format") != FORMAT_VERSION:
+        raise ValueError("unsupported level format {!r}".format(definition.get("format")))
+
+    walls = []
+    for i, wall in enumerate(definition.get("walls", [])):
+        walls.append(_ints(wall["rect"], 4, "walls[{}].rect".format(i))
+                     + (_colour(wall["colour"], "walls[{}].colour".format(i)),))
+
+    goal = _ints(definition["goal"], 4, "goal")
+    player = (_ints(definition["spawn"], 2, "spawn")
+              + _ints(definition.get("player_size", DEFAULT_PLAYER_SIZE), 2, "player_size"))
+
+    enemies = []
+    for i, row in enumerate(definition.get("enemies", [])):
+        what = "enemies[{}]".format(i)
+        x, y = _ints(row["start"], 2, what + ".start")
+        velocity_x, velocity_y = _ints(row["velocity"], 2, what + ".velocity")
+        spacing_x, spacing_y = _ints(row.get("spacing", [0, 0]), 2, what + ".spacing")
+        count = row.get("count", 1)
+        if not isinstance(count, int) or count < 0:
+            raise ValueError("{}.count must be a non-negative integer, not {!r}".format(what, count))
+        bouncing = bool(row.get("bouncing", False))
+        for j in range(count):
+            enemies.append((bouncing, x + spacing_x * j, y + spacing_y * j, velocity_x, velocity_y))
+
+    texts = []
+    for i, text in enumerate(definition.get("texts", [])):
+        what = "texts[{}]".format(i)
+        anchor = text.get("anchor", "topleft")
+        if anchor not in TEXT_ANCHORS:
+            raise ValueError("{}.anchor must be one of {}, not {!r}".format(what, sorted(TEXT_ANCHORS), anchor))
+        x, y = _ints(text["position"], 2, what + ".position")
+        texts.append((text["text"], text.get("font", "Arial"), int(text["size"]), bool(text.get("bold", False)),
+                      _colour(text["colour"], what + ".colour"), anchor, x, y))
+
+    return LevelData(walls, goal, player, enemies, texts)
+
+def _pack_string(string):
+    encoded = string.encode("utf-8")
+    return _STRING_LENGTH.pack(len(encoded)) + encoded
+
+def _unpack_string(data, offset):
+    length, = _STRING_LENGTH.unpack_from(data, offset)
+    offset += _STRING_LENGTH.size
+    return data[offset:offset + length].decode("utf-8"), offset + length
+
+def encode(level_data):
+    """ Returns the LevelData in the binary cache format """
+    parts = [_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(level_data.walls), len(level_data.enemies), len(level_data.texts)),
+             _RECT.pack(*level_data.goal), _RECT.pack(*level_data.player)]
+    for left, top, width, height, colour in level_data.walls:
+        parts.append(_WALL.pack(left, top, width, height, *colour))
+    for enemy in level_data.enemies:
+        parts.append(_ENEMY.pack(*enemy))
+    for text, font, size, bold, colour, anchor, x, y in level_data.texts:
+        parts.append(_TEXT.pack(size, bold, colour[0], colour[1], colour[2], x, y))
+        parts.append(_pack_string(text))
+        parts.append(_pack_string(font))
+        parts.append(_pack_string(anchor))
+    return b"".join(parts)
+
+def decode(data):
+    """ Returns the LevelData stored in the binary cache format """
+    magic, version, num_walls, num_enemies, num_texts = _HEADER.unpack_from(data, 0)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION:
+        raise ValueError("not a version {} compiled level".format(CACHE_VERSION))
+    offset = _HEADER.size
+
+    goal = _RECT.unpack_from(data, offset)
+    player = _RECT.unpack_from(data, offset + _RECT.size)
+    offset += 2 * _RECT.size
+
+    walls = [(left, top, width, height, (red, green, blue))
+             for left, top, width, height, red, green, blue
+             in _WALL.iter_unpack(data[offset:offset + num_walls * _WALL.size])]
+    offset += num_walls * _WALL.size
+
+    enemies = [(bool(bouncing), x, y, velocity_x, velocity_y)
+               for bouncing, x, y, velocity_x, velocity_y
+               in _ENEMY.iter_unpack(data[offset:offset + num_enemies * _ENEMY.size])]
+    offset += num_enemies * _ENEMY.size
+
+    texts = []
+    for _ in range(num_texts):
+        size, bold, red, green, blue, x, y = _TEXT.unpack_from(data, offset)
+        offset += _TEXT.size
+        text, offset = _unpack_string(data, offset)
+        font, offset = _unpack_string(data, offset)
+        anchor, offset = _unpack_string(data, offset)
+        texts.append((text, font, size, bool(bold), (red, green, blue), anchor, x, y))
+
+    return LevelData(walls, goal, player, enemies, texts)
+
+def cache_path(path, cache_dir):
+    """
+    Returns where the compiled form of the level file at the specified path
+    is cached. The name depends on the file's path, size and modification
+    time, so editing the file makes it get compiled again.
+    """
+    stat = os.stat(path)
+    key = "{}|{}|{}|{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns, CACHE_VERSION)
+    return os.path.join(cache_dir, "levels", hashlib.sha1(key.encode("utf-8")).hexdigest() + ".whgl")
+
+def load_level(path, cache_dir):
+    """
+    Returns the LevelData of the level file at the specified path, loading it
+    from cache_dir if it has been compiled before and compiling and caching
+    it otherwise. Raises ValueError if the level file is invalid.
+    """
+    compiled_path = cache_path(path, cache_dir)
+    try:
+        with open(compiled_path, "rb") as compiled_file:
+            return decode(compiled_file.read())
+    except (OSError, ValueError, struct.error):
+        pass
+
+    with open(path) as level_file:
+        try:
+            level_data = compile_level(json.load(level_file))
+        except (KeyError, TypeError, ValueError) as error:
+            raise ValueError("{}: invalid level file ({!r})".format(path, error))
+
+    # Write to a temporary file first so that a half-written cache file is
+    # never loaded. It is named after the process and thread, since pool
+    # workers, the simulation process and the prefetch thread may compile the
+    # same level at once.
+    temp_path = "{}.{}.{}.tmp".format(compiled_path, os.getpid(), threading.get_ident())
+    try:
+        if not os.path.isdir(os.path.dirname(compiled_path)):
+            os.makedirs(os.path.dirname(compiled_path), exist_ok=True)
+        with open(temp_path, "wb") as compiled_file:
+            compiled_file.write(encode(level_data))
+        os.replace(temp_path, compiled_path)
+    except OSError:
+        # The cache directory cannot be written to, so the level is compiled
+        # again next time.
+        pass
+
+    return level_data
+
+def main():
+    from worlds_hardest_game import CACHE_DIR
+
+    if len(sys.argv) < 2:
+        print("usage: python level_format.py LEVEL_FILE...")
+        return 2
+
+    invalid = False
+    for path in sys.argv[1:]:
+        try:
+            level_data = load_level(path, CACHE_DIR)
+        except ValueError as error:
+            print(error)
+            invalid = True
+            continue
+        print("{}: {} walls, {} enemies, {} texts".format(
+            path, len(level_data.walls), len(level_data.enemies), len(level_data.texts)))
+    return 1 if invalid else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+'''
+observations.py
+Observations of a Level for automated agents, without a display.
+
+PixelObserver renders the Level into an off-screen frame buffer that is
+owned by a NumPy array, and returns that array itself rather than a copy of
+the screen. Frames after the first are drawn with a DirtyRenderer, so only
+the sprites that moved are redrawn.
+
+GridObserver skips rendering altogether: it fills a small single-channel
+grid (one cell per cell_size x cell_size pixels) straight from the positions
+of the walls, the goal, the enemies and the Player. The walls and the goal
+never move, so they are rasterised once; every observation copies them and
+marks the cells that the enemies and the Player overlap.
+
+Usage:
+    level = Level_02()
+    grid = GridObserver(level)
+    while not level.step(agent.act(grid.observe())):
+        pass
+'''
+
+import numpy as np
+import pygame
+
+from worlds_hardest_game import SCREEN_WIDTH, SCREEN_HEIGHT, DirtyRenderer
+
+# Values of the cells of a GridObserver's grid. Later entries are drawn over
+# earlier ones.
+EMPTY, WALL, GOAL, ENEMY, PLAYER = range(5)
+
+# Width and height of a GridObserver cell, in pixels
+DEFAULT_CELL_SIZE = 8
+
+class PixelObserver(object):
+    """
+    Renders Levels into an off-screen frame buffer. observe() returns a
+    (height, width, 3) uint8 view of the frame buffer's RGB channels, which
+    stays valid (and is updated in place) for the lifetime of the
+    PixelObserver; copy it to keep a frame.
+    """
+    def __init__(self):
+        # The frame buffer is a NumPy array, and the Surface that is drawn on
+        # is built on top of its memory. (A view from pygame.surfarray would
+        # lock the Surface for as long as the view exists, and a locked
+        # Surface cannot be blitted on.)
+        self.buffer = np.zeros((SCREEN_HEIGHT, SCREEN_WIDTH, 4), dtype=np.uint8)
+        self.surface = pygame.image.frombuffer(self.buffer, (SCREEN_WIDTH, SCREEN_HEIGHT), "RGBX")
+        self.pixels = self.buffer[:, :, :3]
+
+        # Levels draw their HUD and tips with fonts.
+        pygame.font.init()
+        self.renderer = DirtyRenderer(self.surface)
+
+    def observe(self, level):
+        """ Draws the specified Level (and its HUD) and returns the frame buffer's RGB view """
+        self.renderer.draw(level, [])
+        return self.pixels
+
+class GridObserver(object):
+    """
+    Observes a Level as a (rows, columns) uint8 grid of EMPTY, WALL, GOAL,
+    ENEMY and PLAYER cells. A cell holds the last of those values (in that
+    order) that overlaps it. observe() fills and returns the same array every
+    time; copy it to keep an observation.
+    """
+    def __init__(self, level, cell_size=DEFAULT_CELL_SIZE):
+        """ Rasterises the walls and the goal of the specified Level """
+        self.level = level
+        self.cell_size = cell_size
+
+        rows = -(-SCREEN_HEIGHT // cell_size)
+        columns = -(-SCREEN_WIDTH // cell_size)
+        self.static_grid = np.zeros((rows, columns), dtype=np.uint8)
+        self.grid = np.zeros((rows, columns), dtype=np.uint8)
+
+        walls = [wall for wall in level.wall_list if wall is not level.goal]
+        self.paint(self.static_grid, *_rect_arrays(walls), value=WALL)
+        self.paint(self.static_grid, *_rect_arrays([level.goal]), value=GOAL)
+
+        self.screen_rect = pygame.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+        self.enemy_sprites = level.enemy_block_list.sprites()
+        self.enemy_width, self.enemy_height = _rect_arrays(self.enemy_sprites)[2:]
+
+    def paint(self, grid, x, y, width, height, value):
+        """
+        Sets every cell of grid that overlaps one of the specified rects (given
+        as arrays of pixel coordinates and sizes) to value. Rects that are
+        partly or entirely off the screen are clipped.
+        """
+        cell_size = self.cell_size
+        rows, columns = grid.shape
+        first_column = x // cell_size
+        last_column = (x + width - 1) // cell_size
+        first_row = y // cell_size
+        last_row = (y + height - 1) // cell_size
+
+        visible = (first_column < columns) & (last_column >= 0) & (first_row < rows) & (last_row >= 0)
+        if not visible.all():
+            first_column, last_column = first_column[visible], last_column[visible]
+            first_row, last_row = first_row[visible], last_row[visible]
+        np.maximum(first_column, 0, out=first_column)
+        np.minimum(last_column, columns - 1, out=last_column)
+        np.maximum(first_row, 0, out=first_row)
+        np.minimum(last_row, rows - 1, out=last_row)
+
+        # Small rects are painted with a single assignment: each one covers at
+        # most span_rows x span_columns cells, and offsets past its far edge
+        # are clamped to that edge, which paints its last row or column again.
+        span_columns = (int(width.max(initial=0)) + cell_size - 2) // cell_size + 1
+        span_rows = (int(height.max(initial=0)) + cell_size - 2) // cell_size + 1
+        if span_columns * span_rows > len(first_column):
+            # Large rects (such as walls) are quicker to fill as slices.
+            for left, right, top, bottom in zip(first_column.tolist(), last_column.tolist(),
+                                                first_row.tolist(), last_row.tolist()):
+                grid[top:bottom + 1, left:right + 1] = value
+            return
+        row = np.minimum(first_row[:, None] + np.arange(span_rows), last_row[:, None])
+        column = np.minimum(first_column[:, None] + np.arange(span_columns), last_column[:, None])
+        grid[row[:, :, None], column[:, None, :]] = value
+
+    def observe(self):
+        """ Returns the grid of the Level in its current state """
+        level = self.level
+        grid = self.grid
+        np.copyto(grid, self.static_grid)
+
+        # The enemies' positions are read from the Level's enemy_physics if it
+        # has one, since their sprites are only brought up to date before drawing.
+        physics = level.enemy_physics
+        if physics is not None:
+            self.paint(grid, physics.x, physics.y, physics.width, physics.height, value=ENEMY)
+        elif self.enemy_sprites:
+            x = np.fromiter((sprite.rect.x for sprite in self.enemy_sprites), np.int64, len(self.enemy_sprites))
+            y = np.fromiter((sprite.rect.y for sprite in self.enemy_sprites), np.int64, len(self.enemy_sprites))
+            self.paint(grid, x, y, self.enemy_width, self.enemy_height, value=ENEMY)
+
+        # A single rect is quicker to fill as a slice.
+        rect = level.player.rect.clip(self.screen_rect)
+        cell_size = self.cell_size
+        if rect.width and rect.height:
+            grid[rect.top // cell_size:(rect.bottom - 1) // cell_size + 1,
+                 rect.left // cell_size:(rect.right - 1) // cell_size + 1] = PLAYER
+        return grid
+
+def _rect_arrays(sprites):
+    """ Returns the x, y, width and height of the specified sprites' rects as four arrays """
+    rects = np.array([tuple(sprite.rect) for sprite in sprites], dtype=np.int64).reshape(-1, 4)
+    return rects[:, 0], rects[:, 1], rects[:, 2], rects[:, 3]
@@ -0,0 +1,268 @@
+'''
+occupancy.py
+Precomputed enemy occupancy tables. Enemies never react to the Player, so
+the enemies of a Level always go through the same sequence of states, which
+eventually repeats. This module finds the period of that sequence, stores
+every enemy's position and velocity for each tick of it in a table, and
+caches the table on disk as a memory-mappable .npy file keyed by a hash of
+the Level's definition.
+
+Game gives every Level it builds an occupancy table if the table takes at
+most MAX_GAME_TABLE_BYTES; longer cycles are only used when asked for.
+
+Usage:
+    level = Level_01()
+    level.enemy_physics = PeriodicEnemyPhysics(level)
+'''
+
+import hashlib
+import json
+import os
+import warnings
+
+import numpy as np
+
+from worlds_hardest_game import CACHE_DIR, FPS
+from enemy_physics import VectorizedEnemyPhysics
+
+# Longest enemy cycle (in ticks) that is looked for
+MAX_PERIOD_TICKS = 2 * 60 * 60 * FPS
+
+# Largest table (in bytes) that Game builds for a Level as it is loaded. The
+# search for a cycle takes about as long as stepping the enemies through it,
+# so longer cycles would hold up the next Level after the congratulations
+# message (Level_02's cycle takes a 31 MB table and Level_03's 82 MB).
+MAX_GAME_TABLE_BYTES = 1 << 20
+
+# Bump this when the table format or the enemy rules change so that old
+# cache files are not used.
+TABLE_VERSION = 1
+
+# Columns of an occupancy table. table[t, i] holds enemy i's state t ticks
+# after the table was built (for t past the end, see PeriodicEnemyPhysics).
+X, Y, VELOCITY_X, VELOCITY_Y = range(4)
+
+class NoCycleError(ValueError):
+    """ Raised when the enemies' motion does not repeat within the ticks (or table size) searched """
+    pass
+
+def level_hash(physics):
+    """
+    Returns a hex digest identifying the enemies (type, rect and velocity, in
+    update order) and the walls of the Level that the VectorizedEnemyPhysics
+    was built from.
+    """
+    digest = hashlib.sha256()
+    digest.update(b"occupancy %d\n" % TABLE_VERSION)
+    for array in (physics.x, physics.y, physics.width, physics.height,
+                  physics.velocity_x, physics.velocity_y, physics.bouncing,
+                  physics.wall_x, physics.wall_y, physics.wall_width, physics.wall_height):
+        digest.update(np.ascontiguousarray(array, dtype=np.int64).tobytes())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+def find_enemy_period(physics, max_ticks=MAX_PERIOD_TICKS, max_bytes=None):
+    """
+    Steps the VectorizedEnemyPhysics until its state repeats. Returns (start,
+    period, table), where the enemies are in the same state at ticks t and
+    t + period for every t >= start, and table holds their state at every
+    tick before the repeat. Returns None if no repeat is found within
+    max_ticks ticks, or before the table would take more than max_bytes bytes.
+    """
+    # States are compared exactly, but stored as int16 to save memory for as
+    # long as every value fits.
+    dtype = np.int16
+    limits = np.iinfo(np.int16)
+
+    # Maps the hash of each state seen so far to the ticks it was seen at
+    seen = {}
+    states = []
+    for tick in range(max_ticks + 1):
+        state = np.stack([physics.x, physics.y, physics.velocity_x, physics.velocity_y], axis=1).astype(np.int64)
+        key = hash(state.tobytes())
+        for earlier in seen.get(key, ()):
+            if np.array_equal(states[earlier], state):
+                return earlier, tick - earlier, np.array(states)
+        seen.setdefault(key, []).append(tick)
+
+        if dtype is np.int16 and state.size and (state.min() < limits.min or state.max() > limits.max):
+            dtype = np.int64
+            states = [earlier_state.astype(np.int64) for earlier_state in states]
+        if max_bytes is not None and (len(states) + 1) * state.size * np.dtype(dtype).itemsize > max_bytes:
+            return None
+        states.append(state.astype(dtype))
+        physics.update()
+    return None
+
+def load_table(physics, cache_dir=CACHE_DIR, max_ticks=MAX_PERIOD_TICKS, max_bytes=None):
+    """
+    Returns (table, start, period) for the enemies of the Level that the
+    specified VectorizedEnemyPhysics was built from, in their current state,
+    or None if their motion does not repeat within max_ticks ticks (and a
+    table of at most max_bytes bytes). The table is memory-mapped from
+    cache_dir if it has been built before; otherwise the physics is stepped
+    to build it, and it is saved there.
+    """
+    key = level_hash(physics)
+    table_path = os.path.join(cache_dir, key + ".npy")
+    info_path = os.path.join(cache_dir, key + ".json")
+
+    if os.path.exists(info_path):
+        with open(info_path) as info_file:
+            info = json.load(info_file)
+        if info["period"] is not None:
+            table = np.load(table_path, mmap_mode="r")
+            if max_bytes is None or table.nbytes <= max_bytes:
+                return table, info["start"], info["period"]
+            return None
+        searched_bytes = info.get("max_bytes")
+        if info["max_ticks"] >= max_ticks and (searched_bytes is None
+                                               or (max_bytes is not None and searched_bytes >= max_bytes)):
+            # A previous search at least as long already found that the
+            # motion does not repeat.
+            return None
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Write to temporary files first so that a half-written table is never
+    # loaded. They are named after the process, since the game and its
+    # simulation process may build the same table at once.
+    suffix = ".{}.tmp".format(os.getpid())
+    cycle = find_enemy_period(physics, max_ticks, max_bytes)
+    if cycle is None:
+        # Remember the failed search, since it is as slow as a successful one.
+        with open(info_path + suffix, "w") as info_file:
+            json.dump({"start": None, "period": None, "max_ticks": max_ticks, "max_bytes": max_bytes}, info_file)
+        os.replace(info_path + suffix, info_path)
+        return None
+    start, period, table = cycle
+
+    np.save(table_path + suffix + ".npy", table)
+    os.replace(table_path + suffix + ".npy", table_path)
+    with open(info_path + suffix, "w") as info_file:
+        json.dump({"start": start, "period": period, "max_ticks": max_ticks}, info_file)
+    os.replace(info_path + suffix, info_path)
+
+    return np.load(table_path, mmap_mode="r"), start, period
+
+def use_occupancy_table(level, cache_dir=CACHE_DIR, max_ticks=MAX_PERIOD_TICKS, max_bytes=None):
+    """
+    Gives the specified Level a PeriodicEnemyPhysics if that is provably safe
+    (and its table takes at most max_bytes bytes), so that its enemies no
+    longer need to be updated every tick. Returns True if it did, or False if
+    the Level keeps its current enemy physics. Levels that already have an
+    enemy_physics, such as compact DataLevels, always keep it. A warning is
+    issued if the table could not be used for any reason other than the
+    enemies' motion not repeating.
+    """
+    if level.enemy_physics is not None:
+        return False
+    try:
+        level.enemy_physics = PeriodicEnemyPhysics(level, cache_dir, max_ticks, max_bytes)
+    except NoCycleError:
+        return False
+    except (ValueError, OSError) as error:
+        # ValueError: an enemy overrides update(); OSError: the cache
+        # directory cannot be written to.
+        warnings.warn("{} does not use an occupancy table: {}".format(type(level).__name__, error))
+        return False
+    return True
+
+class PeriodicEnemyPhysics(object):
+    """
+    Moves the EnemyBlocks of a Level by looking their states up in an
+    occupancy table instead of updating them, so a tick costs the same no
+    matter how many enemies there are. Like VectorizedEnemyPhysics, the
+    sprites' rects are only brought up to date by sync_sprites().
+    """
+    def __init__(self, level, cache_dir=CACHE_DIR, max_ticks=MAX_PERIOD_TICKS, max_bytes=None):
+        """
+        Loads or builds the occupancy table for the enemies of the specified
+        Level. Raises ValueError if the enemies cannot be replaced by a table:
+        if one of them overrides update() (so it might react to the Player), or
+        NoCycleError if their motion does not repeat within max_ticks ticks
+        (and a table of at most max_bytes bytes).
+        """
+        # VectorizedEnemyPhysics rejects enemies that override update().
+        physics = VectorizedEnemyPhysics(level)
+        loaded = load_table(physics, cache_dir, max_ticks, max_bytes)
+        if loaded is None:
+            raise NoCycleError("the enemies' motion does not repeat within {} ticks".format(max_ticks))
+
+        self.level = level
+        self.sprites = physics.sprites
+        self.table, self.start, self.period = loaded
+        self.width = physics.width
+        self.height = physics.height
+
+        # Number of ticks since the table was built, which happened on the
+        # Level's tick first_tick
+        self.tick = 0
+        self.first_tick = level.ticks
+
+    def row(self, tick):
+        """ Returns the table row holding the enemies' state at the specified tick """
+        if tick >= self.start:
+            tick = self.start + (tick - self.start) % self.period
+        return self.table[tick]
+
+    @property
+    def x(self):
+        """ The enemies' x positions on the current tick, like VectorizedEnemyPhysics.x (a view of the table) """
+        return self.row(self.tick)[:, X]
+
+    @property
+    def y(self):
+        """ The enemies' y positions on the current tick, like VectorizedEnemyPhysics.y (a view of the table) """
+        return self.row(self.tick)[:, Y]
+
+    def update(self):
+        """ Advances the enemies by one tick """
+        self.tick += 1
+
+    def _table_tick(self, level_ticks, state):
+        """
+        Returns the number of ticks since the table was built at the specified
+        tick of the Level, checking that the enemies' state (an (enemies, 4)
+        array) is where the table has them then. Raises ValueError if it is
+        not (if it is from a different run of the enemies).
+        """
+        tick = level_ticks - self.first_tick
+        if tick < 0 or not np.array_equal(self.row(tick), state):
+            raise ValueError("the enemies are not where the occupancy table has them on tick {}".format(level_ticks))
+        return tick
+
+    def check_snapshot(self, level_ticks, enemies):
+        """
+        Raises ValueError unless the enemies of a snapshot taken on the
+        specified tick of the Level (a sequence of four ints per enemy, in the
+        format of Level.snapshot()) can be restored. Level.restore() calls
+        this before it changes anything.
+        """
+        self._table_tick(level_ticks, np.asarray(enemies, dtype=np.int64).reshape(-1, 4))
+
+    def read_sprites(self):
+        """
+        Catches up with the sprites after Level.restore() has moved them.
+        Raises ValueError if they are not where the table has them on the
+        Level's tick.
+        """
+        state = np.array([(sprite.rect.x, sprite.rect.y, sprite.velocity_x, sprite.velocity_y)
+                          for sprite in self.sprites], dtype=np.int64).reshape(-1, 4)
+        self.tick = self._table_tick(self.level.ticks, state)
+
+    def collides(self, rect):
+        """ Returns True if the specified rect overlaps any enemy """
+        x = self.x
+        y = self.y
+        return bool(np.any((x < rect.x + rect.width) & (rect.x < x + self.width)
+                           & (y < rect.y + rect.height) & (rect.y < y + self.height)))
+
+    def sync_sprites(self):
+        """ Copies the enemies' positions and velocities into their sprites """
+        for sprite, (x, y, velocity_x, velocity_y) in zip(self.sprites, self.row(self.tick).tolist()):
+            sprite.rect.x = x
+            sprite.rect.y = y
+            sprite.velocity_x = velocity_x
+            sprite.velocity_y = velocity_y
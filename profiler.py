@@ -0,0 +1,241 @@
+'''
+profiler.py
+Frame profiling for the main() loop. Each frame is split into phases (event
+polling, input, HUD text, Level update, drawing, sending the frame to the
+display, and sleeping in the frame limiter), and the time spent in each one
+is recorded. Recent frame times are kept in a fixed-size ring buffer, from
+which percentiles, a histogram and dropped frame counts are computed, and
+recent phases can be exported as a Chrome trace (open it in chrome://tracing
+or https://ui.perfetto.dev).
+
+Input latency is measured too: from the moment the game first sees a change
+in the arrow keys to the end of the display update of the first frame drawn
+after a tick has applied it. (When a key is pressed while the game is
+sleeping, the time until the game wakes up is not included.)
+
+Usage:
+    profiler = FrameProfiler(FPS)
+    while running:
+        profiler.start_frame()
+        handle_events()
+        profiler.mark(EVENTS)
+        level.update()
+        profiler.mark(UPDATE)
+        ...
+        profiler.end_frame()
+'''
+
+import array
+import collections
+import json
+import time
+
+# Phases of a frame
+EVENTS, INPUT, HUD, UPDATE, DRAW, DISPLAY, SLEEP = range(7)
+PHASE_NAMES = ["events", "input", "hud", "update", "draw", "display", "sleep"]
+
+# Number of recent frames that statistics are computed over
+HISTORY_FRAMES = 600
+
+# Number of recent phases kept for trace export
+TRACE_EVENTS = 16 * HISTORY_FRAMES
+
+# A frame counts as dropped if it takes this many times as long as it should.
+DROPPED_FRAME_FACTOR = 1.5
+
+# Number of frames between updates of the overlay text
+OVERLAY_INTERVAL_FRAMES = 30
+
+# Width of the buckets of latency_report()'s histogram, in seconds
+LATENCY_BUCKET_SECONDS = 0.002
+
+def percentile(values, percent):
+    """ Returns the specified percentile of a list of values, or 0.0 if it is empty """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * percent / 100.0), len(values) - 1)]
+
+def histogram(values, bucket_size):
+    """
+    Returns a list of counts of values, where entry i counts the values
+    between i and i + 1 buckets.
+    """
+    counts = []
+    for value in values:
+        bucket = int(value / bucket_size)
+        if bucket >= len(counts):
+            counts.extend([0] * (bucket + 1 - len(counts)))
+        counts[bucket] += 1
+    return counts
+
+class FrameProfiler(object):
+    """
+    Times the phases of each frame. Call start_frame() at the start of a
+    frame, mark(phase) at the end of each phase (a phase may be marked more
+    than once per frame; its times add up) and end_frame() at the end.
+    """
+    def __init__(self, fps, history_frames=HISTORY_FRAMES, trace_events=TRACE_EVENTS):
+        """ fps is the target frame rate, or 0 if frames are not limited """
+        self.fps = fps
+        self.history_frames = history_frames
+
+        # Ring buffer of the lengths of the most recent frames, in seconds
+        self.frame_times = array.array("d", [0.0] * history_frames)
+
+        # Total number of frames that have ended
+        self.frames = 0
+
+        # Total number of frames that have been dropped
+        self.dropped_frames = 0
+
+        # Time spent in each phase during the current frame and the previous
+        # one, in seconds
+        self.phase_times = [0.0] * len(PHASE_NAMES)
+        self.last_phase_times = self.phase_times
+
+        # Most recent (phase, start, end) spans, where phase is None for a
+        # whole frame. Times are perf_counter() values.
+        self.trace = collections.deque(maxlen=trace_events)
+
+        self.frame_start = None
+        self.last_mark = None
+
+        self.overlay_text = None
+
+        # Seconds from the start of the game until the first frame was shown,
+        # if the game sets it
+        self.startup_time = None
+
+        # Ring buffer of the most recent input latencies, in seconds, and the
+        # total number that have been measured
+        self.input_latencies = array.array("d", [0.0] * history_frames)
+        self.num_input_latencies = 0
+
+        # When the oldest input change that a tick has applied, but that has
+        # not been shown yet, was first seen (a perf_counter() value)
+        self.pending_input_time = None
+
+    def start_frame(self):
+        """ Starts timing a new frame """
+        self.frame_start = self.last_mark = time.perf_counter()
+        self.phase_times = [0.0] * len(PHASE_NAMES)
+
+    def mark(self, phase):
+        """ Ends the specified phase, which started when the previous one ended """
+        now = time.perf_counter()
+        self.phase_times[phase] += now - self.last_mark
+        self.trace.append((phase, self.last_mark, now))
+        self.last_mark = now
+
+    def end_frame(self):
+        """ Ends the current frame """
+        now = time.perf_counter()
+        frame_time = now - self.frame_start
+        self.trace.append((None, self.frame_start, now))
+        self.last_phase_times = self.phase_times
+
+        self.frame_times[self.frames % self.history_frames] = frame_time
+        self.frames += 1
+        if self.fps and frame_time > DROPPED_FRAME_FACTOR / self.fps:
+            self.dropped_frames += 1
+
+    def input_applied(self, seen_time):
+        """
+        Records that a tick has applied an input change that was first seen
+        at seen_time (a perf_counter() value).
+        """
+        if self.pending_input_time is None:
+            self.pending_input_time = seen_time
+
+    def frame_shown(self):
+        """
+        Records that a frame has just been sent to the display, which ends
+        the latency of any input change applied since the previous one.
+        """
+        if self.pending_input_time is None:
+            return
+        self.input_latencies[self.num_input_latencies % self.history_frames] = (
+            time.perf_counter() - self.pending_input_time)
+        self.num_input_latencies += 1
+        self.pending_input_time = None
+
+    def recent_frame_times(self):
+        """ Returns the lengths of the most recent frames (up to history_frames of them), in seconds """
+        if self.frames < self.history_frames:
+            return self.frame_times[:self.frames].tolist()
+        return self.frame_times.tolist()
+
+    def recent_input_latencies(self):
+        """ Returns the most recent input latencies (up to history_frames of them), in seconds """
+        if self.num_input_latencies < self.history_frames:
+            return self.input_latencies[:self.num_input_latencies].tolist()
+        return self.input_latencies.tolist()
+
+    def percentile(self, percent):
+        """ Returns the specified percentile of the recent frame times, in seconds """
+        return percentile(self.recent_frame_times(), percent)
+
+    def histogram(self, bucket_seconds=0.001):
+        """
+        Returns a list of counts of recent frames, where entry i counts the
+        frames that took between i and i + 1 buckets of time.
+        """
+        return histogram(self.recent_frame_times(), bucket_seconds)
+
+    def latency_percentile(self, percent):
+        """ Returns the specified percentile of the recent input latencies, in seconds """
+        return percentile(self.recent_input_latencies(), percent)
+
+    def latency_histogram(self, bucket_seconds=LATENCY_BUCKET_SECONDS):
+        """ Returns a histogram (like histogram()) of the recent input latencies """
+        return histogram(self.recent_input_latencies(), bucket_seconds)
+
+    def latency_report(self, bucket_seconds=LATENCY_BUCKET_SECONDS):
+        """ Returns the recent input latencies' percentiles and histogram as lines of text """
+        counts = self.latency_histogram(bucket_seconds)
+        lines = ["input latency over the last {} inputs: p50 {:.1f} ms, p99 {:.1f} ms".format(
+            sum(counts), 1000 * self.latency_percentile(50), 1000 * self.latency_percentile(99))]
+        most = max(counts, default=0)
+        for i, count in enumerate(counts):
+            lines.append("{:5.0f}-{:<3.0f} ms {:6} {}".format(
+                1000 * i * bucket_seconds, 1000 * (i + 1) * bucket_seconds, count, "#" * (40 * count // most)))
+        return lines
+
+    def overlay_lines(self):
+        """
+        Returns the lines of text shown by the overlay. They are only worked
+        out again every OVERLAY_INTERVAL_FRAMES frames, so that the text is
+        readable and is not rendered every frame.
+        """
+        if self.overlay_text is None or self.frames % OVERLAY_INTERVAL_FRAMES == 0:
+            self.overlay_text = [
+                "frame p50 {:.1f} ms  p99 {:.1f} ms".format(1000 * self.percentile(50), 1000 * self.percentile(99)),
+                "dropped {} of {} frames  startup {:.0f} ms".format(
+                    self.dropped_frames, self.frames, 1000 * (self.startup_time or 0.0)),
+                "input latency p50 {:.1f} ms  p99 {:.1f} ms".format(
+                    1000 * self.latency_percentile(50), 1000 * self.latency_percentile(99)),
+                "  ".join("{} {:.1f}".format(name, 1000 * phase_time)
+                          for name, phase_time in zip(PHASE_NAMES, self.last_phase_times)),
+            ]
+        return self.overlay_text
+
+    def chrome_trace(self):
+        """ Returns the recent phases as a dict in Chrome's trace event format """
+        events = []
+        for phase, start, end in self.trace:
+            events.append({
+                "name": "frame" if phase is None else PHASE_NAMES[phase],
+                "cat": "frame" if phase is None else "phase",
+                "ph": "X",
+                "ts": start * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": 0,
+                "tid": 0,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_chrome_trace(self, path):
+        """ Writes the recent phases to a Chrome trace file """
+        with open(path, "w") as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
@@ -0,0 +1,237 @@
+'''
+replay.py
+Compact, deterministic input replays. main() can record the input bitmask
+of every tick the Level is updated on; a replay stores the inputs of each
+Level run-length encoded, together with the tick the Level was completed on
+and the Player's total deaths at that point, which serve as a checksum. Since
+the game is deterministic, playing a replay back headless reproduces the run
+exactly, so the recorded deaths and completion ticks can be verified.
+
+File format (all integers little-endian):
+    header:  b"WHGR", version (u8)
+    level:   b"L", level index (u8), completed (u8), ticks (u32), deaths (u32),
+             number of runs (u32), runs
+    trailer: b"E", CRC-32 of everything before the trailer (u32)
+Each run is a varint (7 bits per byte, low bits first) holding
+(run length << 4) | input bitmask.
+
+Run this file to verify a replay:
+    python replay.py run.whgr
+'''
+
+import argparse
+import collections
+import struct
+import sys
+import zlib
+
+import worlds_hardest_game
+
+MAGIC = b"WHGR"
+VERSION = 1
+
+_LEVEL_HEADER = struct.Struct("<BBIII")
+_TRAILER = struct.Struct("<I")
+
+# Levels of a replay longer than this (in ticks) are rejected while it is
+# decoded, before their inputs are expanded, so that a malformed or hostile
+# replay cannot make decode() allocate an unbounded list of inputs.
+# ReplayRecorder stops recording when a Level reaches this length, so
+# encode() never has to write a longer one.
+MAX_LEVEL_TICKS = 60 * 60 * worlds_hardest_game.FPS
+
+# One Level of a replay. inputs holds one input bitmask per tick that the
+# Level was updated on; ticks is len(inputs); deaths is the Player's total
+# number of deaths (carried over from earlier Levels) at the end of the Level.
+LevelRecord = collections.namedtuple("LevelRecord", ["level_index", "completed", "ticks", "deaths", "inputs"])
+
+class ReplayError(Exception):
+    """ Raised when a replay file is malformed """
+    pass
+
+def encode_runs(inputs):
+    """ Run-length encodes a list of input bitmasks into bytes """
+    encoded = bytearray()
+    runs = 0
+    index = 0
+    while index < len(inputs):
+        mask = inputs[index]
+        length = 1
+        while index + length < len(inputs) and inputs[index + length] == mask:
+            length += 1
+        index += length
+        runs += 1
+
+        value = (length << 4) | mask
+        while value >= 0x80:
+            encoded.append((value & 0x7F) | 0x80)
+            value >>= 7
+        encoded.append(value)
+    return runs, bytes(encoded)
+
+def decode_runs(data, offset, runs, max_ticks):
+    """
+    Decodes the specified number of runs starting at data[offset]. Returns
+    the list of input bitmasks and the offset just past the runs. Raises
+    ReplayError if the runs add up to more than max_ticks inputs.
+    """
+    inputs = []
+    for _ in range(runs):
+        value = 0
+        shift = 0
+        while True:
+            if offset >= len(data):
+                raise ReplayError("replay ends in the middle of a run")
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        # Checked before the run is expanded, since a few bytes can hold an
+        # arbitrarily long run.
+        if len(inputs) + (value >> 4) > max_ticks:
+            raise ReplayError("runs add up to more than {} ticks".format(max_ticks))
+        inputs.extend([value & 0xF] * (value >> 4))
+    return inputs, offset
+
+def encode(levels):
+    """
+    Returns the bytes of a replay containing the specified LevelRecords.
+    Raises ValueError if one of them is longer than MAX_LEVEL_TICKS, since
+    decode() would reject the replay.
+    """
+    data = bytearray(MAGIC)
+    data.append(VERSION)
+    for level in levels:
+        if level.ticks > MAX_LEVEL_TICKS:
+            raise ValueError("level {} is longer than {} ticks".format(level.level_index + 1, MAX_LEVEL_TICKS))
+        runs, encoded_runs = encode_runs(level.inputs)
+        data += b"L"
+        data += _LEVEL_HEADER.pack(level.level_index, level.completed, level.ticks, level.deaths, runs)
+        data += encoded_runs
+    data += b"E"
+    data += _TRAILER.pack(zlib.crc32(bytes(data)) & 0xFFFFFFFF)
+    return bytes(data)
+
+def decode(data):
+    """ Returns the list of LevelRecords stored in the bytes of a replay """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ReplayError("not a replay file")
+    if data[len(MAGIC)] != VERSION:
+        raise ReplayError("unsupported replay version {}".format(data[len(MAGIC)]))
+
+    levels = []
+    offset = len(MAGIC) + 1
+    while True:
+        tag = data[offset:offset + 1]
+        offset += 1
+        if tag == b"E":
+            break
+        if tag != b"L":
+            raise ReplayError("unexpected block at offset {}".format(offset - 1))
+        level_index, completed, ticks, deaths, runs = _LEVEL_HEADER.unpack_from(data, offset)
+        offset += _LEVEL_HEADER.size
+        if ticks > MAX_LEVEL_TICKS:
+            raise ReplayError("level {} is longer than {} ticks".format(level_index + 1, MAX_LEVEL_TICKS))
+        inputs, offset = decode_runs(data, offset, runs, ticks)
+        if len(inputs) != ticks:
+            raise ReplayError("level {} has {} inputs but claims {} ticks".format(level_index + 1, len(inputs), ticks))
+        levels.append(LevelRecord(level_index, bool(completed), ticks, deaths, inputs))
+
+    checksum, = _TRAILER.unpack_from(data, offset)
+    if checksum != zlib.crc32(data[:offset]) & 0xFFFFFFFF:
+        raise ReplayError("checksum mismatch")
+    return levels
+
+def load(path):
+    """ Returns the list of LevelRecords in the replay file at the specified path """
+    with open(path, "rb") as replay_file:
+        return decode(replay_file.read())
+
+def save(path, levels):
+    """ Writes the specified LevelRecords to a replay file """
+    with open(path, "wb") as replay_file:
+        replay_file.write(encode(levels))
+
+class ReplayRecorder(object):
+    """
+    Records the input bitmask of every tick in main(). The replay file is
+    rewritten every time a Level ends, so a crash loses at most one Level.
+    Recording stops for good once a Level ends without being completed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.levels = []
+        self.inputs = []
+        self.stopped = False
+
+    def record(self, input_mask):
+        """ Records the input bitmask of a tick that the current Level was updated on """
+        if not self.stopped:
+            self.inputs.append(input_mask)
+
+    def level_full(self):
+        """
+        Returns True if the current Level has MAX_LEVEL_TICKS ticks recorded,
+        in which case it must be ended, since a replay cannot hold more.
+        """
+        return len(self.inputs) >= MAX_LEVEL_TICKS
+
+    def end_level(self, level_index, deaths, completed=True):
+        """
+        Ends the current Level. deaths is the Player's total number of deaths
+        so far; completed is False if the game was quit during the Level or
+        the Level is full, which stops the recording.
+        """
+        if self.stopped:
+            return
+        self.levels.append(LevelRecord(level_index, completed, len(self.inputs), deaths, self.inputs))
+        self.inputs = []
+        self.stopped = not completed
+        save(self.path, self.levels)
+
+# The outcome of playing back one LevelRecord. ticks and deaths are what the
+# playback produced; ok is True if they match the record.
+PlaybackResult = collections.namedtuple("PlaybackResult", ["level_index", "ok", "ticks", "deaths", "completed"])
+
+def play(levels, level_classes=worlds_hardest_game.LEVELS):
+    """
+    Plays the specified LevelRecords back headless as fast as possible and
+    returns a list with one PlaybackResult per record.
+    """
+    results = []
+    deaths = 0
+    for record in levels:
+        level = level_classes[record.level_index]()
+        # The number of deaths carries over from the previous Level.
+        level.player.deaths = deaths
+        ticks = worlds_hardest_game.simulate(level, record.inputs)
+        deaths = level.player.deaths
+        completed = level.player.reached_goal
+        ok = ticks == record.ticks and deaths == record.deaths and completed == record.completed
+        results.append(PlaybackResult(record.level_index, ok, ticks, deaths, completed))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify a replay by playing it back headless.")
+    parser.add_argument("path", help="replay file recorded with worlds_hardest_game.py --record")
+    args = parser.parse_args()
+
+    try:
+        levels = load(args.path)
+    except (ReplayError, struct.error, IndexError) as error:
+        print("{}: invalid replay ({})".format(args.path, error))
+        return 2
+
+    all_ok = True
+    for record, result in zip(levels, play(levels)):
+        status = "ok" if result.ok else "MISMATCH"
+        print("Level {}: {} ticks, {} deaths, {} [{}]".format(
+            record.level_index + 1, record.ticks, record.deaths,
+            "completed" if record.completed else "not completed", status))
+        all_ok = all_ok and result.ok
+    return 0 if all_ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
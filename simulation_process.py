@@ -0,0 +1,310 @@
+'''
+simulation_process.py
+Runs the game's simulation in a worker process, so that drawing and
+simulating use a core each. The worker runs a Game at FPS ticks per second
+and, after every tick, writes its state into a block of shared memory; the
+main process keeps a RemoteGame, a copy of the Game that is never ticked but
+is brought up to date from the shared memory before every frame is drawn.
+
+Shared memory layout (native byte order):
+    control:  front buffer index, stop flag, done flag, input write index,
+              input read index (i64 each)
+    input:    INPUT_RING_SIZE input bitmasks (u8)
+    buffer 0: sequence number, tick, level index, congratulations ticks,
+              deaths, snapshot length (i64 each), then a Level.snapshot()
+    buffer 1: the same
+The two buffers are double buffered: the worker writes the back buffer and
+then makes it the front one. Each buffer is also a seqlock (its sequence
+number is odd while it is being written), so the main process copies the
+front buffer without taking a lock, and only uses the copy if the sequence
+number shows that the worker did not write to the buffer in the meantime.
+Input goes the other way through a single-producer, single-consumer ring of
+input bitmasks.
+
+Usage:
+    python worlds_hardest_game.py --simulation-process
+'''
+
+import multiprocessing
+import multiprocessing.shared_memory
+import time
+
+import numpy as np
+
+import worlds_hardest_game
+from worlds_hardest_game import (MAX_CATCH_UP_TICKS, SNAPSHOT_HEADER, TICK_SECONDS,
+                                 Game, GameOverScreen, wait_until)
+
+# Indices of the control fields
+FRONT, STOP, DONE, INPUT_WRITE, INPUT_READ = range(5)
+NUM_CONTROL_FIELDS = 5
+
+# Indices of the fields at the start of each buffer
+SEQUENCE, TICK, LEVEL_INDEX, CONGRATULATIONS_TICKS, DEATHS, SNAPSHOT_LENGTH = range(6)
+NUM_BUFFER_FIELDS = 6
+
+# Number of input bitmasks that the input ring holds
+INPUT_RING_SIZE = 256
+
+# Most EnemyBlocks that a Level may have in this mode; the shared memory is
+# sized for this many.
+MAX_ENEMIES = 4096
+
+# Seconds that close() waits for the worker to stop before terminating it
+STOP_TIMEOUT_SECONDS = 5.0
+
+class SharedState(object):
+    """ NumPy views of the fields of the shared memory block (see the layout above) """
+    def __init__(self, shared_memory, max_enemies):
+        buf = shared_memory.buf
+        self.max_enemies = max_enemies
+        offset = 0
+        self.control = np.ndarray(NUM_CONTROL_FIELDS, dtype=np.int64, buffer=buf, offset=offset)
+        offset += self.control.nbytes
+        self.inputs = np.ndarray(INPUT_RING_SIZE, dtype=np.uint8, buffer=buf, offset=offset)
+        offset += self.inputs.nbytes
+
+        snapshot_capacity = _round_up(SNAPSHOT_HEADER.size + 16 * max_enemies)
+        self.headers = []
+        self.snapshots = []
+        for _ in range(2):
+            header = np.ndarray(NUM_BUFFER_FIELDS, dtype=np.int64, buffer=buf, offset=offset)
+            offset += header.nbytes
+            self.headers.append(header)
+            self.snapshots.append(buf[offset:offset + snapshot_capacity])
+            offset += snapshot_capacity
+
+    def release(self):
+        """ Drops the views, which must be done before the shared memory is closed """
+        for snapshot in self.snapshots:
+            snapshot.release()
+        self.control = self.inputs = self.headers = self.snapshots = None
+
+def _round_up(size):
+    """ Rounds size up to a multiple of 8 bytes, so that the next field is aligned """
+    return (size + 7) // 8 * 8
+
+def shared_memory_size(max_enemies):
+    """ Returns the size in bytes of the shared memory block """
+    return (8 * NUM_CONTROL_FIELDS + INPUT_RING_SIZE
+            + 2 * (8 * NUM_BUFFER_FIELDS + _round_up(SNAPSHOT_HEADER.size + 16 * max_enemies)))
+
+def _publish(state, game, ticks, deaths):
+    """ Writes the Game's state after the specified number of ticks to the back buffer and flips the buffers """
+    back = 1 - int(state.control[FRONT])
+    header = state.headers[back]
+
+    # The game over screen has no Player, so it has no snapshot.
+    snapshot = b""
+    if game.current_level.player is not None:
+        snapshot = game.current_level.snapshot()
+        if len(snapshot) > len(state.snapshots[back]):
+            raise ValueError("Levels may have at most {} EnemyBlocks when simulated in another process".format(
+                state.max_enemies))
+
+    header[SEQUENCE] += 1
+    header[TICK] = ticks
+    header[LEVEL_INDEX] = game.current_level_index
+    header[CONGRATULATIONS_TICKS] = game.congratulations_text_ticks
+    header[DEATHS] = deaths
+    state.snapshots[back][:len(snapshot)] = snapshot
+    header[SNAPSHOT_LENGTH] = len(snapshot)
+    header[SEQUENCE] += 1
+
+    state.control[FRONT] = back
+
+def _run_simulation(shared_memory_name, max_enemies, level_classes, record_path, telemetry_dir):
+    """ The worker process: runs a Game at FPS ticks per second until it ends or is stopped """
+    shared_memory = multiprocessing.shared_memory.SharedMemory(shared_memory_name)
+    state = SharedState(shared_memory, max_enemies)
+
+    recorder = None
+    if record_path is not None:
+        import replay
+        recorder = replay.ReplayRecorder(record_path)
+    telemetry_log = None
+    if telemetry_dir is not None:
+        import telemetry
+        telemetry_log = telemetry.open_session_log(telemetry_dir)
+    game = Game(level_classes, recorder, telemetry=telemetry_log)
+
+    mask = 0
+    ticks = 0
+    deaths = 0
+    next_tick_time = time.perf_counter()
+    try:
+        while not game.done and not state.control[STOP]:
+            wait_until(next_tick_time)
+
+            # Only the newest input matters, like the key_pressed list in main().
+            read_index = int(state.control[INPUT_READ])
+            write_index = int(state.control[INPUT_WRITE])
+            if read_index != write_index:
+                mask = int(state.inputs[(write_index - 1) % INPUT_RING_SIZE])
+                state.control[INPUT_READ] = write_index
+
+            game.tick(mask)
+            ticks += 1
+            if game.current_level.player is not None:
+                deaths = game.current_level.player.deaths
+            _publish(state, game, ticks, deaths)
+
+            # Like main(), fall behind instead of running more than
+            # MAX_CATCH_UP_TICKS ticks in a row to catch up.
+            next_tick_time = max(next_tick_time + TICK_SECONDS,
+                                 time.perf_counter() - MAX_CATCH_UP_TICKS * TICK_SECONDS)
+    finally:
+        game.close()
+        state.control[DONE] = 1
+        state.release()
+        shared_memory.close()
+
+class RemoteGame(Game):
+    """
+    A Game that is simulated by a worker process. Instead of calling tick(),
+    send the newest input bitmask with send_input() and call sync() before
+    drawing to bring the current Level and the Game's messages up to date.
+    """
+    def __init__(self, level_classes=worlds_hardest_game.LEVELS, record_path=None, max_enemies=MAX_ENEMIES,
+                 telemetry_dir=None):
+        """
+        Starts a worker process that plays through the specified Level
+        classes, recording its inputs to a replay at record_path and its
+        telemetry to a session file in telemetry_dir if they are given.
+        The main process builds its own instance of each Level, which it
+        draws the worker's state on.
+        """
+        super(RemoteGame, self).__init__(level_classes)
+
+        self.shared_memory = multiprocessing.shared_memory.SharedMemory(
+            create=True, size=shared_memory_size(max_enemies))
+        self.state = SharedState(self.shared_memory, max_enemies)
+        self.state.control[:] = 0
+        for header in self.state.headers:
+            header[:] = 0
+
+        # The most recent tick that sync() has read, and the most recent
+        # input bitmask that send_input() has sent
+        self.ticks = 0
+        self.last_input = 0
+
+        # The index of the Level that next_level (if any) is building
+        self.next_level_index = None
+
+        # The pygame display must not be copied into the worker, so it is
+        # started afresh rather than forked.
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(target=_run_simulation,
+                                       args=(self.shared_memory.name, max_enemies, level_classes, record_path,
+                                             telemetry_dir),
+                                       daemon=True)
+        try:
+            self.process.start()
+        except BaseException:
+            # Nothing else will free the shared memory if the worker never starts.
+            self.state.release()
+            self.shared_memory.close()
+            self.shared_memory.unlink()
+            self.level_loader.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    def build_level(self, level_class):
+        # The worker moves the enemies; this copy of each Level only restores
+        # the worker's snapshots.
+        return level_class()
+
+    def tick(self, input_mask):
+        raise TypeError("a RemoteGame is ticked by its worker process; use send_input() and sync()")
+
+    def send_input(self, input_mask):
+        """ Sends the input bitmask to the worker if it has changed """
+        if input_mask == self.last_input:
+            return
+        control = self.state.control
+        write_index = int(control[INPUT_WRITE])
+        # When the ring is full, the worker has not read anything for
+        # INPUT_RING_SIZE changes, and only the newest input matters anyway.
+        self.state.inputs[write_index % INPUT_RING_SIZE] = input_mask
+        # The input is written before the write index, so the worker never
+        # reads an entry that is not there yet.
+        control[INPUT_WRITE] = write_index + 1
+        self.last_input = input_mask
+
+    def sync(self):
+        """
+        Brings the Game up to date with the newest tick that the worker has
+        published. Returns the number of ticks since the previous call, or 0
+        if nothing has changed. Raises RuntimeError if the worker has died.
+        """
+        state = self.state
+        while True:
+            front = int(state.control[FRONT])
+            header = state.headers[front]
+            sequence = int(header[SEQUENCE])
+            if sequence & 1:
+                # The worker is writing this buffer; it flips to the other one next.
+                if not self.process.is_alive():
+                    raise RuntimeError("the simulation process exited with code {}".format(self.process.exitcode))
+                continue
+            # Everything is copied out before it is used, and only used if the
+            # worker did not write to the buffer in the meantime; otherwise the
+            # new front buffer is read instead.
+            fields = header.tolist()
+            snapshot = bytes(state.snapshots[front][:max(fields[SNAPSHOT_LENGTH], 0)])
+            if int(header[SEQUENCE]) == sequence:
+                break
+
+        ticks = fields[TICK]
+        if ticks == self.ticks:
+            if not state.control[DONE] and not self.process.is_alive():
+                raise RuntimeError("the simulation process exited with code {}".format(self.process.exitcode))
+        else:
+            self._apply(fields, snapshot)
+
+        new_ticks = ticks - self.ticks
+        self.ticks = ticks
+        if state.control[DONE]:
+            self.done = True
+            if not self.process.is_alive() and self.process.exitcode != 0:
+                raise RuntimeError("the simulation process exited with code {}".format(self.process.exitcode))
+        return new_ticks
+
+    def _apply(self, fields, snapshot):
+        """ Brings the Game up to date with a copy of one buffer's fields and snapshot """
+        level_index = fields[LEVEL_INDEX]
+        if level_index != self.current_level_index:
+            self.current_level_index = level_index
+            if self.playing():
+                if self.next_level is not None and self.next_level_index == level_index:
+                    self.current_level = self.next_level.result()
+                else:
+                    self.current_level = self.build_level(self.level_classes[level_index])
+                self.next_level = None
+            else:
+                self.game_over_messages.append("Total number of deaths: " + str(fields[DEATHS]))
+                self.current_level = GameOverScreen()
+
+        self.congratulations_text_ticks = fields[CONGRATULATIONS_TICKS]
+
+        if snapshot and self.current_level.player is not None:
+            self.current_level.restore(snapshot)
+
+            # Build the next Level in the background while the congratulations
+            # message is showing, like Game.tick() does.
+            if (self.current_level.player.reached_goal and self.next_level is None
+                    and level_index + 1 < len(self.level_classes)):
+                self.next_level_index = level_index + 1
+                self.next_level = self.level_loader.submit(self.build_level, self.level_classes[level_index + 1])
+
+    def close(self):
+        """ Stops the worker process (which finishes its replay, if any) and frees the shared memory """
+        self.state.control[STOP] = 1
+        self.process.join(STOP_TIMEOUT_SECONDS)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+        self.state.release()
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+        super(RemoteGame, self).close()
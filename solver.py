@@ -0,0 +1,216 @@
+'''
+solver.py
+Finds the fastest death-free input sequence from the Player's spawn to the
+Goal of a Level. The search is a breadth-first search over the time-expanded
+state space (player x, player y, tick), done one tick at a time with NumPy:
+every position reached at tick t is expanded with all nine distinct moves,
+and moves that touch an enemy at tick t + 1 are pruned using the enemies'
+precomputed positions. Enemies never react to the Player, so their motion is
+eventually periodic; once it is, positions that were already reached at the
+same point of the enemy cycle are pruned as well.
+
+Run this file to solve every Level in parallel and print their par times:
+    python solver.py
+'''
+
+import argparse
+import collections
+import multiprocessing
+import sys
+
+import numpy as np
+
+import worlds_hardest_game
+from worlds_hardest_game import FPS, SCREEN_WIDTH, SCREEN_HEIGHT, UP, DOWN, LEFT, RIGHT
+from enemy_physics import VectorizedEnemyPhysics
+from vector_env import VectorEnv, input_velocities
+from occupancy import find_enemy_period
+
+# Every distinct move the Player can make in one tick. Pressing opposite keys
+# together cancels them out, so other input bitmasks add nothing new.
+MOVES = np.array([0, UP, DOWN, LEFT, RIGHT, UP | LEFT, UP | RIGHT, DOWN | LEFT, DOWN | RIGHT])
+
+# Longest route (in ticks) that solve() looks for by default
+MAX_TICKS = 60 * FPS
+
+# Largest table of already-visited (position, enemy cycle) states, in bytes
+VISITED_BUDGET_BYTES = 256 * 1024 * 1024
+
+# Special entries in solve()'s table of moves
+UNKNOWN = -1
+GOAL = -2
+OFF_SCREEN = -3
+
+LEVELS = ["Level_01", "Level_02", "Level_03", "Level_04"]
+
+# The result of solve(). inputs holds one input bitmask per tick.
+Solution = collections.namedtuple("Solution", ["level_name", "ticks", "inputs"])
+
+def solve(level_class, max_ticks=MAX_TICKS):
+    """
+    Returns the Solution with the fewest ticks that gets the Player of the
+    specified Level to the Goal without touching an enemy, or None if there
+    is no such route within max_ticks ticks.
+    """
+    env = VectorEnv(level_class, 0)
+    level_name = level_class.__name__
+
+    cycle = find_enemy_period(VectorizedEnemyPhysics(level_class()), max_ticks)
+    if cycle is None:
+        start, period = max_ticks + 1, 1
+    else:
+        start, period, _ = cycle
+    env.extend_timeline(min(max_ticks, start + period) + 1)
+
+    # Positions are stored as keys: y * SCREEN_WIDTH + x
+    num_positions = SCREEN_WIDTH * SCREEN_HEIGHT
+
+    # visited[phase] is a bitmap of the positions reached at that point of the enemy cycle.
+    if cycle is not None and period * num_positions // 8 <= VISITED_BUDGET_BYTES:
+        visited = np.zeros((period, (num_positions + 7) // 8), dtype=np.uint8)
+    else:
+        visited = None
+
+    # Walls never move, so where each (position, move) pair ends up is only
+    # worked out once. Entries are UNKNOWN until then, GOAL if the move
+    # reaches the goal and OFF_SCREEN if it leaves the screen, which is
+    # treated as blocked.
+    transitions = np.full(num_positions * len(MOVES), UNKNOWN, dtype=np.int32)
+    move_velocity_x, move_velocity_y = input_velocities(MOVES)
+
+    # danger[key] is True if a Player at that position touches an enemy.
+    danger = np.zeros(num_positions, dtype=bool)
+
+    # Maps a position key to the index of its first occurrence among the candidates
+    first_index = np.empty(num_positions, dtype=np.int64)
+
+    frontier = np.array([env.initial_player_y * SCREEN_WIDTH + env.initial_player_x], dtype=np.int64)
+
+    # history[t] holds, for every position reached at tick t + 1, the index of
+    # its predecessor at tick t and the index of the move that was made.
+    history = []
+
+    for tick in range(1, max_ticks + 1):
+        if tick < start:
+            timeline_tick = tick
+        else:
+            timeline_tick = start + (tick - start) % period
+
+        parents = np.repeat(np.arange(len(frontier)), len(MOVES))
+        moves = np.tile(np.arange(len(MOVES)), len(frontier))
+        candidates = frontier[parents] * len(MOVES) + moves
+
+        destinations = transitions[candidates]
+        unknown = np.flatnonzero(destinations == UNKNOWN)
+        if len(unknown) > 0:
+            keys = frontier[parents[unknown]]
+            x, y, at_goal = env.move_players(keys % SCREEN_WIDTH, keys // SCREEN_WIDTH,
+                                             move_velocity_x[moves[unknown]], move_velocity_y[moves[unknown]])
+            off_screen = (x < 0) | (x >= SCREEN_WIDTH) | (y < 0) | (y >= SCREEN_HEIGHT)
+            destinations[unknown] = np.where(at_goal, GOAL, np.where(off_screen, OFF_SCREEN, y * SCREEN_WIDTH + x))
+            transitions[candidates[unknown]] = destinations[unknown]
+
+        # The Player is checked against the enemies before being pushed out of
+        # walls. Positions off the screen have no key, so they are blocked.
+        _mark_danger(danger, env, timeline_tick)
+        moved_x = frontier[parents] % SCREEN_WIDTH + move_velocity_x[moves]
+        moved_y = frontier[parents] // SCREEN_WIDTH + move_velocity_y[moves]
+        on_screen = (moved_x >= 0) & (moved_x < SCREEN_WIDTH) & (moved_y >= 0) & (moved_y < SCREEN_HEIGHT)
+        safe = on_screen & ~danger[np.where(on_screen, moved_y * SCREEN_WIDTH + moved_x, 0)]
+        safe &= destinations != OFF_SCREEN
+
+        winners = np.flatnonzero(safe & (destinations == GOAL))
+        if len(winners) > 0:
+            winner = winners[0]
+            inputs = [int(MOVES[moves[winner]])]
+            parent = parents[winner]
+            for parents_before, moves_before in reversed(history):
+                inputs.append(int(MOVES[moves_before[parent]]))
+                parent = parents_before[parent]
+            inputs.reverse()
+            return Solution(level_name, tick, inputs)
+
+        safe = np.flatnonzero(safe & (destinations != GOAL))
+        keys, parents, moves = destinations[safe].astype(np.int64), parents[safe], moves[safe]
+
+        # Keep only the first way of reaching each position.
+        order = np.arange(len(keys))
+        first_index[keys[::-1]] = order[::-1]
+        keep = first_index[keys] == order
+
+        if visited is not None and tick >= start:
+            phase = visited[(tick - start) % period]
+            bits = (1 << (keys & 7)).astype(np.uint8)
+            keep &= (phase[keys >> 3] & bits) == 0
+            np.bitwise_or.at(phase, keys[keep] >> 3, bits[keep])
+
+        frontier = keys[keep]
+        history.append((parents[keep], moves[keep]))
+
+        if len(frontier) == 0:
+            return None
+
+    return None
+
+def _mark_danger(danger, env, timeline_tick):
+    """
+    Sets danger (a flattened SCREEN_HEIGHT x SCREEN_WIDTH grid of Player
+    positions) to True wherever a Player would touch one of the enemies at
+    the specified tick of the VectorEnv's enemy timeline.
+    """
+    grid = danger.reshape(SCREEN_HEIGHT, SCREEN_WIDTH)
+    grid[:] = False
+    for x, y, width, height in zip(env.enemy_x[timeline_tick].tolist(), env.enemy_y[timeline_tick].tolist(),
+                                   env.enemy_width.tolist(), env.enemy_height.tolist()):
+        grid[max(y - env.player_height + 1, 0):max(y + height, 0),
+             max(x - env.player_width + 1, 0):max(x + width, 0)] = True
+
+def verify(level_class, solution):
+    """
+    Plays the Solution's inputs on a new instance of the Level and returns
+    True if the Player reaches the goal on the last tick without dying.
+    """
+    level = level_class()
+    ticks = worlds_hardest_game.simulate(level, solution.inputs)
+    return ticks == solution.ticks and level.player.reached_goal and level.player.deaths == 0
+
+def _solve_level(args):
+    """ Solves and verifies one Level. Runs in a worker process. """
+    level_name, max_ticks = args
+    level_class = getattr(worlds_hardest_game, level_name)
+    solution = solve(level_class, max_ticks)
+    if solution is not None and not verify(level_class, solution):
+        raise RuntimeError(level_name + ": the solution does not replay correctly")
+    return level_name, solution
+
+def solve_levels(level_names=LEVELS, max_ticks=MAX_TICKS, processes=None):
+    """
+    Solves the Levels with the specified names (attributes of
+    worlds_hardest_game) in a pool of worker processes. Returns a dict
+    mapping each name to its Solution, or to None if it could not be solved.
+    """
+    with multiprocessing.Pool(processes) as pool:
+        return dict(pool.imap_unordered(_solve_level, [(name, max_ticks) for name in level_names]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the fastest death-free route through each level.")
+    parser.add_argument("levels", nargs="*", default=LEVELS, help="names of the levels to solve")
+    parser.add_argument("--max-ticks", type=int, default=MAX_TICKS, help="longest route to look for")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    solutions = solve_levels(args.levels, args.max_ticks, args.processes)
+
+    unsolved = False
+    for level_name in args.levels:
+        solution = solutions[level_name]
+        if solution is None:
+            print("{}: no death-free route within {} ticks".format(level_name, args.max_ticks))
+            unsolved = True
+        else:
+            print("{}: par {} ticks ({:.2f} s)".format(level_name, solution.ticks, solution.ticks / float(FPS)))
+
+    return 1 if unsolved else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
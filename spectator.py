@@ -0,0 +1,485 @@
+'''
+spectator.py
+Streams a live game to spectators over TCP. main() publishes the game's state
+after every tick to a SpectatorServer, which runs an asyncio event loop on its
+own thread and sends each connected client only what changed since the
+previous tick (with batch_ticks above 1, the deltas of several ticks are sent
+together, which cuts the number of sends). Only the newest published state
+waits for the server's thread, so a server that falls behind skips states
+rather than queueing them. Every client has its own bounded send buffer; a
+client that cannot keep up has ticks dropped and is sent a keyframe (the full
+state) once it drains, so a slow spectator never stalls the game or the
+other spectators.
+
+Messages are a 4-byte little-endian length followed by the payload:
+    keyframe: b"K", level index (u16), tick (i64), deaths (i64),
+              player x, y (i32), number of enemies (u32), then every enemy's x, y (i32)
+    delta:    b"D", tick (i64), flags (u8), then
+              player x, y (i32)                        if flags & PLAYER_MOVED
+              deaths (i64)                             if flags & DEATHS_CHANGED
+              number of changed enemies (u32), then each one's index (u32) and x, y (i32)
+A client's first message is always a keyframe, and so is the first message
+after a new Level starts.
+
+Usage:
+    python worlds_hardest_game.py --spectate 8765     # run the game and serve it
+    python spectator.py watch 127.0.0.1 8765          # stand-in spectator client
+    python spectator.py loadtest --clients 1000       # 1,000 loopback spectators
+'''
+
+import argparse
+import array
+import asyncio
+import collections
+import multiprocessing
+import struct
+import sys
+import threading
+import time
+
+DEFAULT_PORT = 8765
+
+KEYFRAME = b"K"
+DELTA = b"D"
+
+PLAYER_MOVED = 1
+DEATHS_CHANGED = 2
+
+# A client's send buffer may hold this many bytes before ticks are dropped for it.
+CLIENT_BUFFER_BYTES = 64 * 1024
+
+# Number of ticks whose deltas are sent to clients together by default.
+# Spectators follow every tick unless a larger batch is asked for.
+DEFAULT_BATCH_TICKS = 1
+
+_LENGTH = struct.Struct("<I")
+_KEYFRAME_HEADER = struct.Struct("<cHqqiiI")
+_DELTA_HEADER = struct.Struct("<cqB")
+_POSITION = struct.Struct("<ii")
+_DEATHS = struct.Struct("<q")
+_COUNT = struct.Struct("<I")
+_CHANGED_ENEMY = struct.Struct("<Iii")
+
+# The state of the game after one tick. enemies holds the x and y coordinates
+# of every EnemyBlock, one after another.
+SpectatorState = collections.namedtuple(
+    "SpectatorState", ["level_index", "tick", "deaths", "player_x", "player_y", "enemies"])
+
+def capture_state(game):
+    """ Returns the SpectatorState of a worlds_hardest_game.Game that is being played """
+    level = game.current_level
+    physics = level.enemy_physics
+    if physics is not None:
+        # Read straight from the enemy_physics, which is the only copy of the
+        # enemies of compact Levels (they have no sprites).
+        enemies = [coordinate for position in zip(physics.x.tolist(), physics.y.tolist()) for coordinate in position]
+    else:
+        enemies = []
+        for enemy_block in level.enemy_block_list:
+            enemies.append(enemy_block.rect.x)
+            enemies.append(enemy_block.rect.y)
+    return SpectatorState(game.current_level_index, level.ticks, level.player.deaths,
+                          level.player.rect.x, level.player.rect.y, enemies)
+
+def encode_keyframe(state):
+    """ Returns a keyframe message holding the full SpectatorState """
+    payload = (_KEYFRAME_HEADER.pack(KEYFRAME, state.level_index, state.tick, state.deaths,
+                                     state.player_x, state.player_y, len(state.enemies) // 2)
+               + array.array("i", state.enemies).tobytes())
+    return _LENGTH.pack(len(payload)) + payload
+
+def encode_delta(previous, state):
+    """
+    Returns a delta message that turns the previous SpectatorState into the
+    specified one. Both must be from the same Level.
+    """
+    flags = 0
+    parts = [None]
+    if (state.player_x, state.player_y) != (previous.player_x, previous.player_y):
+        flags |= PLAYER_MOVED
+        parts.append(_POSITION.pack(state.player_x, state.player_y))
+    if state.deaths != previous.deaths:
+        flags |= DEATHS_CHANGED
+        parts.append(_DEATHS.pack(state.deaths))
+    parts[0] = _DELTA_HEADER.pack(DELTA, state.tick, flags)
+
+    changed = []
+    old = previous.enemies
+    new = state.enemies
+    for i in range(0, len(new), 2):
+        if new[i] != old[i] or new[i + 1] != old[i + 1]:
+            changed.append(_CHANGED_ENEMY.pack(i // 2, new[i], new[i + 1]))
+    parts.append(_COUNT.pack(len(changed)))
+    parts.extend(changed)
+
+    payload = b"".join(parts)
+    return _LENGTH.pack(len(payload)) + payload
+
+class SpectatorView(object):
+    """ A spectator's copy of the game's state, kept up to date from messages """
+    def __init__(self):
+        self.state = None
+        self.keyframes = 0
+        self.deltas = 0
+
+    def apply(self, payload):
+        """ Applies one message payload (without its length prefix) """
+        if payload[:1] == KEYFRAME:
+            _, level_index, tick, deaths, player_x, player_y, num_enemies = _KEYFRAME_HEADER.unpack_from(payload)
+            enemies = array.array("i")
+            enemies.frombytes(payload[_KEYFRAME_HEADER.size:_KEYFRAME_HEADER.size + 8 * num_enemies])
+            self.state = SpectatorState(level_index, tick, deaths, player_x, player_y, enemies.tolist())
+            self.keyframes += 1
+            return
+
+        if self.state is None:
+            raise ValueError("received a delta before the first keyframe")
+        _, tick, flags = _DELTA_HEADER.unpack_from(payload)
+        offset = _DELTA_HEADER.size
+        player_x, player_y, deaths = self.state.player_x, self.state.player_y, self.state.deaths
+        if flags & PLAYER_MOVED:
+            player_x, player_y = _POSITION.unpack_from(payload, offset)
+            offset += _POSITION.size
+        if flags & DEATHS_CHANGED:
+            deaths, = _DEATHS.unpack_from(payload, offset)
+            offset += _DEATHS.size
+        num_changed, = _COUNT.unpack_from(payload, offset)
+        offset += _COUNT.size
+        enemies = self.state.enemies
+        for index, x, y in _CHANGED_ENEMY.iter_unpack(payload[offset:offset + num_changed * _CHANGED_ENEMY.size]):
+            enemies[2 * index] = x
+            enemies[2 * index + 1] = y
+        self.state = SpectatorState(self.state.level_index, tick, deaths, player_x, player_y, enemies)
+        self.deltas += 1
+
+class MessageReader(object):
+    """ Splits a byte stream into message payloads """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """ Adds received data and returns the payloads of the messages it completed """
+        self.buffer += data
+        payloads = []
+        offset = 0
+        while len(self.buffer) - offset >= _LENGTH.size:
+            length, = _LENGTH.unpack_from(self.buffer, offset)
+            if len(self.buffer) - offset - _LENGTH.size < length:
+                break
+            start = offset + _LENGTH.size
+            payloads.append(bytes(self.buffer[start:start + length]))
+            offset = start + length
+        del self.buffer[:offset]
+        return payloads
+
+class _SpectatorProtocol(asyncio.Protocol):
+    """ The server's end of one spectator's connection """
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        # True while the client's send buffer is full
+        self.paused = False
+        # True if the client has missed a message and must be sent a keyframe
+        self.needs_keyframe = True
+        self.dropped_ticks = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=CLIENT_BUFFER_BYTES)
+        self.server.clients.add(self)
+
+    def connection_lost(self, exc):
+        self.server.clients.discard(self)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+    def data_received(self, data):
+        # Spectators have nothing to say.
+        pass
+
+class SpectatorServer(object):
+    """
+    Serves the states published by the game loop to every connected spectator.
+    The server's event loop runs on its own thread; publish() only hands the
+    state over to it, so the game loop never waits for the network.
+    """
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, batch_ticks=DEFAULT_BATCH_TICKS):
+        """
+        Serves on the specified host and port (0 picks a free port). Messages
+        are sent every batch_ticks ticks, each send carrying the deltas of
+        all of the ticks since the last one: sending less often costs less
+        CPU time per spectator, at the price of batch_ticks / FPS seconds of
+        extra latency.
+        """
+        self.host = host
+        self.port = port
+        self.batch_ticks = batch_ticks
+        self.clients = set()
+        self.loop = None
+        self.thread = None
+        self.server = None
+
+        # The last state published
+        self.state = None
+
+        # Deltas of the ticks since the last send. If a new Level started
+        # since then, everyone is sent a keyframe instead, so this is None.
+        self.pending = []
+        self.pending_ticks = 0
+
+        # The newest state published by the game loop that the server's thread
+        # has not taken yet, and the number of ticks that it stands for. A
+        # callback to take it is scheduled only when the slot is empty.
+        self.lock = threading.Lock()
+        self.latest = None
+        self.latest_ticks = 0
+
+        # Total number of sends to clients and of ticks dropped for slow clients
+        self.messages_sent = 0
+        self.ticks_dropped = 0
+
+    def start(self):
+        """ Starts serving on a background thread. Returns the port that is being listened on. """
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(
+                self.loop.create_server(lambda: _SpectatorProtocol(self), self.host, self.port, backlog=1024))
+            self.port = self.server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, name="spectator-server", daemon=True)
+        self.thread.start()
+        started.wait()
+        return self.port
+
+    def stop(self):
+        """ Disconnects every spectator and stops the server """
+        def close():
+            for client in list(self.clients):
+                client.transport.close()
+            self.loop.stop()
+        self.loop.call_soon_threadsafe(close)
+        self.thread.join()
+
+    def publish(self, game):
+        """ Sends the state of the game (a worlds_hardest_game.Game) after a tick to every spectator """
+        self.publish_state(capture_state(game))
+
+    def publish_state(self, state):
+        """
+        Sends a SpectatorState to every spectator. If the server's thread has
+        not taken the previous state yet, the new one replaces it, and the
+        spectators are sent the changes of both ticks at once.
+        """
+        with self.lock:
+            scheduled = self.latest is not None
+            self.latest = state
+            self.latest_ticks += 1
+        if not scheduled:
+            self.loop.call_soon_threadsafe(self._take_latest)
+
+    def _take_latest(self):
+        """ Runs on the server's thread: broadcasts the newest published state """
+        with self.lock:
+            state, ticks = self.latest, self.latest_ticks
+            self.latest = None
+            self.latest_ticks = 0
+        self._broadcast(state, ticks)
+
+    def _broadcast(self, state, ticks=1):
+        """
+        Runs on the server's thread. Every batch_ticks ticks, sends every
+        client the deltas since the last send, or a keyframe if it needs one.
+        ticks is the number of ticks since the previous state.
+        """
+        previous = self.state
+        self.state = state
+
+        new_level = (previous is None or previous.level_index != state.level_index
+                     or len(previous.enemies) != len(state.enemies))
+        if new_level:
+            self.pending = None
+        elif self.pending is not None:
+            self.pending.append(encode_delta(previous, state))
+
+        self.pending_ticks += ticks
+        if self.pending_ticks < self.batch_ticks:
+            return
+
+        deltas = None if self.pending is None else b"".join(self.pending)
+        keyframe = None
+        for client in self.clients:
+            if client.paused:
+                client.needs_keyframe = True
+                client.dropped_ticks += self.pending_ticks
+                self.ticks_dropped += self.pending_ticks
+                continue
+            if client.needs_keyframe or deltas is None:
+                if keyframe is None:
+                    keyframe = encode_keyframe(state)
+                client.transport.write(keyframe)
+                client.needs_keyframe = False
+            else:
+                client.transport.write(deltas)
+            self.messages_sent += 1
+
+        self.pending = []
+        self.pending_ticks = 0
+
+class _ClientProtocol(asyncio.Protocol):
+    """ A stand-in spectator. It decodes every message if verify is True and only counts them otherwise. """
+    def __init__(self, verify):
+        self.verify = verify
+        self.reader = MessageReader()
+        self.view = SpectatorView()
+        self.messages = 0
+        self.bytes = 0
+        self.closed = None
+
+    def connection_made(self, transport):
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def data_received(self, data):
+        self.bytes += len(data)
+        payloads = self.reader.feed(data)
+        self.messages += len(payloads)
+        if self.verify:
+            for payload in payloads:
+                self.view.apply(payload)
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+async def _connect_clients(host, port, num_clients, num_verified):
+    loop = asyncio.get_running_loop()
+    clients = []
+    for i in range(num_clients):
+        _, protocol = await loop.create_connection(lambda: _ClientProtocol(i < num_verified), host, port)
+        clients.append(protocol)
+    return clients
+
+def watch(host, port):
+    """ Connects one spectator and prints the game's state once a second until the server closes """
+    async def run():
+        clients = await _connect_clients(host, port, 1, 1)
+        client = clients[0]
+        while not client.closed.done():
+            await asyncio.wait([client.closed], timeout=1.0)
+            state = client.view.state
+            if state is not None:
+                print("level {} tick {} deaths {} player ({}, {}) - {} keyframes, {} deltas, {} bytes".format(
+                    state.level_index + 1, state.tick, state.deaths, state.player_x, state.player_y,
+                    client.view.keyframes, client.view.deltas, client.bytes))
+    asyncio.run(run())
+
+def _client_process(host, port, num_clients, num_verified, ready, results):
+    """ Runs in a child process during the load test: connects clients and reports what they received """
+    async def run():
+        clients = await _connect_clients(host, port, num_clients, num_verified)
+        ready.set()
+        await asyncio.gather(*[client.closed for client in clients])
+        results.put([(client.messages, client.bytes, client.view.state) for client in clients])
+    asyncio.run(run())
+
+def load_test(num_clients, seconds, processes, batch_ticks=DEFAULT_BATCH_TICKS):
+    """
+    Plays Level_04 with no input at 60 ticks per second, serving it to
+    num_clients loopback spectators spread over several client processes,
+    and prints how much CPU time the server thread used.
+    """
+    import worlds_hardest_game
+
+    server = SpectatorServer(port=0, batch_ticks=batch_ticks)
+    port = server.start()
+
+    context = multiprocessing.get_context("spawn")
+    ready_events = []
+    results = context.Queue()
+    workers = []
+    for i in range(processes):
+        share = num_clients // processes + (1 if i < num_clients % processes else 0)
+        ready = context.Event()
+        worker = context.Process(target=_client_process, args=("127.0.0.1", port, share, 1, ready, results))
+        worker.start()
+        workers.append(worker)
+        ready_events.append(ready)
+    for ready in ready_events:
+        ready.wait()
+
+    # Measure the CPU time of the server's thread from inside it.
+    def thread_time():
+        result = threading.Event()
+        holder = []
+        server.loop.call_soon_threadsafe(lambda: (holder.append(time.thread_time()), result.set()))
+        result.wait()
+        return holder[0]
+
+    game = worlds_hardest_game.Game([worlds_hardest_game.Level_04])
+    start_cpu = thread_time()
+    start = time.perf_counter()
+    ticks = 0
+    while time.perf_counter() - start < seconds:
+        game.tick(0)
+        server.publish(game)
+        ticks += 1
+        # Keep to 60 ticks per second.
+        delay = start + ticks / float(worlds_hardest_game.FPS) - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    elapsed = time.perf_counter() - start
+    server_cpu = thread_time() - start_cpu
+    game.close()
+    # The last state published is sent before the server stops.
+    server.stop()
+    final_state = server.state
+
+    received = []
+    for _ in workers:
+        received.extend(results.get())
+    for worker in workers:
+        worker.join()
+
+    verified = [state for _, _, state in received if state is not None]
+    print("{} spectators, {} ticks in {:.1f} s ({:.1f} ticks/s)".format(
+        len(received), ticks, elapsed, ticks / elapsed))
+    print("server thread CPU: {:.1%} of one core".format(server_cpu / elapsed))
+    print("sends: {}, ticks dropped for slow spectators: {}".format(server.messages_sent, server.ticks_dropped))
+    print("messages received per spectator: min {}, max {}; {:.0f} bytes/s each on average".format(
+        min(messages for messages, _, _ in received), max(messages for messages, _, _ in received),
+        sum(num_bytes for _, num_bytes, _ in received) / float(len(received)) / elapsed))
+    print("verified spectators in sync with the game: {} of {}".format(
+        sum(state == final_state for state in verified), len(verified)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Spectator client and load test for the spectator server.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    watch_parser = subparsers.add_parser("watch", help="watch a game served with worlds_hardest_game.py --spectate")
+    watch_parser.add_argument("host")
+    watch_parser.add_argument("port", type=int)
+    load_parser = subparsers.add_parser("loadtest", help="serve a game to many loopback spectators")
+    load_parser.add_argument("--clients", type=int, default=1000)
+    load_parser.add_argument("--seconds", type=float, default=10.0)
+    load_parser.add_argument("--processes", type=int, default=4, help="number of client processes")
+    load_parser.add_argument("--batch-ticks", type=int, default=DEFAULT_BATCH_TICKS, help="ticks of deltas sent together")
+    args = parser.parse_args()
+
+    if args.command == "watch":
+        watch(args.host, args.port)
+    else:
+        load_test(args.clients, args.seconds, args.processes, args.batch_ticks)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+'''
+telemetry.py
+Opt-in telemetry of where players go and where they die. While the game runs
+with --telemetry DIR, every tick that a Level is updated on is logged to a
+session file in DIR as a fixed-size binary record: the Level's index and tick
+count, the Player's rect, and whether the Player died on that tick. The
+session file is a ring buffer that is memory-mapped for the whole session,
+so writing a record only packs it into memory with struct.pack_into(): no
+bytes objects are built and no system calls are made, and the operating
+system writes the pages back to the file in the background (even if the game
+crashes). Once the ring is full, the oldest records are overwritten.
+
+The aggregator reduces any number of session files into per-Level NumPy
+heatmaps, one of deaths and one of occupancy (ticks spent in each cell),
+streaming each file's records in blocks straight from the mapped file and
+spreading the files across a pool of worker processes.
+
+File format (all integers little-endian):
+    header:  b"WHGT", version (u16), record size (u16), capacity in records
+             (u32), 4 bytes of padding, number of records ever written (u64)
+    records: capacity records, each: Level tick (u32), x (i32), y (i32),
+             width (u16), height (u16), Level index (u8), flags (u8),
+             2 bytes of padding
+Record number n is stored in slot n % capacity.
+
+Run this file to aggregate a directory of session logs:
+    python telemetry.py telemetry/ --output heatmaps.npz --images heatmaps/
+'''
+
+import argparse
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+MAGIC = b"WHGT"
+VERSION = 1
+
+HEADER = struct.Struct("<4sHHIxxxxQ")
+RECORD = struct.Struct("<IiiHHBBxx")
+
+# Offset of the header's count of records written, which is updated after
+# every record
+_WRITTEN = struct.Struct("<Q")
+WRITTEN_OFFSET = HEADER.size - _WRITTEN.size
+
+# Bits of a record's flags
+DEATH = 1           # the Player was hit by an enemy on this tick
+
+# Records that a session file holds before it wraps around (about 4.5 hours
+# of play at 60 ticks per second, in 20 MB)
+DEFAULT_CAPACITY = 1 << 20
+
+# The layout of a record as a NumPy structured dtype
+RECORD_DTYPE = np.dtype({"names": ["tick", "x", "y", "width", "height", "level_index", "flags"],
+                         "formats": ["<u4", "<i4", "<i4", "<u2", "<u2", "u1", "u1"],
+                         "offsets": [0, 4, 8, 12, 14, 16, 17],
+                         "itemsize": RECORD.size})
+
+# Width and height of a heatmap cell, in pixels
+HEATMAP_CELL_SIZE = 10
+
+# Number of records that the aggregator reduces at once
+BLOCK_RECORDS = 1 << 18
+
+# Number of session files that a worker aggregates at once
+FILES_PER_BATCH = 64
+
+class TelemetryError(Exception):
+    """ Raised when a telemetry file is malformed """
+    pass
+
+class TelemetryLog(object):
+    """
+    Writes records to a memory-mapped ring buffer file. log() is called once
+    per tick, so it does as little as possible: it packs one record and the
+    count of records into the mapped memory and nothing else.
+    """
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        """ Creates (or overwrites) the session file at path, holding up to capacity records """
+        self.path = path
+        self.capacity = capacity
+        self.file = open(path, "w+b")
+        self.file.truncate(HEADER.size + capacity * RECORD.size)
+        self.mmap = mmap.mmap(self.file.fileno(), 0)
+        HEADER.pack_into(self.mmap, 0, MAGIC, VERSION, RECORD.size, capacity, 0)
+
+        # Number of records written, and the offset of the slot that the next
+        # one goes in
+        self.written = 0
+        self.offset = HEADER.size
+        self.end = HEADER.size + capacity * RECORD.size
+
+    def log(self, level_index, level):
+        """ Records the state of the Player of the specified Level after a tick """
+        player = level.player
+        rect = player.rect
+        # Player.update() sets ticks_since_hit to 0 on the tick that the Player is hit.
+        RECORD.pack_into(self.mmap, self.offset, level.ticks, rect.x, rect.y, rect.width, rect.height, level_index,
+                         DEATH if player.hit_by_enemy and player.ticks_since_hit == 0 else 0)
+        self.written += 1
+        _WRITTEN.pack_into(self.mmap, WRITTEN_OFFSET, self.written)
+
+        self.offset += RECORD.size
+        if self.offset == self.end:
+            self.offset = HEADER.size
+
+    def close(self):
+        """ Writes the file back to disk and closes it """
+        self.mmap.flush()
+        self.mmap.close()
+        self.file.close()
+
+def open_session_log(directory, capacity=DEFAULT_CAPACITY):
+    """ Returns a TelemetryLog writing to a new session file in the specified directory """
+    os.makedirs(directory, exist_ok=True)
+    name = "session-{}-{}".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+    # Sessions started by the same process within a second are numbered.
+    path = os.path.join(directory, name + ".whgt")
+    number = 1
+    while os.path.exists(path):
+        number += 1
+        path = os.path.join(directory, "{}-{}.whgt".format(name, number))
+    return TelemetryLog(path, capacity)
+
+def read_records(path):
+    """
+    Yields the valid records of a session file, in slot order, as
+    read-only RECORD_DTYPE arrays of up to BLOCK_RECORDS records that view
+    the mapped file. Raises TelemetryError if the file is malformed.
+    """
+    with open(path, "rb") as log_file:
+        header = log_file.read(HEADER.size)
+        file_size = os.fstat(log_file.fileno()).st_size
+    if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+        raise TelemetryError("not a telemetry file")
+    magic, version, record_size, capacity, written = HEADER.unpack(header)
+    if version != VERSION or record_size != RECORD.size:
+        raise TelemetryError("unsupported telemetry version {}".format(version))
+    if file_size < HEADER.size + capacity * RECORD.size:
+        raise TelemetryError("telemetry file is truncated")
+
+    num_records = min(written, capacity)
+    if num_records == 0:
+        return
+    # The heatmaps do not depend on the order of the records, so the ring is
+    # read in slot order rather than from its oldest record.
+    records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=HEADER.size, shape=(num_records,))
+    for start in range(0, num_records, BLOCK_RECORDS):
+        yield records[start:start + BLOCK_RECORDS]
+
+class Heatmaps(object):
+    """
+    Per-Level heatmaps of deaths and of occupancy. deaths[i] and
+    occupancy[i] are (rows, columns) arrays of counts for the Level with
+    index i, with one cell per HEATMAP_CELL_SIZE x HEATMAP_CELL_SIZE pixels
+    of the screen; the Player is counted in the cell under its centre.
+    """
+    def __init__(self, screen_width, screen_height, cell_size=HEATMAP_CELL_SIZE):
+        self.cell_size = cell_size
+        self.rows = -(-screen_height // cell_size)
+        self.columns = -(-screen_width // cell_size)
+        self.deaths = np.zeros((0, self.rows, self.columns), dtype=np.int64)
+        self.occupancy = np.zeros((0, self.rows, self.columns), dtype=np.int64)
+        self.num_records = 0
+
+    def _grow(self, num_levels):
+        """ Makes room for Levels with indices below num_levels """
+        if num_levels > len(self.deaths):
+            padding = ((0, num_levels - len(self.deaths)), (0, 0), (0, 0))
+            self.deaths = np.pad(self.deaths, padding)
+            self.occupancy = np.pad(self.occupancy, padding)
+
+    def add(self, records):
+        """ Counts an array of records """
+        if len(records) == 0:
+            return
+        num_levels = int(records["level_index"].max()) + 1
+        self._grow(num_levels)
+
+        column = (records["x"] + records["width"] // 2) // self.cell_size
+        row = (records["y"] + records["height"] // 2) // self.cell_size
+        np.clip(column, 0, self.columns - 1, out=column)
+        np.clip(row, 0, self.rows - 1, out=row)
+        cells = (records["level_index"].astype(np.int64) * self.rows + row) * self.columns + column
+
+        size = num_levels * self.rows * self.columns
+        shape = (num_levels, self.rows, self.columns)
+        self.occupancy[:num_levels] += np.bincount(cells, minlength=size).reshape(shape)
+        died = (records["flags"] & DEATH) != 0
+        self.deaths[:num_levels] += np.bincount(cells[died], minlength=size).reshape(shape)
+        self.num_records += len(records)
+
+    def merge(self, other):
+        """ Adds the counts of another Heatmaps with the same cells """
+        self._grow(len(other.deaths))
+        self.deaths[:len(other.deaths)] += other.deaths
+        self.occupancy[:len(other.occupancy)] += other.occupancy
+        self.num_records += other.num_records
+
+    def save(self, path):
+        """ Saves the heatmaps as a .npz file with deaths, occupancy and cell_size arrays """
+        np.savez_compressed(path, deaths=self.deaths, occupancy=self.occupancy, cell_size=self.cell_size)
+
+def aggregate_files(paths):
+    """
+    Aggregates the session files at the specified paths. Runs in a worker
+    process. Returns the Heatmaps and a list of (path, error message) pairs
+    for the files that could not be read.
+    """
+    from worlds_hardest_game import SCREEN_WIDTH, SCREEN_HEIGHT
+    heatmaps = Heatmaps(SCREEN_WIDTH, SCREEN_HEIGHT)
+    errors = []
+    for path in paths:
+        try:
+            for block in read_records(path):
+                heatmaps.add(block)
+        except (OSError, ValueError, TelemetryError) as error:
+            errors.append((path, str(error)))
+    return heatmaps, errors
+
+def aggregate_directory(directory, processes=None):
+    """
+    Aggregates every session file in the specified directory in a pool of
+    worker processes. Returns the merged Heatmaps and a list of (path, error
+    message) pairs for the files that could not be read.
+    """
+    from worlds_hardest_game import SCREEN_WIDTH, SCREEN_HEIGHT
+    paths = sorted(entry.path for entry in os.scandir(directory) if entry.is_file() and entry.name.endswith(".whgt"))
+    batches = [paths[i:i + FILES_PER_BATCH] for i in range(0, len(paths), FILES_PER_BATCH)]
+
+    heatmaps = Heatmaps(SCREEN_WIDTH, SCREEN_HEIGHT)
+    errors = []
+    with multiprocessing.Pool(processes) as pool:
+        for batch_heatmaps, batch_errors in pool.imap_unordered(aggregate_files, batches):
+            heatmaps.merge(batch_heatmaps)
+            errors.extend(batch_errors)
+    return heatmaps, errors
+
+def save_images(heatmaps, directory):
+    """
+    Saves a PNG of every Level's death heatmap drawn over the Level, with
+    cells shaded redder the more deaths they have
+    """
+    import pygame
+    import worlds_hardest_game
+
+    pygame.font.init()
+    os.makedirs(directory, exist_ok=True)
+    for level_index in range(min(len(heatmaps.deaths), len(worlds_hardest_game.LEVELS))):
+        deaths = heatmaps.deaths[level_index]
+        image = worlds_hardest_game.LEVELS[level_index]().get_background().copy()
+
+        # Each cell's opacity grows with the square root of its number of
+        # deaths, so that cells with few deaths still show up.
+        alpha = np.sqrt(deaths / max(int(deaths.max()), 1)) * 200
+        cells = np.zeros((heatmaps.columns, heatmaps.rows, 4), dtype=np.uint8)
+        cells[:, :, 0] = 255
+        cells[:, :, 3] = alpha.T.astype(np.uint8)
+        overlay = pygame.image.frombuffer(np.ascontiguousarray(cells.swapaxes(0, 1)).tobytes(),
+                                          (heatmaps.columns, heatmaps.rows), "RGBA")
+        overlay = pygame.transform.scale(overlay, (heatmaps.columns * heatmaps.cell_size,
+                                                   heatmaps.rows * heatmaps.cell_size))
+        image.blit(overlay, (0, 0))
+        pygame.image.save(image, os.path.join(directory, "level_{:02d}_deaths.png".format(level_index + 1)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate telemetry session logs into per-Level heatmaps.")
+    parser.add_argument("directory", help="directory of session logs written with worlds_hardest_game.py --telemetry")
+    parser.add_argument("--output", default="heatmaps.npz", help="NumPy .npz file to write the heatmaps to")
+    parser.add_argument("--images", metavar="DIR", help="also save each Level's death heatmap as a PNG in DIR")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    heatmaps, errors = aggregate_directory(args.directory, args.processes)
+    for path, error in errors:
+        print("{}: skipped ({})".format(path, error), file=sys.stderr)
+    heatmaps.save(args.output)
+    if args.images is not None:
+        save_images(heatmaps, args.images)
+
+    print("aggregated {} records in {:.1f} s: {}".format(
+        heatmaps.num_records, time.perf_counter() - start,
+        ", ".join("Level {}: {} deaths".format(i + 1, int(deaths.sum())) for i, deaths in enumerate(heatmaps.deaths))),
+        file=sys.stderr)
+    return 0 if not errors else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,11 @@
+'''
+conftest.py
+Makes the game's modules importable from the tests and runs pygame without a
+display.
+'''
+
+import os
+import sys
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
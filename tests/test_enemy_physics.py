@@ -0,0 +1,67 @@
+'''
+test_enemy_physics.py
+Checks that every way of moving the enemies plays each built-in Level the same
+way as the EnemyBlock sprites updating themselves.
+'''
+
+import pytest
+
+import worlds_hardest_game
+from worlds_hardest_game import UP, DOWN, LEFT, RIGHT
+from enemy_physics import VectorizedEnemyPhysics
+from occupancy import NoCycleError, PeriodicEnemyPhysics
+
+TICKS = 600
+
+# Longest enemy cycle looked for when building occupancy tables
+MAX_PERIOD_TICKS = 2000
+
+# Held for 25 ticks each, in turn, so that the Player wanders about and dies
+INPUTS = [RIGHT, RIGHT | DOWN, UP, RIGHT | UP, LEFT, DOWN, 0, RIGHT]
+
+def input_mask(tick):
+    return INPUTS[tick // 25 % len(INPUTS)]
+
+def sprites(level_class, tmp_path):
+    return level_class()
+
+def vectorized(level_class, tmp_path):
+    level = level_class()
+    level.enemy_physics = VectorizedEnemyPhysics(level)
+    return level
+
+def occupancy_table(level_class, tmp_path):
+    level = level_class()
+    try:
+        level.enemy_physics = PeriodicEnemyPhysics(level, str(tmp_path), MAX_PERIOD_TICKS)
+    except NoCycleError:
+        pytest.skip("the enemies of {} do not repeat".format(level_class.__name__))
+    return level
+
+def compact(level_class, tmp_path):
+    return level_class(compact=True)
+
+@pytest.mark.parametrize("level_class", worlds_hardest_game.LEVELS)
+@pytest.mark.parametrize("build_level", [vectorized, occupancy_table, compact])
+def test_enemy_physics_matches_the_sprites(level_class, build_level, tmp_path):
+    expected = sprites(level_class, tmp_path)
+    level = build_level(level_class, tmp_path)
+    for tick in range(TICKS):
+        for each in (expected, level):
+            each.player.apply_input(input_mask(tick))
+            each.update()
+        assert level.snapshot() == expected.snapshot(), "tick {}".format(tick)
+
+@pytest.mark.parametrize("level_class", worlds_hardest_game.LEVELS)
+def test_restoring_every_tick_matches_the_sprites(level_class):
+    expected = level_class()
+    level = level_class()
+    for tick in range(TICKS):
+        for each in (expected, level):
+            each.player.apply_input(input_mask(tick))
+            each.update()
+        # Carry on from a copy of the Level made from its snapshot.
+        copy = level_class()
+        copy.restore(level.snapshot())
+        level = copy
+        assert level.snapshot() == expected.snapshot(), "tick {}".format(tick)
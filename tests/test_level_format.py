@@ -0,0 +1,25 @@
+'''
+test_level_format.py
+Tests of loading and caching level files.
+'''
+
+import os
+
+import level_format
+from worlds_hardest_game import LEVEL_DIR
+
+LEVEL_PATH = os.path.join(LEVEL_DIR, "level_01.json")
+
+def test_load_level_caches_the_compiled_level(tmp_path):
+    level_data = level_format.load_level(LEVEL_PATH, str(tmp_path))
+    assert os.path.isfile(level_format.cache_path(LEVEL_PATH, str(tmp_path)))
+    assert level_format.load_level(LEVEL_PATH, str(tmp_path)) == level_data
+    assert [name for name in os.listdir(str(tmp_path / "levels")) if name.endswith(".tmp")] == []
+
+def test_load_level_without_a_usable_cache_dir(tmp_path):
+    # The cache directory is a file, so nothing can be cached in it.
+    cache_file = tmp_path / "cache"
+    cache_file.write_bytes(b"")
+    level_data = level_format.load_level(LEVEL_PATH, str(cache_file))
+    assert level_data == level_format.load_level(LEVEL_PATH, str(tmp_path))
+    assert cache_file.read_bytes() == b""
@@ -0,0 +1,27 @@
+'''
+test_replay.py
+Tests of recording and decoding replays.
+'''
+
+import pytest
+
+import replay
+from worlds_hardest_game import Game, RIGHT
+
+def test_recording_stops_at_the_longest_level_a_replay_holds(tmp_path, monkeypatch):
+    monkeypatch.setattr(replay, "MAX_LEVEL_TICKS", 50)
+    path = str(tmp_path / "run.whgr")
+    game = Game(recorder=replay.ReplayRecorder(path))
+    for _ in range(80):
+        game.tick(RIGHT)
+    game.close()
+
+    levels = replay.load(path)
+    assert [(level.level_index, level.completed, level.ticks) for level in levels] == [(0, False, 50)]
+    assert all(result.ok for result in replay.play(levels))
+
+def test_encode_rejects_levels_that_decode_would_reject(monkeypatch):
+    monkeypatch.setattr(replay, "MAX_LEVEL_TICKS", 50)
+    level = replay.LevelRecord(0, False, 51, 0, [0] * 51)
+    with pytest.raises(ValueError):
+        replay.encode([level])
@@ -0,0 +1,70 @@
+'''
+test_snapshots.py
+Tests of Level.snapshot() and Level.restore().
+'''
+
+import struct
+
+import pytest
+
+import worlds_hardest_game
+from worlds_hardest_game import SNAPSHOT_HEADER, DOWN, RIGHT
+from occupancy import PeriodicEnemyPhysics
+
+def play(level, ticks, input_mask=RIGHT | DOWN):
+    for _ in range(ticks):
+        level.player.apply_input(input_mask)
+        level.update()
+
+@pytest.mark.parametrize("level_class", worlds_hardest_game.LEVELS)
+def test_restore_reproduces_the_level(level_class):
+    level = level_class()
+    play(level, 200)
+    copy = level_class()
+    copy.restore(level.snapshot())
+    assert copy.snapshot() == level.snapshot()
+
+    # Both copies carry on the same way.
+    play(level, 100)
+    play(copy, 100)
+    assert copy.snapshot() == level.snapshot()
+
+def test_rejected_snapshot_leaves_the_level_unchanged(tmp_path):
+    level = worlds_hardest_game.Level_01()
+    level.enemy_physics = PeriodicEnemyPhysics(level, str(tmp_path))
+    play(level, 150)
+    before = level.snapshot()
+
+    # A snapshot whose first enemy is not where the occupancy table has it
+    other = worlds_hardest_game.Level_01()
+    play(other, 40, 0)
+    snapshot = bytearray(other.snapshot())
+    x, = struct.unpack_from("<i", snapshot, SNAPSHOT_HEADER.size)
+    struct.pack_into("<i", snapshot, SNAPSHOT_HEADER.size, x + 1)
+
+    with pytest.raises(ValueError):
+        level.restore(bytes(snapshot))
+    assert level.snapshot() == before
+
+    # The unmodified snapshot is accepted.
+    level.restore(other.snapshot())
+    assert level.snapshot() == other.snapshot()
+
+def test_unrestorable_enemy_physics_leaves_the_level_unchanged():
+    class UnrestorablePhysics(object):
+        def update(self):
+            pass
+
+        def collides(self, rect):
+            return False
+
+        def sync_sprites(self):
+            pass
+
+    level = worlds_hardest_game.Level_02()
+    play(level, 50)
+    level.enemy_physics = UnrestorablePhysics()
+    before = level.snapshot()
+    with pytest.raises(ValueError):
+        level.restore(worlds_hardest_game.Level_02().snapshot())
+    assert level.snapshot() == before
@@ -0,0 +1,28 @@
+'''
+test_solver.py
+Tests of the fastest-route solver.
+'''
+
+import level_format
+import solver
+from worlds_hardest_game import DataLevel, SCREEN_WIDTH, SCREEN_HEIGHT
+
+class OpenLevel(DataLevel):
+    """
+    A Level without walls around the edges of the screen. The Player spawns
+    on the left edge and the goal runs down the right edge, so a solver
+    that let the Player wrap around onto the previous row would reach the
+    goal in a couple of ticks.
+    """
+    def __init__(self, compact=False):
+        super(OpenLevel, self).__init__(level_format.compile_level({
+            "format": level_format.FORMAT_VERSION,
+            "goal": [SCREEN_WIDTH - 50, 0, 50, SCREEN_HEIGHT],
+            "spawn": [0, 0],
+            "enemies": [{"start": [300, 100], "velocity": [0, 2], "count": 4, "spacing": [50, 0]}],
+        }), compact)
+
+def test_solve_keeps_the_player_on_the_screen():
+    solution = solver.solve(OpenLevel, max_ticks=1000)
+    assert solution is not None
+    assert solver.verify(OpenLevel, solution)
@@ -0,0 +1,20 @@
+'''
+test_spectator.py
+Tests of the spectator message encoding.
+'''
+
+import spectator
+from spectator import SpectatorState
+
+def test_messages_hold_more_than_65535_enemies():
+    num_enemies = 70000
+    first = SpectatorState(0, 1, 0, 10, 20, list(range(2 * num_enemies)))
+    enemies = list(first.enemies)
+    enemies[-2:] = [-5, -6]
+    second = SpectatorState(0, 2, 1, 11, 20, enemies)
+
+    view = spectator.SpectatorView()
+    view.apply(spectator.encode_keyframe(first)[spectator._LENGTH.size:])
+    assert view.state == first
+    view.apply(spectator.encode_delta(first, second)[spectator._LENGTH.size:])
+    assert view.state == second
@@ -0,0 +1,222 @@
+'''
+trajectory.py
+Closed-form enemy trajectories. An EnemyBlock that does not bounce off other
+enemies moves back and forth along one axis between two walls, so its
+coordinate along that axis is a triangle wave of the tick number:
+
+    r = (phase + t) mod 2n
+    position = low + speed * (n - |n - r|)
+
+where low is the lowest position it reaches, n is the number of ticks it
+takes to cross from one end to the other, and phase is where in the cycle it
+starts. Its position at any tick can therefore be computed directly instead
+of by calling update() once per tick. BouncingEnemyBlocks also react to each
+other, so the states of Levels that contain them (or enemies whose motion
+does not fit a triangle wave, such as diagonal ones) are looked up in an
+occupancy table (see occupancy.py) if their motion repeats within a small
+one, and stepped otherwise.
+
+Usage:
+    level = Level_03()
+    level.seek(1000000)         # or: EnemyTrajectories(level).state(1000000)
+'''
+
+import collections
+
+import numpy as np
+
+import occupancy
+from enemy_physics import VectorizedEnemyPhysics
+
+# The triangle wave followed by one enemy along one axis (0 for x, 1 for y).
+# The other coordinate stays at fixed.
+TriangleWave = collections.namedtuple("TriangleWave", ["axis", "low", "speed", "half_period", "phase", "fixed"])
+
+def fit_triangle_wave(x, y, velocity_x, velocity_y):
+    """
+    Returns the TriangleWave followed by one enemy, given its state (position
+    and velocity arrays) at every tick of at least one full cycle starting at
+    tick 0, or None if its motion is not a triangle wave.
+    """
+    if np.all(velocity_y == 0):
+        axis, position, velocity, fixed = 0, x, velocity_x, y
+    elif np.all(velocity_x == 0):
+        axis, position, velocity, fixed = 1, y, velocity_y, x
+    else:
+        return None
+    if np.any(fixed != fixed[0]):
+        return None
+
+    speed = int(abs(velocity[0]))
+    if speed == 0:
+        return TriangleWave(axis, int(position[0]), 0, 1, 0, int(fixed[0]))
+
+    low = int(position.min())
+    high = int(position.max())
+    if (high - low) % speed != 0 or (int(position[0]) - low) % speed != 0:
+        return None
+    half_period = (high - low) // speed
+    if half_period == 0:
+        return None
+
+    start = (int(position[0]) - low) // speed
+    phase = start if velocity[0] > 0 else 2 * half_period - start
+    wave = TriangleWave(axis, low, speed, half_period, phase, int(fixed[0]))
+
+    # The wave must reproduce every recorded tick exactly.
+    wave_x, wave_y, wave_velocity_x, wave_velocity_y = evaluate([wave], np.arange(len(x)))
+    if not (np.array_equal(wave_x[:, 0], x) and np.array_equal(wave_y[:, 0], y)
+            and np.array_equal(wave_velocity_x[:, 0], velocity_x) and np.array_equal(wave_velocity_y[:, 0], velocity_y)):
+        return None
+    return wave
+
+def evaluate(waves, ticks):
+    """
+    Returns the x, y, x velocity and y velocity of enemies following the
+    specified TriangleWaves at the specified ticks, as four (ticks, enemies)
+    arrays.
+    """
+    ticks = np.asarray(ticks, dtype=np.int64).reshape(-1, 1)
+    axis = np.array([wave.axis for wave in waves], dtype=np.int64)
+    low = np.array([wave.low for wave in waves], dtype=np.int64)
+    speed = np.array([wave.speed for wave in waves], dtype=np.int64)
+    half_period = np.array([wave.half_period for wave in waves], dtype=np.int64)
+    phase = np.array([wave.phase for wave in waves], dtype=np.int64)
+    fixed = np.array([wave.fixed for wave in waves], dtype=np.int64)
+
+    r = (phase + ticks) % (2 * half_period)
+    position = low + speed * (half_period - np.abs(half_period - r))
+    # An enemy turns around on the tick it reaches either end of its range.
+    velocity = np.where(r < half_period, speed, -speed)
+
+    along_x = axis == 0
+    x = np.where(along_x, position, fixed)
+    y = np.where(along_x, fixed, position)
+    velocity_x = np.where(along_x, velocity, 0)
+    velocity_y = np.where(along_x, 0, velocity)
+    return x, y, velocity_x, velocity_y
+
+class EnemyTrajectories(object):
+    """
+    The state of every EnemyBlock of a Level at any tick, relative to the
+    tick the EnemyTrajectories was built at. If every enemy follows a
+    triangle wave, or the enemies' motion repeats within an occupancy table
+    of at most occupancy.MAX_GAME_TABLE_BYTES, state() takes the same time
+    for any tick; otherwise the sprites of a copy of the Level are stepped,
+    going back to the starting state to seek backwards.
+    """
+    def __init__(self, level):
+        """
+        Works out the trajectories of the EnemyBlocks of the specified Level
+        from their current state. Raises ValueError if an enemy overrides
+        update().
+        """
+        physics = VectorizedEnemyPhysics(level)
+        self.sprites = physics.sprites
+        self.initial_state = (physics.x.copy(), physics.y.copy(), physics.velocity_x.copy(), physics.velocity_y.copy())
+
+        # The TriangleWave of every enemy, or None if they do not all follow one
+        self.waves = None
+        if len(physics.bouncing) == 0:
+            self.waves = self._fit_waves(physics)
+
+        # The occupancy table of the enemies when there are no waves, or None
+        # if their motion does not repeat within a small enough one
+        self.table = None
+        if self.waves is None:
+            try:
+                loaded = occupancy.load_table(VectorizedEnemyPhysics(level),
+                                              max_bytes=occupancy.MAX_GAME_TABLE_BYTES)
+            except OSError:
+                # The cache directory cannot be written to.
+                loaded = None
+            if loaded is not None:
+                self.table, self.table_start, self.period = loaded
+
+        # A copy of the Level whose sprites are stepped when there is neither,
+        # which is quicker than a VectorizedEnemyPhysics for the few enemies of
+        # a Level; it is stepper_tick ticks past the starting state.
+        self.stepper = None
+        self.stepper_tick = 0
+        if self.waves is None and self.table is None:
+            self.stepper = level.clone()
+
+    def _fit_waves(self, physics):
+        """
+        Steps a copy of the enemies through one full cycle of the slowest one
+        and fits a TriangleWave to each. Returns None if any enemy does not
+        follow one.
+        """
+        if len(physics.sprites) == 0:
+            return []
+
+        # Enemies turn around within the bounds of the walls, so a cycle takes
+        # at most two crossings of those bounds.
+        extent = max(int((physics.wall_x + physics.wall_width).max(initial=0) - physics.wall_x.min(initial=0)),
+                     int((physics.wall_y + physics.wall_height).max(initial=0) - physics.wall_y.min(initial=0)))
+        speeds = np.maximum(np.abs(physics.velocity_x), np.abs(physics.velocity_y))
+        min_speed = int(speeds[speeds > 0].min(initial=1))
+        num_ticks = 2 * (extent // min_speed + 2) + 1
+
+        history = np.empty((4, num_ticks, len(physics.sprites)), dtype=np.int64)
+        for tick in range(num_ticks):
+            if tick > 0:
+                physics.update()
+            history[:, tick] = (physics.x, physics.y, physics.velocity_x, physics.velocity_y)
+
+        waves = []
+        for i in range(len(physics.sprites)):
+            wave = fit_triangle_wave(*history[:, :, i])
+            if wave is None:
+                return None
+            waves.append(wave)
+        return waves
+
+    def closed_form(self):
+        """ Returns True if state() computes states directly instead of stepping """
+        return self.stepper is None
+
+    def state(self, tick):
+        """
+        Returns four arrays holding every enemy's x, y, x velocity and y
+        velocity (in update order) tick ticks after the trajectories were built.
+        """
+        if self.waves is not None:
+            x, y, velocity_x, velocity_y = evaluate(self.waves, [tick])
+            return x[0], y[0], velocity_x[0], velocity_y[0]
+
+        if tick < 0:
+            raise ValueError("cannot seek to before the EnemyTrajectories were built")
+
+        if self.table is not None:
+            if tick >= self.table_start:
+                tick = self.table_start + (tick - self.table_start) % self.period
+            state = self.table[tick].astype(np.int64)
+            return (state[:, occupancy.X], state[:, occupancy.Y],
+                    state[:, occupancy.VELOCITY_X], state[:, occupancy.VELOCITY_Y])
+
+        stepper = self.stepper
+        enemy_blocks = stepper.enemy_block_list.sprites()
+        if tick < self.stepper_tick:
+            _move_sprites(enemy_blocks, self.initial_state)
+            stepper.enemy_index = None
+            self.stepper_tick = 0
+        update = stepper.enemy_block_list.update
+        for _ in range(tick - self.stepper_tick):
+            update()
+        self.stepper_tick = tick
+        state = np.array([(enemy_block.rect.x, enemy_block.rect.y, enemy_block.velocity_x, enemy_block.velocity_y)
+                          for enemy_block in enemy_blocks], dtype=np.int64).reshape(-1, 4)
+        return state[:, 0], state[:, 1], state[:, 2], state[:, 3]
+
+    def apply(self, tick):
+        """ Moves the enemies' sprites to their state at the specified tick """
+        _move_sprites(self.sprites, self.state(tick))
+
+def _move_sprites(sprites, state):
+    """ Sets the positions and velocities of the specified sprites from four arrays, as returned by state() """
+    for sprite, x, y, velocity_x, velocity_y in zip(sprites, *[array.tolist() for array in state]):
+        sprite.rect.x = x
+        sprite.rect.y = y
+        sprite.velocity_x = velocity_x
+        sprite.velocity_y = velocity_y
@@ -0,0 +1,249 @@
+'''
+vector_env.py
+A batched environment that steps many independent copies of a Level in
+lockstep. The state of every copy lives in contiguous NumPy arrays (one entry
+per copy) instead of Level objects and sprite Groups, and each step applies
+the rules of Level.update() to all of the copies at once.
+
+Enemies never react to the Player, so every copy's enemies are in the same
+state a given number of ticks after the copy was reset. The enemies are
+therefore simulated only once, into a shared timeline, and each copy looks up
+its enemies' positions by its own tick count.
+
+Usage:
+    env = VectorEnv(Level_02, 10000)
+    state = env.step(input_masks)   # input_masks: one UP/DOWN/LEFT/RIGHT bitmask per copy
+    state.reached_goal              # one flag per copy
+'''
+
+import collections
+
+import numpy as np
+
+from worlds_hardest_game import FPS, PLAYER_SPEED, UP, DOWN, LEFT, RIGHT
+from enemy_physics import VectorizedEnemyPhysics
+
+# Number of ticks added to the enemy timeline at a time
+TIMELINE_CHUNK_TICKS = 1024
+
+# The arrays returned by VectorEnv.step(). They are the environment's own
+# buffers, so they change on the next call to step() or reset().
+VectorEnvState = collections.namedtuple(
+    "VectorEnvState", ["player_x", "player_y", "hit_by_enemy", "reached_goal", "deaths"])
+
+def input_velocities(input_masks):
+    """
+    Returns the x and y velocities that Player.apply_input() gives for each of
+    the specified input bitmasks.
+    """
+    velocity_x = PLAYER_SPEED * (((input_masks & RIGHT) != 0).astype(np.int64) - ((input_masks & LEFT) != 0))
+    velocity_y = PLAYER_SPEED * (((input_masks & DOWN) != 0).astype(np.int64) - ((input_masks & UP) != 0))
+    return velocity_x, velocity_y
+
+class VectorEnv(object):
+    """
+    Steps num_envs copies of a Level subclass in lockstep. Each copy behaves
+    exactly like calling Level.step() on its own instance of the Level: once
+    a copy's Player reaches the goal, that copy stops updating until it is reset.
+    """
+    def __init__(self, level_class, num_envs):
+        """
+        Builds a single instance of level_class to read the Level's layout from,
+        then allocates the state of num_envs copies of it.
+        """
+        level = level_class()
+        self.num_envs = num_envs
+
+        # Steps the enemies of the Level that the layout was read from.
+        self.enemy_physics = VectorizedEnemyPhysics(level)
+
+        # enemy_x[t] and enemy_y[t] hold every enemy's position t ticks after a
+        # reset. Rows are added by extend_timeline() as copies need them.
+        num_enemies = len(self.enemy_physics.sprites)
+        self.enemy_x = np.empty((0, num_enemies), dtype=np.int32)
+        self.enemy_y = np.empty((0, num_enemies), dtype=np.int32)
+        self.timeline_length = 0
+        self.extend_timeline(1)
+
+        self.enemy_width = self.enemy_physics.width.astype(np.int32)
+        self.enemy_height = self.enemy_physics.height.astype(np.int32)
+
+        self.initial_player_x = level.player.init_pos[0]
+        self.initial_player_y = level.player.init_pos[1]
+        self.player_width = level.player.rect.width
+        self.player_height = level.player.rect.height
+
+        walls = level.wall_list.sprites()
+        self.wall_x = np.array([wall.rect.x for wall in walls], dtype=np.int64)
+        self.wall_y = np.array([wall.rect.y for wall in walls], dtype=np.int64)
+        self.wall_width = np.array([wall.rect.width for wall in walls], dtype=np.int64)
+        self.wall_height = np.array([wall.rect.height for wall in walls], dtype=np.int64)
+        self.goal_index = walls.index(level.goal)
+
+        # Number of ticks that each copy has been updated for since it was reset
+        self.ticks = np.empty(num_envs, dtype=np.int64)
+
+        self.player_x = np.empty(num_envs, dtype=np.int64)
+        self.player_y = np.empty(num_envs, dtype=np.int64)
+        self.hit_by_enemy = np.empty(num_envs, dtype=bool)
+        self.ticks_since_hit = np.empty(num_envs, dtype=np.int64)
+        self.reached_goal = np.empty(num_envs, dtype=bool)
+        self.deaths = np.empty(num_envs, dtype=np.int64)
+
+        self.reset()
+
+    def extend_timeline(self, length):
+        """ Simulates the enemies until the timeline holds at least length ticks """
+        if length <= self.timeline_length:
+            return
+
+        capacity = len(self.enemy_x)
+        if length > capacity:
+            capacity = max(length, capacity + TIMELINE_CHUNK_TICKS)
+            self.enemy_x = np.resize(self.enemy_x, (capacity, self.enemy_x.shape[1]))
+            self.enemy_y = np.resize(self.enemy_y, (capacity, self.enemy_y.shape[1]))
+
+        physics = self.enemy_physics
+        for tick in range(self.timeline_length, length):
+            if tick > 0:
+                physics.update()
+            self.enemy_x[tick] = physics.x
+            self.enemy_y[tick] = physics.y
+        self.timeline_length = length
+
+    def reset(self, envs=None):
+        """
+        Puts the specified copies (an index array or boolean mask; all of them
+        by default) back into the Level's initial state, including setting
+        their death counts back to 0. Returns the current VectorEnvState.
+        """
+        if envs is None:
+            envs = slice(None)
+
+        self.ticks[envs] = 0
+
+        self.player_x[envs] = self.initial_player_x
+        self.player_y[envs] = self.initial_player_y
+        self.hit_by_enemy[envs] = False
+        self.ticks_since_hit[envs] = FPS + 1
+        self.reached_goal[envs] = False
+        self.deaths[envs] = 0
+
+        return self.state()
+
+    def enemy_positions(self):
+        """
+        Returns two (copies, enemies) arrays holding the x and y coordinates of
+        every copy's enemies.
+        """
+        return self.enemy_x[self.ticks], self.enemy_y[self.ticks]
+
+    def state(self):
+        """ Returns the current VectorEnvState """
+        return VectorEnvState(self.player_x, self.player_y, self.hit_by_enemy, self.reached_goal, self.deaths)
+
+    def step(self, input_masks):
+        """
+        Advances every copy whose Player has not reached the goal by one tick.
+        input_masks is an array with one input bitmask (any combination of UP,
+        DOWN, LEFT, and RIGHT) per copy. Returns the current VectorEnvState.
+        """
+        input_masks = np.asarray(input_masks)
+        active = ~self.reached_goal
+        if active.all():
+            envs = slice(None)
+        else:
+            envs = np.flatnonzero(active)
+            input_masks = input_masks[envs]
+
+        self.ticks[envs] += 1
+        self.extend_timeline(int(self.ticks.max()) + 1)
+        self._update_players(envs, input_masks)
+
+        return self.state()
+
+    def _update_players(self, envs, input_masks):
+        """ Moves the Players of the specified copies, like Player.update() """
+        x = self.player_x[envs]
+        y = self.player_y[envs]
+        hit_by_enemy = self.hit_by_enemy[envs]
+        ticks_since_hit = self.ticks_since_hit[envs]
+
+        # Players that were hit by an enemy cannot move for 1 second, after
+        # which they go back to the start of the Level.
+        stunned = hit_by_enemy & (ticks_since_hit <= FPS * 2)
+        ticks_since_hit += stunned
+        recovered = stunned & (ticks_since_hit > FPS)
+        hit_by_enemy &= ~recovered
+        x[recovered] = self.initial_player_x
+        y[recovered] = self.initial_player_y
+
+        moving = ~stunned
+        velocity_x, velocity_y = input_velocities(input_masks)
+        # The enemies are always updated before the Player, so the Player is
+        # checked against their positions at the end of this tick.
+        enemies_hit = self.enemies_hit(x + velocity_x, y + velocity_y, self.ticks[envs])
+        new_x, new_y, at_goal = self.move_players(x, y, velocity_x, velocity_y)
+
+        newly_hit = moving & enemies_hit
+        hit_by_enemy |= newly_hit
+        ticks_since_hit[newly_hit] = 0
+
+        self.player_x[envs] = np.where(moving, new_x, x)
+        self.player_y[envs] = np.where(moving, new_y, y)
+        self.hit_by_enemy[envs] = hit_by_enemy
+        self.ticks_since_hit[envs] = ticks_since_hit
+        self.reached_goal[envs] |= moving & at_goal
+        self.deaths[envs] += newly_hit
+
+    def enemies_hit(self, x, y, ticks):
+        """
+        Returns whether Players at positions (x, y) touch an enemy, where ticks
+        is the number of ticks since the reset for each Player.
+        """
+        enemy_x = self.enemy_x[ticks]
+        enemy_y = self.enemy_y[ticks]
+        return ((enemy_x < (x + self.player_width)[:, None]) & (x[:, None] < enemy_x + self.enemy_width)
+                & (enemy_y < (y + self.player_height)[:, None]) & (y[:, None] < enemy_y + self.enemy_height)).any(axis=-1)
+
+    def move_players(self, x, y, velocity_x, velocity_y):
+        """
+        Applies the wall rules of Player.update() to Players (that are not
+        stunned) at positions (x, y) moving with the specified velocities.
+        Returns three arrays: the Players' new x and y coordinates, and whether
+        each Player reached the goal.
+        """
+        width = self.player_width
+        height = self.player_height
+
+        x = x + velocity_x
+        y = y + velocity_y
+
+        walls_hit = ((self.wall_x < (x + width)[:, None]) & (x[:, None] < self.wall_x + self.wall_width)
+                     & (self.wall_y < (y + height)[:, None]) & (y[:, None] < self.wall_y + self.wall_height))
+        at_goal = walls_hit[:, self.goal_index]
+
+        # Push Players that walked into a single wall back out of it.
+        num_walls_hit = walls_hit.sum(axis=-1)
+        wall = walls_hit.argmax(axis=-1)
+        wall_x = self.wall_x[wall]
+        wall_y = self.wall_y[wall]
+        wall_right = wall_x + self.wall_width[wall]
+        wall_bottom = wall_y + self.wall_height[wall]
+        one_wall = (num_walls_hit == 1) & ~at_goal
+
+        push_left = one_wall & (velocity_x > 0) & (wall_x <= x + width) & (x + width <= wall_x + velocity_x)
+        push_right = (one_wall & ~push_left & (velocity_x < 0)
+                      & (wall_right + velocity_x <= x) & (x <= wall_right))
+        push_up = one_wall & (velocity_y > 0) & (wall_y <= y + height) & (y + height <= wall_y + velocity_y)
+        push_down = (one_wall & ~push_up & (velocity_y < 0)
+                     & (wall_bottom + velocity_y <= y) & (y <= wall_bottom))
+        x = np.where(push_left, wall_x - width, np.where(push_right, wall_right, x))
+        y = np.where(push_up, wall_y - height, np.where(push_down, wall_bottom, y))
+
+        # Players that walked into a corner where two walls meet are moved back.
+        corner = (num_walls_hit == 2) & ~at_goal
+        x -= velocity_x * corner
+        y -= velocity_y * corner
+
+        return x, y, at_goal
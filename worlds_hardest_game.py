@@ -9,7 +9,16 @@ levels make up the world's truly hardest game!
 '''
 
 import pygame
+import array
+import concurrent.futures
+import copy
+import functools
 import os
+import struct
+import time
+
+import level_format
+import profiler
 
 os.environ['SDL_VIDEO_CENTERED'] = '1'
 
@@ -27,9 +36,62 @@ FPS = 60
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 600
 PLAYER_SPEED = 3
+ENEMY_SIZE = 10
+
+# Length of a simulation tick in seconds
+TICK_SECONDS = 1.0 / FPS
+
+# A tick is run up to this many seconds early, so that frame limiter jitter
+# does not make a frame run no ticks and the next one two.
+TICK_TOLERANCE_SECONDS = 0.002
+
+# Most ticks run in one frame when catching up after a frame that ran long
+MAX_CATCH_UP_TICKS = 5
+
+# With busy-wait pacing in low-latency mode, main() sleeps until this many
+# seconds before a tick is due and spins for the rest, since sleeping can
+# overshoot by a millisecond or more.
+BUSY_WAIT_SECONDS = 0.002
+
+# With an uncapped frame rate, main() polls a simulation process this often
+# while it has no new tick to draw, since when its next tick is due is not known.
+SIMULATION_POLL_SECONDS = TICK_SECONDS / 4
+
+# Input bitmask values. Each bit corresponds to one entry of the key_pressed
+# list in main(), which stores the states of the UP, DOWN, LEFT, and RIGHT keys.
+UP = 1
+DOWN = 2
+LEFT = 4
+RIGHT = 8
+
+# Maximum number of rendered text surfaces kept by render_text()
+TEXT_CACHE_SIZE = 64
+
+# Maximum number of WallMaps kept by get_wall_map()
+WALL_MAP_CACHE_SIZE = 32
+
+# Maximum number of solid-colour images kept by get_image()
+IMAGE_CACHE_SIZE = 256
+
+# Layout of the start of a Level.snapshot(): the Level's tick count, then the
+# Player's x, y, x velocity, y velocity, hit_by_enemy, ticks_since_hit, deaths
+# and reached_goal. It is followed by the x, y, x velocity and y velocity of
+# every EnemyBlock as 32-bit integers.
+SNAPSHOT_HEADER = struct.Struct("<qiiiiBiqB")
+
+# Width and height of a cell in a Level's SpatialHash of EnemyBlocks
+ENEMY_INDEX_CELL_SIZE = 32
+
+# Directory where precomputed data (such as enemy occupancy tables) is cached
+CACHE_DIR = os.environ.get("WHG_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+
+# Directory containing the level files of the built-in Levels
+LEVEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "levels")
 
 class EnemyBlock(pygame.sprite.Sprite):
     """ Represents an enemy block (a black block) """
+    colour = BLACK
+
     def __init__(self, level, velocity_x, velocity_y):
         """
         Constructs an EnemyBlock with the specified x and y velocities. The
@@ -37,8 +99,8 @@ class EnemyBlock(pygame.sprite.Sprite):
         """
         super(EnemyBlock, self).__init__()
 
-        self.image = pygame.Surface([10, 10])
-        self.image.fill(BLACK)
+        # Every EnemyBlock of a colour shares one image.
+        self.image = get_image(ENEMY_SIZE, ENEMY_SIZE, self.colour)
 
         self.rect = self.image.get_rect()
 
@@ -48,6 +110,18 @@ class EnemyBlock(pygame.sprite.Sprite):
         # The Level that the EnemyBlock is in.
         self.level = level
 
+    def clone(self, level):
+        """
+        Returns a copy of the EnemyBlock that is in the specified Level. The
+        copy shares the EnemyBlock's image, which never changes.
+        """
+        enemy_block = copy.copy(self)
+        # Sprite.__init__() gives the copy its own (empty) set of Groups.
+        pygame.sprite.Sprite.__init__(enemy_block)
+        enemy_block.rect = self.rect.copy()
+        enemy_block.level = level
+        return enemy_block
+
     def update(self):
         """
         Updates the position of the EnemyBlock according to the block's velocity.
@@ -55,15 +129,17 @@ class EnemyBlock(pygame.sprite.Sprite):
         """
         self.rect.x += self.velocity_x
         self.rect.y += self.velocity_y
+        self.level.get_enemy_index().move(self)
 
-        walls_hit = pygame.sprite.spritecollide(self, self.level.wall_list, False)
+        wall_map = self.level.get_wall_map()
+        walls_hit = wall_map.collide(self.rect)
         if len(walls_hit) == 1:
-            wall = walls_hit[0]
-            if (self.velocity_x > 0 and wall.rect.x <= self.rect.x + self.rect.width <= wall.rect.x + self.velocity_x
-                    or self.velocity_x < 0 and wall.rect.x + wall.rect.width + self.velocity_x <= self.rect.x <= wall.rect.x + wall.rect.width):
+            wall = wall_map.rects[walls_hit[0]]
+            if (self.velocity_x > 0 and wall.x <= self.rect.x + self.rect.width <= wall.x + self.velocity_x
+                    or self.velocity_x < 0 and wall.x + wall.width + self.velocity_x <= self.rect.x <= wall.x + wall.width):
                 self.velocity_x *= -1
-            if (self.velocity_y > 0 and wall.rect.y <= self.rect.y + self.rect.height <= wall.rect.y + self.velocity_y
-                    or self.velocity_y < 0 and wall.rect.y + wall.rect.height + self.velocity_y <= self.rect.y <= wall.rect.y + wall.rect.height):
+            if (self.velocity_y > 0 and wall.y <= self.rect.y + self.rect.height <= wall.y + self.velocity_y
+                    or self.velocity_y < 0 and wall.y + wall.height + self.velocity_y <= self.rect.y <= wall.y + wall.height):
                 self.velocity_y *= -1
         elif len(walls_hit) == 2: # the block hit a corner where two walls intersect
             self.velocity_x *= -1
@@ -74,15 +150,12 @@ class BouncingEnemyBlock(EnemyBlock):
     Represents an EnemyBlock that bounces off of other EnemyBlocks as well
     as RectWalls
     """
-    def __init__(self, level, velocity_x, velocity_y):
-        super(BouncingEnemyBlock, self).__init__(level, velocity_x, velocity_y)
-
-        self.image.fill(MAGENTA)
+    colour = MAGENTA
 
     def update(self):
         super(BouncingEnemyBlock, self).update()
 
-        enemy_blocks_hit = pygame.sprite.spritecollide(self, self.level.enemy_block_list, False)
+        enemy_blocks_hit = self.level.get_enemy_index().query(self.rect)
         if len(enemy_blocks_hit) > 1: # Must be greater than 1 because the sprite always "collides" with itself
             self.velocity_x *= -1
             self.velocity_y *= -1
@@ -97,8 +170,7 @@ class Player(pygame.sprite.Sprite):
         """
         super(Player, self).__init__()
 
-        self.image = pygame.Surface([width, height])
-        self.image.fill(RED)
+        self.image = get_image(width, height, RED)
 
         self.rect = self.image.get_rect()
         self.rect.x = init_pos_x
@@ -139,6 +211,26 @@ class Player(pygame.sprite.Sprite):
     def go_down(self):
         self.velocity_y += PLAYER_SPEED
 
+    def apply_input(self, input_mask):
+        """
+        Sets the Player's velocity according to the specified input bitmask,
+        which is any combination of UP, DOWN, LEFT, and RIGHT.
+        """
+        # The Player's x and y velocities must be reset to 0 every time, or else
+        # the Player would go faster and faster as the arrow keys continue
+        # to be pressed.
+        self.velocity_x = 0
+        self.velocity_y = 0
+
+        if input_mask & UP:
+            self.go_up()
+        if input_mask & DOWN:
+            self.go_down()
+        if input_mask & LEFT:
+            self.go_left()
+        if input_mask & RIGHT:
+            self.go_right()
+
     def update(self):
         """ Updates the Player's position. """
         # If the Player has been hit by an enemy, they cannot move for 1 second.
@@ -146,51 +238,67 @@ class Player(pygame.sprite.Sprite):
             self.ticks_since_hit += 1
 
             # Make the Player translucent
-            self.image.set_alpha(75)
+            self.set_translucent(True)
 
             if self.ticks_since_hit > FPS:
                 # 1 second has passed since the Player has been hit by an enemy.
                 self.hit_by_enemy = False
 
                 # Remove the Player's transparency
-                self.image.set_alpha(None)
+                self.set_translucent(False)
 
                 self.rect.x = self.init_pos[0]
                 self.rect.y = self.init_pos[1]
         else:
             self.rect.x += self.velocity_x
             self.rect.y += self.velocity_y
-            enemies_hit = pygame.sprite.spritecollide(self, self.level.enemy_block_list, False)
-            if len(enemies_hit) > 0:
+            if self.level.enemy_hit(self):
                 self.hit_by_enemy = True
                 self.ticks_since_hit = 0
                 self.deaths += 1
 
             # Check if the Player hit a wall, and adjust the Player's position accordingly.
-            walls_hit = pygame.sprite.spritecollide(self, self.level.wall_list, False)
-            for wall in walls_hit:
-                if wall == self.level.goal:
-                    self.reached_goal = True
-                    return # Immediately exits the method without running the rest of the code.
+            wall_map = self.level.get_wall_map()
+            walls_hit = wall_map.collide(self.rect)
+            if wall_map.goal_index in walls_hit:
+                self.reached_goal = True
+                return # Immediately exits the method without running the rest of the code.
 
             if len(walls_hit) == 1:
-                wall = walls_hit[0]
-                if self.velocity_x > 0 and wall.rect.x <= self.rect.x + self.rect.width <= wall.rect.x + self.velocity_x:
-                    self.rect.x = wall.rect.x - self.rect.width
-                elif self.velocity_x < 0 and wall.rect.x + wall.rect.width + self.velocity_x <= self.rect.x <= wall.rect.x + wall.rect.width:
-                    self.rect.x = wall.rect.x + wall.rect.width
-                if self.velocity_y > 0 and wall.rect.y <= self.rect.y + self.rect.height <= wall.rect.y + self.velocity_y:
-                    self.rect.y = wall.rect.y - self.rect.height
-                elif self.velocity_y < 0 and wall.rect.y + wall.rect.height + self.velocity_y <= self.rect.y <= wall.rect.y + wall.rect.height:
-                    self.rect.y = wall.rect.y + wall.rect.height
+                wall = wall_map.rects[walls_hit[0]]
+                if self.velocity_x > 0 and wall.x <= self.rect.x + self.rect.width <= wall.x + self.velocity_x:
+                    self.rect.x = wall.x - self.rect.width
+                elif self.velocity_x < 0 and wall.x + wall.width + self.velocity_x <= self.rect.x <= wall.x + wall.width:
+                    self.rect.x = wall.x + wall.width
+                if self.velocity_y > 0 and wall.y <= self.rect.y + self.rect.height <= wall.y + self.velocity_y:
+                    self.rect.y = wall.y - self.rect.height
+                elif self.velocity_y < 0 and wall.y + wall.height + self.velocity_y <= self.rect.y <= wall.y + wall.height:
+                    self.rect.y = wall.y + wall.height
             elif len(walls_hit) == 2: # the Player hit a corner where two walls intersect
                 self.rect.x -= self.velocity_x
                 self.rect.y -= self.velocity_y
 
+    def set_translucent(self, translucent):
+        """
+        Switches the Player between its opaque image and its translucent one,
+        which it shows while it recovers from being hit. Both are shared with
+        every other Player of the same size.
+        """
+        self.image = get_image(self.rect.width, self.rect.height, RED, 75 if translucent else None)
+
     def draw(self, surface):
         """ Draws the Player on the specified surface """
         pygame.draw.rect(surface, RED, self.rect)
 
+    def clone(self, level):
+        """ Returns a copy of the Player that is in the specified Level """
+        player = copy.copy(self)
+        pygame.sprite.Sprite.__init__(player)
+        player.rect = self.rect.copy()
+        player.init_pos = list(self.init_pos)
+        player.level = level
+        return player
+
 class Level(object):
     """
     A superclass for all Levels. Every Level has a "player" attribute, which is
@@ -218,184 +326,360 @@ class Level(object):
         # a Goal object. The goal MUST be the first object in self.wall_list
         self.goal = None
 
+        # An optional backend that moves the EnemyBlocks instead of their own
+        # update() methods, such as enemy_physics.VectorizedEnemyPhysics. It must
+        # provide update(), collides(rect) and sync_sprites() methods.
+        self.enemy_physics = None
+
+        # A SpatialHash of the EnemyBlocks, created by get_enemy_index().
+        self.enemy_index = None
+
+        # The WallMap of the walls in wall_list, looked up by get_wall_map().
+        self.wall_map = None
+
+        # The static layer of the Level (everything that never changes), drawn
+        # once by get_background().
+        self.background = None
+
+        # The sprites that can change from frame to frame. Created by
+        # get_moving_sprites().
+        self.moving_sprites = None
+
+        # Number of times that the Level has been updated (or the tick that
+        # seek() last moved the enemies to).
+        self.ticks = 0
+
+        # The trajectory.EnemyTrajectories used by seek(), created the first
+        # time it is called, and the tick that its trajectories start at.
+        self.trajectories = None
+        self.trajectories_tick = 0
+
     def draw(self, surface):
         """
         Draws all objects in the Level on the specified surface.
         In addition, displays a "deaths" counter in the top-left corner.
         """
-        self.all_sprites_list.draw(surface)
+        self.draw_background(surface)
 
-        # Displays deaths counter in the top-left corner.
-        deaths_font = pygame.font.SysFont("Arial", 20, True)
+        self.sync_sprites()
+        for layer in self.get_moving_layers():
+            layer.draw(surface)
 
-        deaths_text = deaths_font.render("Deaths: " + str(self.player.deaths), False, BLUE)
+        for text, position in self.hud():
+            surface.blit(text, position)
 
-        surface.blit(deaths_text, [10, 10])
+    def draw_background(self, surface):
+        """
+        Draws the parts of the Level that never change (the walls and the goal)
+        on the specified surface. Override this to add static decorations such
+        as tips.
+        """
+        self.wall_list.draw(surface)
 
-    def update(self):
-        """ Updates all objects in the Level """
-        self.all_sprites_list.update()
+    def get_background(self):
+        """
+        Returns a screen-sized Surface with the static layer of the Level drawn
+        on a white background. The Surface is only drawn the first time this
+        method is called.
+        """
+        if self.background is None:
+            self.background = pygame.Surface([SCREEN_WIDTH, SCREEN_HEIGHT])
+            self.background.fill(WHITE)
+            self.draw_background(self.background)
+        return self.background
 
-class Level_01(Level):
-    """ Represents Level 1 """
-    def __init__(self):
-        """ Initializes Level 1 and all objects within """
-        super(Level_01, self).__init__()
+    def get_moving_sprites(self):
+        """
+        Returns a RenderUpdates group containing every sprite in the Level
+        that is not a wall.
+        """
+        if self.moving_sprites is None:
+            self.moving_sprites = pygame.sprite.RenderUpdates(
+                [sprite for sprite in self.all_sprites_list if sprite not in self.wall_list])
+        return self.moving_sprites
 
-        # Initialize enemy blocks
-        for i in range(12):
-            enemy_block = EnemyBlock(self, 0, 2)
-            enemy_block.rect.x = 100 + 50 * i
-            enemy_block.rect.y = 400
-            self.enemy_block_list.add(enemy_block)
+    def get_moving_layers(self):
+        """
+        Returns the groups that are redrawn every frame, bottom first: the
+        enemy_physics if it draws enemies that have no sprites (see
+        enemy_physics.EnemyArrays), then get_moving_sprites(). Each one has
+        the draw(), clear() and iteration of a RenderUpdates group.
+        """
+        if self.enemy_physics is not None and hasattr(self.enemy_physics, "draw"):
+            return [self.enemy_physics, self.get_moving_sprites()]
+        return [self.get_moving_sprites()]
 
-        # Initialize boundaries of the level
-        left_boundary = RectWall(0, 0, 50, SCREEN_HEIGHT, CYAN)
-        right_boundary = RectWall(SCREEN_WIDTH - 50, 0, 50, SCREEN_HEIGHT, CYAN)
-        top_boundary = RectWall(0, 0, SCREEN_WIDTH, 50, CYAN)
-        bottom_boundary = RectWall(0, SCREEN_HEIGHT - 50, SCREEN_WIDTH, 50, CYAN)
+    def sync_sprites(self):
+        """ Makes sure that the sprites' rects are up to date before drawing """
+        if self.enemy_physics is not None:
+            self.enemy_physics.sync_sprites()
 
-        # The goal that the Player must reach to pass the Level
-        self.goal = Goal(right_boundary.rect.x - 50, top_boundary.rect.height, 50, SCREEN_HEIGHT - 100)
+    def hud(self):
+        """
+        Returns a list of (text Surface, position) pairs that are drawn on top
+        of the Level. By default, this is a "deaths" counter in the top-left corner.
+        """
+        return [(render_text("Arial", 20, True, "Deaths: " + str(self.player.deaths), BLUE), [10, 10])]
 
-        self.wall_list.add(self.goal, left_boundary, right_boundary, top_boundary, bottom_boundary)
+    def update(self):
+        """ Updates all objects in the Level """
+        self.ticks += 1
+        if self.enemy_physics is None:
+            self.all_sprites_list.update()
+        else:
+            self.enemy_physics.update()
+            self.player.update()
 
-        self.player = Player(self, left_boundary.rect.width + 10, bottom_boundary.rect.y - 20, 10, 10)
+    def enemy_hit(self, sprite):
+        """ Returns True if the specified sprite is touching any EnemyBlock """
+        if self.enemy_physics is not None:
+            return self.enemy_physics.collides(sprite.rect)
+        return self.get_enemy_index().collides(sprite.rect)
 
-        self.all_sprites_list.add(self.enemy_block_list, self.wall_list, self.player)
+    def get_enemy_index(self):
+        """
+        Returns a SpatialHash containing every EnemyBlock in the Level. The
+        index is built the first time this method is called; after that,
+        EnemyBlocks keep it up to date as they move. Set self.enemy_index to None
+        after moving enemies by any other means so that it gets rebuilt.
+        """
+        if self.enemy_index is None:
+            self.enemy_index = SpatialHash(ENEMY_INDEX_CELL_SIZE)
+            for enemy_block in self.enemy_block_list:
+                self.enemy_index.add(enemy_block)
+        return self.enemy_index
 
-    def draw(self, surface):
-        # Call the super class's draw() method
-        super(Level_01, self).draw(surface)
-
-        tips_font = pygame.font.SysFont("Arial", 32)
-        tips_text = tips_font.render("Move your red block using the arrow keys.", False, RED)
-        surface.blit(tips_text, [60, 60])
-        tips_text = tips_font.render("Get to the green goal ==>", False, LIME_GREEN)
-        surface.blit(tips_text, [self.goal.rect.x - tips_text.get_width() - 50, SCREEN_HEIGHT - tips_text.get_height() - 100])
-        tips_text = tips_font.render("Don't touch the black blocks!", False, BLACK)
-        surface.blit(tips_text, [60, 140])
-
-class Level_02(Level):
-    """ Represents Level 2 """
-    def __init__(self):
-        """ Initializes Level 2 and all objects within """
-        super(Level_02, self).__init__()
+    def get_wall_map(self):
+        """
+        Returns the WallMap of the walls in the Level's wall_list. WallMaps are
+        shared by every Level with the same walls, so it is only built the
+        first time that a Level with these walls is played. Set
+        self.wall_map to None after changing the walls so that it is looked
+        up again.
+        """
+        if self.wall_map is None:
+            walls = self.wall_list.sprites()
+            goal_index = walls.index(self.goal) if self.goal in walls else None
+            self.wall_map = get_wall_map(tuple(tuple(wall.rect) for wall in walls), goal_index)
+        return self.wall_map
 
-        # Initialize enemy blocks
+    def seek(self, tick):
+        """
+        Moves the EnemyBlocks to where they are tick ticks after the Level was
+        constructed, without updating them once per tick (see trajectory.py).
+        The Player is not moved. Cannot be used together with enemy_physics.
+        """
+        if self.enemy_physics is not None:
+            raise ValueError("seek() moves the EnemyBlocks' sprites, which enemy_physics does not read")
+        if self.trajectories is None:
+            import trajectory
+            # The trajectories start from the enemies' current state.
+            self.trajectories = trajectory.EnemyTrajectories(self)
+            self.trajectories_tick = self.ticks
+
+        self.trajectories.apply(tick - self.trajectories_tick)
+        self.ticks = tick
+        self.enemy_index = None
+
+    def snapshot(self):
+        """
+        Returns the state of the Level (its tick count, the Player and every
+        EnemyBlock) as bytes in the SNAPSHOT_HEADER format, which restore()
+        can put the Level, or another copy of it, back into.
+        """
+        self.sync_sprites()
 
-        # === Vertically-moving blocks ===
-        for i in range(14):
-            enemy_block = EnemyBlock(self, 0, 5)
-            enemy_block.rect.x = 50 + 50 * i
-            enemy_block.rect.y = 100
-            self.enemy_block_list.add(enemy_block)
-
-        # === Horizontally-moving blocks ===
-        for i in range(10):
-            enemy_block = EnemyBlock(self, 5, 0)
-            enemy_block.rect.x = 150
-            enemy_block.rect.y = 75 + 50 * i
-            self.enemy_block_list.add(enemy_block)
-
-        # Initialize boundaries of the level
-        left_boundary = RectWall(0, 0, 50, SCREEN_HEIGHT, CYAN)
-        right_boundary = RectWall(SCREEN_WIDTH - 50, 0, 50, SCREEN_HEIGHT, CYAN)
-        top_boundary = RectWall(0, 0, SCREEN_WIDTH, 50, CYAN)
-        bottom_boundary = RectWall(0, SCREEN_HEIGHT - 50, SCREEN_WIDTH, 50, CYAN)
+        player = self.player
+        snapshot_enemies = getattr(self.enemy_physics, "snapshot_enemies", None)
+        if snapshot_enemies is not None:
+            enemies = snapshot_enemies()
+        else:
+            enemies = array.array("i")
+            for enemy_block in self.enemy_block_list:
+                enemies.extend((enemy_block.rect.x, enemy_block.rect.y, enemy_block.velocity_x, enemy_block.velocity_y))
+            enemies = enemies.tobytes()
 
-        # The goal that the Player must reach to pass the Level
-        self.goal = Goal(left_boundary.rect.width, bottom_boundary.rect.y - 50, 50, 50)
+        return SNAPSHOT_HEADER.pack(self.ticks, player.rect.x, player.rect.y, player.velocity_x, player.velocity_y,
+                                    player.hit_by_enemy, player.ticks_since_hit, player.deaths,
+                                    player.reached_goal) + enemies
 
-        self.wall_list.add(self.goal, left_boundary, right_boundary, top_boundary, bottom_boundary)
+    def restore(self, snapshot):
+        """
+        Puts the Level back into the state recorded by snapshot(), which may
+        be any bytes-like object (it is read in place). Raises ValueError,
+        without changing the Level, if the snapshot has the wrong number of
+        EnemyBlocks, or if the Level's enemy_physics cannot load its state
+        from the sprites or rejects the snapshot's enemies.
+        """
+        (ticks, x, y, velocity_x, velocity_y, hit_by_enemy, ticks_since_hit, deaths,
+         reached_goal) = SNAPSHOT_HEADER.unpack_from(snapshot)
+        enemies = memoryview(snapshot)[SNAPSHOT_HEADER.size:]
+        # Every EnemyBlock takes four C ints.
+        enemy_size = 4 * struct.calcsize("i")
+        restore_enemies = getattr(self.enemy_physics, "restore_enemies", None)
+        num_enemies = len(self.enemy_physics) if restore_enemies is not None else len(self.enemy_block_list)
+        if len(enemies) != enemy_size * num_enemies:
+            raise ValueError("the snapshot has {} enemies, but the Level has {}".format(
+                len(enemies) // enemy_size, num_enemies))
+        # Checked before anything is changed, so that a failed restore leaves
+        # the Level as it was.
+        read_sprites = None
+        if self.enemy_physics is not None and restore_enemies is None:
+            read_sprites = getattr(self.enemy_physics, "read_sprites", None)
+            if read_sprites is None:
+                raise ValueError(type(self.enemy_physics).__name__ + " cannot be restored from a snapshot")
+        enemies = enemies.cast("i")
+        check_snapshot = getattr(self.enemy_physics, "check_snapshot", None)
+        if check_snapshot is not None:
+            check_snapshot(ticks, enemies)
+
+        if restore_enemies is not None:
+            restore_enemies(enemies)
+        else:
+            i = 0
+            for enemy_block in self.enemy_block_list:
+                enemy_block.rect.x, enemy_block.rect.y, enemy_block.velocity_x, enemy_block.velocity_y = enemies[i:i + 4]
+                i += 4
+
+        player = self.player
+        player.rect.x = x
+        player.rect.y = y
+        player.velocity_x = velocity_x
+        player.velocity_y = velocity_y
+        player.hit_by_enemy = bool(hit_by_enemy)
+        player.ticks_since_hit = ticks_since_hit
+        player.deaths = deaths
+        player.reached_goal = bool(reached_goal)
+        # The Player is translucent from the first tick after being hit.
+        player.set_translucent(player.hit_by_enemy and ticks_since_hit > 0)
+
+        self.ticks = ticks
+        self.enemy_index = None
+
+        if read_sprites is not None:
+            read_sprites()
+
+    def clone(self):
+        """
+        Returns a copy of the Level in its current state, without rebuilding
+        it. The copy shares everything that never changes (the walls, the
+        goal, the enemies' images and the background, once it has been
+        drawn) with this Level, and only the Player and the EnemyBlocks are
+        copied. The copy has no enemy_physics, so its enemies update
+        themselves, unless the enemies are enemy_physics.EnemyArrays (which
+        have no sprites), which are copied instead.
+        """
+        self.sync_sprites()
+
+        level = copy.copy(self)
+        level.enemy_block_list = pygame.sprite.Group()
+        level.all_sprites_list = pygame.sprite.Group()
+        level.enemy_physics = None
+        if hasattr(self.enemy_physics, "snapshot_enemies"):
+            level.enemy_physics = self.enemy_physics.clone(level)
+        level.enemy_index = None
+        level.moving_sprites = None
+        level.trajectories = None
+
+        # Both Groups keep their order, which is the order that snapshots list
+        # the enemies in and the order that the sprites are updated in.
+        clones = {self.player: self.player.clone(level)}
+        for enemy_block in self.enemy_block_list:
+            clones[enemy_block] = enemy_block.clone(level)
+            level.enemy_block_list.add(clones[enemy_block])
+        level.player = clones[self.player]
+        level.all_sprites_list.add([clones.get(sprite, sprite) for sprite in self.all_sprites_list])
+
+        return level
+
+    def step(self, input_mask):
+        """
+        Advances the Level by one tick, moving the Player according to the
+        specified input bitmask (any combination of UP, DOWN, LEFT, and RIGHT).
+        Once the Player has reached the goal, the Level stops updating.
+        Returns True if the Player has reached the goal.
+        """
+        if self.player.reached_goal:
+            return True
 
-        self.player = Player(self, right_boundary.rect.x - 20, top_boundary.rect.height + 10, 10, 10)
-        self.all_sprites_list.add(self.enemy_block_list, self.wall_list, self.player)
+        self.player.apply_input(input_mask)
+        self.update()
 
-class Level_03(Level):
-    """ Represents Level 3 """
-    def __init__(self):
-        """ Initializes Level 3 and all objects within """
-        super(Level_03, self).__init__()
+        return self.player.reached_goal
 
-        # Initialize enemy blocks
+class DataLevel(Level):
+    """
+    A Level built from a level file (see level_format.py). Subclasses set
+    level_file to the name of a file in LEVEL_DIR; alternatively, a
+    level_format.LevelData can be passed in directly.
+    """
+    # Name of the level file in LEVEL_DIR that the Level is built from
+    level_file = None
 
-        # === Vertically-moving blocks ===
-        for i in range(7):
-            enemy_block = EnemyBlock(self, 0, 3)
-            enemy_block.rect.x = 50 + 45 * i
-            enemy_block.rect.y = 75
-            self.enemy_block_list.add(enemy_block)
-
-        for i in range(11):
-            enemy_block = EnemyBlock(self, 0, 3)
-            enemy_block.rect.x = 250 + 45 * i
-            enemy_block.rect.y = 525
-            self.enemy_block_list.add(enemy_block)
-
-        # === Horizontally-moving blocks ===
-        for i in range(7):
-            enemy_block = EnemyBlock(self, 3, 0)
-            enemy_block.rect.x = 75
-            enemy_block.rect.y = 90 + 75 * i
-            self.enemy_block_list.add(enemy_block)
-
-        for i in range(6):
-            enemy_block = EnemyBlock(self, 3, 0)
-            enemy_block.rect.x = 625
-            enemy_block.rect.y = 125 + 75 * i
-            self.enemy_block_list.add(enemy_block)
-
-        # Initialize boundaries of the level
-        left_boundary = RectWall(0, 0, 50, SCREEN_HEIGHT, CYAN)
-        right_boundary = RectWall(SCREEN_WIDTH - 50, 0, 50, SCREEN_HEIGHT, CYAN)
-        top_boundary = RectWall(0, 0, SCREEN_WIDTH, 50, CYAN)
-        bottom_boundary = RectWall(0, SCREEN_HEIGHT - 50, SCREEN_WIDTH, 50, CYAN)
+    def __init__(self, level_data=None, compact=False):
+        """
+        Initializes the Level and all objects within from its level file. If
+        compact is True, the enemies are stored as enemy_physics.EnemyArrays
+        instead of EnemyBlock sprites, which takes far less memory per enemy.
+        """
+        super(DataLevel, self).__init__()
 
-        vertical_wall = RectWall(SCREEN_WIDTH / 2 - 20, top_boundary.rect.height, 40, SCREEN_HEIGHT / 2 - top_boundary.rect.height, CYAN)
-        horizontal_wall = RectWall(SCREEN_WIDTH / 2 - 200, vertical_wall.rect.y + 50, 400, 400, CYAN)
+        if level_data is None:
+            level_data = level_format.load_level(os.path.join(LEVEL_DIR, self.level_file), CACHE_DIR)
 
-        self.goal = Goal(vertical_wall.rect.x + vertical_wall.rect.width, top_boundary.rect.height, 60, horizontal_wall.rect.y - top_boundary.rect.height)
+        # Lines of text drawn on the background, as (text, font, size, bold,
+        # colour, anchor, x, y) tuples
+        self.texts = level_data.texts
 
-        self.wall_list.add(self.goal, vertical_wall, horizontal_wall, left_boundary, right_boundary, top_boundary, bottom_boundary)
+        # Initialize enemy blocks
+        if not compact:
+            for bouncing, x, y, velocity_x, velocity_y in level_data.enemies:
+                if bouncing:
+                    enemy_block = BouncingEnemyBlock(self, velocity_x, velocity_y)
+                else:
+                    enemy_block = EnemyBlock(self, velocity_x, velocity_y)
+                enemy_block.rect.x = x
+                enemy_block.rect.y = y
+                self.enemy_block_list.add(enemy_block)
 
-        self.player = Player(self, vertical_wall.rect.x - 20, vertical_wall.rect.y + 10, 10, 10)
-        self.all_sprites_list.add(self.enemy_block_list, self.wall_list, self.player)
+        # The goal that the Player must reach to pass the Level
+        self.goal = Goal(*level_data.goal)
 
-class Level_04(Level):
-    """ Represents Level 4 """
-    def __init__(self):
-        """ Initializes Level 4 and all objects within """
-        super(Level_04, self).__init__()
+        self.wall_list.add(self.goal)
+        for left, top, width, height, colour in level_data.walls:
+            self.wall_list.add(RectWall(left, top, width, height, colour))
 
-        # Initialize enemy blocks
+        if compact:
+            import enemy_physics
+            self.enemy_physics = enemy_physics.EnemyArrays(self, level_data.enemies)
 
-        for i in range(16):
-            enemy_block = BouncingEnemyBlock(self, 0, 5)
-            enemy_block.rect.x = 60 + 45 * i
-            enemy_block.rect.y = 200
-            self.enemy_block_list.add(enemy_block)
+        self.player = Player(self, *level_data.player)
 
-        for i in range(10):
-            enemy_block = BouncingEnemyBlock(self, 5, 0)
-            enemy_block.rect.x = 150
-            enemy_block.rect.y = 90 + 50 * i
-            self.enemy_block_list.add(enemy_block)
+        self.all_sprites_list.add(self.enemy_block_list, self.wall_list, self.player)
 
-        # Initialize boundaries of the level
-        left_boundary = RectWall(0, 0, 50, SCREEN_HEIGHT, CYAN)
-        right_boundary = RectWall(SCREEN_WIDTH - 50, 0, 50, SCREEN_HEIGHT, CYAN)
-        top_boundary = RectWall(0, 0, SCREEN_WIDTH, 50, CYAN)
-        bottom_boundary = RectWall(0, SCREEN_HEIGHT - 50, SCREEN_WIDTH, 50, CYAN)
+    def draw_background(self, surface):
+        # Call the super class's draw_background() method
+        super(DataLevel, self).draw_background(surface)
 
-        horizontal_wall = RectWall(left_boundary.rect.width, top_boundary.rect.height + 30, 100, 25, CYAN)
+        for text, font, size, bold, colour, anchor, x, y in self.texts:
+            text_surface = render_text(font, size, bold, text, colour)
+            surface.blit(text_surface, text_surface.get_rect(**{anchor: (x, y)}))
 
-        self.goal = Goal(SCREEN_WIDTH / 2 - 10, SCREEN_HEIGHT / 2 - 10, 20, 20)
+class Level_01(DataLevel):
+    """ Represents Level 1 """
+    level_file = "level_01.json"
 
-        self.wall_list.add(self.goal, horizontal_wall, left_boundary, right_boundary, top_boundary, bottom_boundary)
+class Level_02(DataLevel):
+    """ Represents Level 2 """
+    level_file = "level_02.json"
 
-        self.player = Player(self, left_boundary.rect.width + 10, top_boundary.rect.height + 10, 10, 10)
-        self.all_sprites_list.add(self.enemy_block_list, self.wall_list, self.player)
+class Level_03(DataLevel):
+    """ Represents Level 3 """
+    level_file = "level_03.json"
+
+class Level_04(DataLevel):
+    """ Represents Level 4 """
+    level_file = "level_04.json"
 
 class GameOverScreen(Level):
     """ Represents the game over screen (a blank Level) """
@@ -410,12 +694,231 @@ class GameOverScreen(Level):
         self.wall_list.add(left_boundary, right_boundary, top_boundary, bottom_boundary)
         self.all_sprites_list.add(self.wall_list)
 
-    def draw(self, surface):
+    def hud(self):
+        """ The GameOverScreen does not display a deaths counter """
+        return []
+
+class SpatialHash(object):
+    """
+    A uniform grid that indexes sprites by the cells that their rects overlap,
+    so that finding the sprites that collide with a rect only has to look at
+    the sprites in nearby cells instead of every sprite.
+    """
+    def __init__(self, cell_size):
+        """ Constructs an empty SpatialHash whose cells are cell_size pixels wide and tall """
+        self.cell_size = cell_size
+
+        # Maps (column, row) to a dict whose keys are the sprites in that cell.
+        # Dicts are used instead of sets so that iteration order is deterministic.
+        self.cells = {}
+
+        # Maps each sprite to the (left, top, right, bottom) range of cells it is in.
+        self.sprite_cells = {}
+
+    def _cell_range(self, rect):
+        """ Returns the (left, top, right, bottom) range of cells that the rect overlaps """
+        cell_size = self.cell_size
+        return (rect.x // cell_size, rect.y // cell_size,
+                (rect.x + rect.width - 1) // cell_size, (rect.y + rect.height - 1) // cell_size)
+
+    def add(self, sprite):
+        """ Adds the specified sprite to the cells that its rect overlaps """
+        cell_range = self._cell_range(sprite.rect)
+        self.sprite_cells[sprite] = cell_range
+        left, top, right, bottom = cell_range
+        for column in range(left, right + 1):
+            for row in range(top, bottom + 1):
+                self.cells.setdefault((column, row), {})[sprite] = None
+
+    def remove(self, sprite):
+        """ Removes the specified sprite from the SpatialHash """
+        left, top, right, bottom = self.sprite_cells.pop(sprite)
+        for column in range(left, right + 1):
+            for row in range(top, bottom + 1):
+                cell = self.cells[(column, row)]
+                del cell[sprite]
+                if not cell:
+                    del self.cells[(column, row)]
+
+    def move(self, sprite):
+        """ Updates the cells of a sprite whose rect has moved """
+        # Same as self._cell_range(), inlined because this runs for every enemy every tick.
+        rect = sprite.rect
+        cell_size = self.cell_size
+        cell_range = (rect.x // cell_size, rect.y // cell_size,
+                      (rect.x + rect.width - 1) // cell_size, (rect.y + rect.height - 1) // cell_size)
+        if cell_range != self.sprite_cells[sprite]:
+            self.remove(sprite)
+            self.add(sprite)
+
+    def query(self, rect):
+        """ Returns a list of the sprites whose rects collide with the specified rect """
+        left, top, right, bottom = self._cell_range(rect)
+        if left == right and top == bottom:
+            cell = self.cells.get((left, top), ())
+            return [sprite for sprite in cell if rect.colliderect(sprite.rect)]
+
+        hits = {}
+        for column in range(left, right + 1):
+            for row in range(top, bottom + 1):
+                for sprite in self.cells.get((column, row), ()):
+                    if sprite not in hits and rect.colliderect(sprite.rect):
+                        hits[sprite] = None
+        return list(hits)
+
+    def collides(self, rect):
+        """ Returns True if any sprite's rect collides with the specified rect """
+        left, top, right, bottom = self._cell_range(rect)
+        for column in range(left, right + 1):
+            for row in range(top, bottom + 1):
+                for sprite in self.cells.get((column, row), ()):
+                    if rect.colliderect(sprite.rect):
+                        return True
+        return False
+
+class WallMap(object):
+    """
+    A static collision map of a Level's walls, which never move. For every x
+    coordinate, a table holds a bitmask of the walls whose right edge is to
+    the right of it and another holds a bitmask of the walls whose left edge
+    is to the left of it, and likewise for y, so the walls that a rect
+    collides with are found with four lookups whatever the number of walls.
+    """
+    def __init__(self, wall_rects, goal_index=None):
+        """
+        Builds the map of walls with the specified (left, top, width, height)
+        rects, in wall_list order. goal_index is the position of the Goal in
+        that order, or None if there is none.
+        """
+        self.rects = [pygame.Rect(rect) for rect in wall_rects]
+        self.goal_index = goal_index
+
+        # Walls without an area never collide with anything, so they are
+        # left out of the tables.
+        walls = [(i, rect) for i, rect in enumerate(self.rects) if rect.width > 0 and rect.height > 0]
+        edges_x = [edge for i, rect in walls for edge in (rect.left, rect.right)] or [0]
+        edges_y = [edge for i, rect in walls for edge in (rect.top, rect.bottom)] or [0]
+
+        # The tables cover every coordinate from the lowest edge to the highest
+        # one; coordinates outside of that range are clamped to it.
+        self.low_x = min(edges_x)
+        self.high_x = max(edges_x)
+        self.low_y = min(edges_y)
+        self.high_y = max(edges_y)
+        self.right_of_x = [sum(1 << i for i, rect in walls if rect.right > x) for x in range(self.low_x, self.high_x + 1)]
+        self.left_of_x = [sum(1 << i for i, rect in walls if rect.left < x) for x in range(self.low_x, self.high_x + 1)]
+        self.below_y = [sum(1 << i for i, rect in walls if rect.bottom > y) for y in range(self.low_y, self.high_y + 1)]
+        self.above_y = [sum(1 << i for i, rect in walls if rect.top < y) for y in range(self.low_y, self.high_y + 1)]
+
+        # Maps each bitmask of walls to a tuple of their indices, in order
+        self.hits = {}
+
+    def collide(self, rect):
         """
-        Draws the boundaries of the GameOverScreen.
-        Does not display a deaths counter or the level counter.
+        Returns a tuple of the indices (in wall_list order) of the walls that
+        the specified rect collides with, like pygame.sprite.spritecollide().
         """
-        self.all_sprites_list.draw(surface)
+        low_x = self.low_x
+        high_x = self.high_x
+        low_y = self.low_y
+        high_y = self.high_y
+        left = rect.x
+        top = rect.y
+        right = left + rect.width
+        bottom = top + rect.height
+        mask = (self.right_of_x[(left if left < high_x else high_x) - low_x if left > low_x else 0]
+                & self.left_of_x[(right if right < high_x else high_x) - low_x if right > low_x else 0]
+                & self.below_y[(top if top < high_y else high_y) - low_y if top > low_y else 0]
+                & self.above_y[(bottom if bottom < high_y else high_y) - low_y if bottom > low_y else 0])
+        if mask == 0:
+            return ()
+
+        hits = self.hits.get(mask)
+        if hits is None:
+            hits = tuple(i for i in range(mask.bit_length()) if mask >> i & 1)
+            self.hits[mask] = hits
+        return hits
+
+@functools.lru_cache(maxsize=WALL_MAP_CACHE_SIZE)
+def get_wall_map(wall_rects, goal_index):
+    """
+    Returns the WallMap of walls with the specified rects (a tuple of
+    (left, top, width, height) tuples in wall_list order) and goal index.
+    The most recently used WallMaps are cached, so a Level's walls are only
+    compiled the first time it is built.
+    """
+    return WallMap(wall_rects, goal_index)
+
+class DirtyRenderer(object):
+    """
+    Draws Levels on the screen using dirty rectangles. The static layer of a
+    Level is drawn once into a cached background. Every frame, only the moving
+    sprites and the text overlays are erased and redrawn, and the areas of the
+    screen that changed are returned so that they can be passed to
+    pygame.display.update() instead of flipping the whole display.
+    """
+    def __init__(self, screen):
+        """ Constructs a DirtyRenderer that draws on the specified screen """
+        self.screen = screen
+
+        # The Level that was drawn in the previous frame
+        self.level = None
+
+        # The (text Surface, position) pairs and their screen rects that were
+        # drawn in the previous frame
+        self.overlays = []
+        self.overlay_rects = []
+
+    def draw(self, level, overlays):
+        """
+        Draws the specified Level, its HUD and the specified list of
+        (text Surface, position) overlays. Returns the list of rects that
+        changed since the previous frame.
+        """
+        overlays = level.hud() + overlays
+        background = level.get_background()
+        layers = level.get_moving_layers()
+        level.sync_sprites()
+
+        if level is not self.level:
+            # A new Level is showing, so the whole screen must be redrawn.
+            self.level = level
+            self.screen.blit(background, [0, 0])
+            for layer in layers:
+                layer.draw(self.screen)
+            self.overlays = overlays
+            self.overlay_rects = [self.screen.blit(text, position) for text, position in overlays]
+            return [self.screen.get_rect()]
+
+        # Every layer is erased before any is drawn, so that erasing one does
+        # not erase what another has just drawn.
+        for layer in layers:
+            layer.clear(self.screen, background)
+        dirty_rects = []
+        for layer in layers:
+            dirty_rects.extend(layer.draw(self.screen))
+
+        # The overlays only need to be redrawn if they changed or if a moving
+        # sprite was drawn over them.
+        if (overlays == self.overlays
+                and not any(rect.collidelist(dirty_rects) != -1 for rect in self.overlay_rects)):
+            return dirty_rects
+
+        for rect in self.overlay_rects:
+            self.screen.blit(background, rect, rect)
+        dirty_rects.extend(self.overlay_rects)
+
+        # Sprites under the old overlays were just erased, so draw them again.
+        for layer in layers:
+            for sprite in layer:
+                if sprite.rect.collidelist(self.overlay_rects) != -1:
+                    self.screen.blit(sprite.image, sprite.rect)
+
+        self.overlays = overlays
+        self.overlay_rects = [self.screen.blit(text, position) for text, position in overlays]
+        dirty_rects.extend(self.overlay_rects)
+
+        return dirty_rects
 
 class RectWall(pygame.sprite.Sprite):
     """ Represents a rectangular wall in a Level """
@@ -431,12 +934,18 @@ class RectWall(pygame.sprite.Sprite):
         """
         super(RectWall, self).__init__()
 
-        self.image = pygame.Surface([width, height])
-        self.image.fill(colour)
+        self.colour = colour
+        self.rect = pygame.Rect(left, top, width, height)
 
-        self.rect = self.image.get_rect()
-        self.rect.x = left
-        self.rect.y = top
+    @property
+    def image(self):
+        """
+        The wall's image, which is shared with every wall of the same size and
+        colour. It is only created when the wall is first drawn, since walls
+        are drawn once into the Level's background and the walls around a
+        large Level make very large images.
+        """
+        return get_image(self.rect.width, self.rect.height, self.colour)
 
     def update(self):
         """
@@ -461,37 +970,365 @@ class Goal(RectWall):
         """
         super(Goal, self).__init__(left, top, width, height, LIME_GREEN)
 
-def main():
-    pygame.init()
+# Fonts that have been loaded by get_font(), keyed by (name, size, bold)
+_fonts = {}
 
-    # Set screen properties
-    size = (SCREEN_WIDTH, SCREEN_HEIGHT)
-    screen = pygame.display.set_mode(size)
-    pygame.display.set_caption("World's Hardest Game Spin-off")
+def get_font(name, size, bold=False):
+    """
+    Returns the system font with the specified name, size and boldness. Looking
+    up a system font is slow, so each font is only loaded the first time it is
+    requested.
+    """
+    key = (name, size, bold)
+    font = _fonts.get(key)
+    if font is None:
+        font = pygame.font.SysFont(name, size, bold)
+        _fonts[key] = font
+    return font
+
+@functools.lru_cache(maxsize=TEXT_CACHE_SIZE)
+def render_text(font_name, size, bold, text, colour):
+    """
+    Returns a Surface containing the specified text rendered in the specified
+    font and colour. The most recently used surfaces are cached, so text is
+    only re-rendered when it changes. The returned Surface is shared and must
+    not be modified.
+    """
+    return get_font(font_name, size, bold).render(text, False, colour)
 
-    done = False
+def clear_font_caches():
+    """
+    Forgets every font loaded by get_font() and every Surface cached by
+    render_text(). Must be called whenever pygame or its font module is shut
+    down, since the cached Fonts cannot be used once it has been.
+    """
+    _fonts.clear()
+    render_text.cache_clear()
 
-    clock = pygame.time.Clock()
+@functools.lru_cache(maxsize=IMAGE_CACHE_SIZE)
+def get_image(width, height, colour, alpha=None):
+    """
+    Returns a width x height Surface filled with the specified colour and
+    with the specified alpha (None for opaque). Sprites that look the same
+    share one Surface instead of each allocating its own, so the returned
+    Surface is shared and must not be modified.
+    """
+    image = pygame.Surface([width, height])
+    image.fill(colour)
+    if alpha is not None:
+        image.set_alpha(alpha)
+    return image
+
+def input_mask(key_pressed):
+    """
+    Converts a key_pressed list (the states of the UP, DOWN, LEFT, and RIGHT
+    keys, in that order) into an input bitmask.
+    """
+    mask = 0
+    for i, bit in enumerate((UP, DOWN, LEFT, RIGHT)):
+        if key_pressed[i]:
+            mask |= bit
+    return mask
+
+def pressed_arrow_keys():
+    """
+    Returns a key_pressed list of the arrow keys' current states, as
+    pygame.key.get_pressed() reports them.
+    """
+    pressed = pygame.key.get_pressed()
+    return [pressed[pygame.K_UP], pressed[pygame.K_DOWN], pressed[pygame.K_LEFT], pressed[pygame.K_RIGHT]]
+
+def wait_until(deadline, busy_wait=False):
+    """
+    Sleeps until the specified perf_counter() time. With busy_wait, the last
+    BUSY_WAIT_SECONDS are spent spinning instead, which wakes up on time.
+    """
+    remaining = deadline - time.perf_counter()
+    if busy_wait:
+        remaining -= BUSY_WAIT_SECONDS
+    if remaining > 0:
+        time.sleep(remaining)
+    if busy_wait:
+        while time.perf_counter() < deadline:
+            pass
+
+def simulate(level, input_masks):
+    """
+    Steps the specified Level once for every input bitmask in input_masks,
+    as fast as possible. Nothing is drawn, so neither a display nor fonts
+    are needed. Stops early if the Player reaches the goal.
+    Returns the number of ticks that were simulated.
+    """
+    ticks = 0
+    for mask in input_masks:
+        if level.player.reached_goal:
+            break
+        level.step(mask)
+        ticks += 1
+    return ticks
+
+# Every Level in the game, in the order that they are played.
+LEVELS = [Level_01, Level_02, Level_03, Level_04]
+
+class Game(object):
+    """
+    A game session: the Level that the Player is on, the congratulations
+    message shown after each Level, and the game over screen. The game
+    advances by one fixed-length tick (1 / FPS seconds of game time) every
+    time tick() is called, no matter how often it is drawn, so all of its
+    timers count ticks rather than frames.
+    """
+    def __init__(self, level_classes=LEVELS, recorder=None, frame_profiler=None, telemetry=None):
+        """
+        Starts a game through the specified Level classes, which are only
+        constructed when they are reached. If a replay.ReplayRecorder is
+        given, the inputs of every tick are recorded to it; if a
+        profiler.FrameProfiler is given, input and update times are marked on it;
+        if a telemetry.TelemetryLog is given, the Player's position and deaths
+        are logged to it every tick.
+        """
+        self.level_classes = level_classes
+        self.recorder = recorder
+        self.frame_profiler = frame_profiler
+        self.telemetry = telemetry
+
+        # The index of level_classes that points to the current level.
+        self.current_level_index = 0
+
+        self.current_level = self.build_level(level_classes[0])
+
+        # Builds the next Level in the background while the current one's
+        # congratulations message is showing.
+        self.level_loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        # A Future that holds the next Level once it has been built
+        self.next_level = None
+
+        # Number of ticks that the congratulations message has been shown for.
+        self.congratulations_text_ticks = 0
+
+        # Messages that show up on the end-game screen when the player beats all of the levels.
+        self.game_over_messages = ["Congratulations!", "You beat all the levels!", "Thanks for playing!"]
+
+        # Becomes True once the game over screen has finished.
+        self.done = False
+
+    def build_level(self, level_class):
+        """
+        Builds a Level of the specified class. If its enemies go through a
+        short enough cycle, they are moved by an occupancy table instead of
+        being updated every tick (see occupancy.py).
+        """
+        import occupancy
+        level = level_class()
+        occupancy.use_occupancy_table(level, max_bytes=occupancy.MAX_GAME_TABLE_BYTES)
+        return level
+
+    def playing(self):
+        """ Returns True until the Player has beaten all of the levels """
+        return self.current_level_index < len(self.level_classes)
+
+    def tick(self, input_mask):
+        """
+        Advances the game by one tick, moving the Player according to the
+        specified input bitmask (any combination of UP, DOWN, LEFT, and RIGHT).
+        """
+        if not self.playing(): # The player beat all of the levels
+            if self.congratulations_text_ticks == 0:
+                # Add a message to game_over_messages telling the player how many times they died
+                self.game_over_messages.append("Total number of deaths: " + str(self.current_level.player.deaths))
+
+                # Initialize game over screen
+                self.current_level = GameOverScreen()
+
+            self.congratulations_text_ticks += 1
+
+            if self.congratulations_text_ticks > 12 * FPS:
+                self.done = True
+            return
+
+        self.current_level.player.apply_input(input_mask)
+        self._mark(profiler.INPUT)
+
+        # Checks if the player has reached the goal.
+        if self.current_level.player.reached_goal:
+            self.congratulations_text_ticks += 1
+
+            if self.next_level is None and self.current_level_index + 1 < len(self.level_classes):
+                self.next_level = self.level_loader.submit(self.build_level,
+                                                           self.level_classes[self.current_level_index + 1])
+
+            # Only show the congratulatory message for 2 seconds.
+            if self.congratulations_text_ticks > 2 * FPS:
+                self.congratulations_text_ticks = 0
 
-    # List of all of the levels in the game
-    levels_list = [Level_01(), Level_02(), Level_03(), Level_04()]
+                # At this point, it is safe to increment the current_level_index.
+                self.current_level_index += 1
+
+                if self.playing(): # The player has not beaten all of the levels
+                    # Changes the Level
+                    # The number of deaths that the Player has carries over to the next Level.
+                    current_deaths = self.current_level.player.deaths
+                    self.current_level = self.next_level.result()
+                    self.current_level.player.deaths = current_deaths
+                    self.next_level = None
+        else: # Only update the Level if the Player hasn't reached the goal.
+            self.current_level.update()
+            self._mark(profiler.UPDATE)
+
+            if self.telemetry is not None:
+                self.telemetry.log(self.current_level_index, self.current_level)
+
+            if self.recorder is not None:
+                self.recorder.record(input_mask)
+                if self.current_level.player.reached_goal:
+                    self.recorder.end_level(self.current_level_index, self.current_level.player.deaths)
+                elif self.recorder.level_full():
+                    # A replay cannot hold any more ticks of this Level, so
+                    # the recording ends here as if the game had been quit.
+                    self.recorder.end_level(self.current_level_index, self.current_level.player.deaths,
+                                            completed=False)
+
+    def overlays(self):
+        """
+        Returns the text that is drawn on top of the Level, as a list of
+        (text Surface, position) pairs.
+        """
+        overlays = []
+
+        if not self.playing():
+            ticks = self.congratulations_text_ticks
+            if 8 * FPS < ticks <= 12 * FPS:
+                congratulations_text = render_text("Arial", 48, True, "World's Hardest Game Spin-off", GREEN)
+                overlays.append((congratulations_text, [SCREEN_WIDTH / 2 - congratulations_text.get_width() / 2,
+					SCREEN_HEIGHT / 2 - congratulations_text.get_height()]))
+                if 9.5 * FPS < ticks <= 12 * FPS:
+                    congratulations_text = render_text("Arial", 48, True, "made by Eugene Chau", GREEN)
+                    overlays.append((congratulations_text, [SCREEN_WIDTH / 2 - congratulations_text.get_width() / 2,
+						SCREEN_HEIGHT / 2]))
+
+            for i in range(4):
+                if 2 * i * FPS < ticks <= 2 * (i + 1) * FPS:
+                    congratulations_text = render_text("Arial", 48, True, self.game_over_messages[i], GREEN)
+                    overlays.append((congratulations_text, [SCREEN_WIDTH / 2 - congratulations_text.get_width() / 2,
+						SCREEN_HEIGHT / 2 - congratulations_text.get_height() / 2]))
+            return overlays
+
+        # Text on the top-right corner telling the player which level they
+        # are on.
+        level_text = render_text("Arial", 20, True, "Level " + str(self.current_level_index + 1), BLUE)
+        overlays.append((level_text, [SCREEN_WIDTH - level_text.get_width() - 10, 10]))
+
+        if self.current_level.player.reached_goal:
+            # Displays a message to the player saying they beat the level.
+            congratulations_text = render_text("Arial", 48, True, "Level " + str(self.current_level_index + 1) + " complete!", GREEN)
+            overlays.append((congratulations_text, [SCREEN_WIDTH / 2 - congratulations_text.get_width() / 2,
+				SCREEN_HEIGHT / 2 - congratulations_text.get_height() / 2]))
+
+        return overlays
+
+    def close(self):
+        """
+        Finishes the replay and the telemetry log (if they are being recorded)
+        and stops the background level loader
+        """
+        # Record the Level that the game was quit during, if any.
+        if self.recorder is not None and self.playing() and not self.current_level.player.reached_goal:
+            self.recorder.end_level(self.current_level_index, self.current_level.player.deaths, completed=False)
+        if self.telemetry is not None:
+            self.telemetry.close()
+
+        self.level_loader.shutdown(wait=False, cancel_futures=True)
+
+    def _mark(self, phase):
+        if self.frame_profiler is not None:
+            self.frame_profiler.mark(phase)
 
-    # The index of levels_list that points to the current level.
-    current_level_index = 0
+def main(record_path=None, max_frames=None, fps=FPS, show_profile=False, trace_path=None, level_classes=LEVELS,
+         lockstep=False, spectate_port=None, low_latency=False, busy_wait=False, simulation_process=False,
+         telemetry_dir=None):
+    """
+    Runs the game through the specified Level classes. The game is simulated
+    at exactly FPS ticks per second of real time (running several ticks in a
+    frame to catch up if a frame runs long), while frames are drawn at up to
+    fps frames per second; fps=0 draws as often as possible. Frames in which
+    no tick was due are not drawn (with fps=0, the game sleeps until the
+    next tick is due instead). With lockstep, every frame runs exactly
+    one tick instead, however long it took.
+
+    If record_path is given, the inputs of the session are recorded to a
+    replay file at that path (see replay.py). max_frames is for benchmarks:
+    the game quits after max_frames frames if it is given.
+
+    Every frame is profiled (see profiler.py). show_profile turns on the
+    frame time overlay, which F3 toggles, and if trace_path is given, the
+    most recent frames are saved there as a Chrome trace when the game quits.
+
+    If spectate_port is given, the game is served to spectators on that port
+    (see spectator.py).
+
+    low_latency reads the arrow keys' states just before the ticks of each
+    frame run, instead of from the events polled at the start of the frame,
+    and sleeps between frames until the next tick is due instead of for
+    1 / fps seconds, so that no frame wakes up just too early to run a tick.
+    busy_wait makes the frame limiter spin instead of sleeping, which is
+    more precise but keeps a CPU core busy (in normal mode it uses
+    Clock.tick_busy_loop()).
+
+    simulation_process runs the simulation in a worker process instead (see
+    simulation_process.py); frames are drawn whenever the worker has run
+    another tick. It cannot be combined with lockstep.
+
+    If telemetry_dir is given, the Player's position and deaths are logged
+    to a new session file in that directory every tick (see telemetry.py).
+
+    Returns the session's FrameProfiler, whose startup_time is the number of
+    seconds it took to show the first frame.
+    """
+    start_time = time.perf_counter()
 
-    current_level = levels_list[0]
+    # Only the modules that the game uses are initialized; pygame.init()
+    # would also start the mixer, joysticks and so on.
+    pygame.display.init()
+    pygame.font.init()
+
+    # Set screen properties
+    size = (SCREEN_WIDTH, SCREEN_HEIGHT)
+    screen = pygame.display.set_mode(size)
+    pygame.display.set_caption("World's Hardest Game Spin-off")
 
-    # The font that is used to show the congratulatory message at the end of the level
-    congratulations_font = pygame.font.SysFont("Arial", 48, True)
+    renderer = DirtyRenderer(screen)
 
-    # Represents whether the congratulations message is being shown or not.
-    congratulations_text_showing = False
+    done = False
 
-    # Number of ticks that the congratulations message has been shown for.
-    congratulations_text_ticks = 0
+    clock = pygame.time.Clock()
 
-    # Messages that show up on the end-game screen when the player beats all of the levels.
-    game_over_messages = ["Congratulations!", "You beat all the levels!", "Thanks for playing!"]
+    frame_profiler = profiler.FrameProfiler(fps)
+
+    if simulation_process:
+        if lockstep:
+            raise ValueError("lockstep cannot be used with a simulation process")
+        import simulation_process as simulation
+        # The worker process records the replay and the telemetry, since it runs the ticks.
+        game = simulation.RemoteGame(level_classes, record_path, telemetry_dir=telemetry_dir)
+    else:
+        recorder = None
+        if record_path is not None:
+            import replay
+            recorder = replay.ReplayRecorder(record_path)
+
+        telemetry_log = None
+        if telemetry_dir is not None:
+            import telemetry
+            telemetry_log = telemetry.open_session_log(telemetry_dir)
+
+        game = Game(level_classes, recorder, frame_profiler, telemetry_log)
+
+    spectator_server = None
+    if spectate_port is not None:
+        import spectator
+        spectator_server = spectator.SpectatorServer("127.0.0.1", spectate_port)
+        spectator_server.start()
 
     # Represents whether the arrow keys are pressed down or not.
     # From left to right, the boolean values correspond to the
@@ -501,13 +1338,30 @@ def main():
     # https://gamedev.stackexchange.com/a/43556
     key_pressed = [False, False, False, False]
 
+    # Number of frames that have been drawn.
+    frames = 0
+
+    # Real time (in seconds) that has passed but has not been simulated yet
+    accumulator = 0.0
+    previous_time = time.perf_counter()
+
+    # For measuring input latency: the input bitmask that ticks last applied,
+    # the most recently read one and when it was first read.
+    applied_mask = 0
+    seen_mask = 0
+    seen_time = None
+
     # -------- Main Program Loop -----------
-    while not done:
+    while not done and not game.done:
+        frame_profiler.start_frame()
+
         # --- Event Handler Loop
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 done = True
-            if current_level_index < len(levels_list):
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                show_profile = not show_profile
+            if game.playing():
                 if event.type == pygame.KEYDOWN: # Player movement is controlled with arrow keys
                     if event.key == pygame.K_UP:
                         key_pressed[0] = True
@@ -527,100 +1381,135 @@ def main():
                     if event.key == pygame.K_RIGHT:
                         key_pressed[3] = False
 
-        screen.fill(WHITE)
-
-        current_level.draw(screen)
-
-        if current_level_index >= len(levels_list): # The player beat all of the levels
-            if congratulations_text_ticks == 0:
-                # Add a message to game_over_messages telling the player how many times they died
-                game_over_messages.append("Total number of deaths: " + str(current_level.player.deaths))
-
-                # Initialize game over screen
-                current_level = GameOverScreen()
-
-            congratulations_text_ticks += 1
-
-            if congratulations_text_ticks > 12 * FPS:
-                done = True # Breaks out of the loop
-
-            if 8 * FPS < congratulations_text_ticks <= 12 * FPS:
-                congratulations_text = congratulations_font.render("World's Hardest Game Spin-off", False, GREEN)
-                screen.blit(congratulations_text, [SCREEN_WIDTH / 2 - congratulations_text.get_width() / 2,
-					SCREEN_HEIGHT / 2 - congratulations_text.get_height()])
-                if 9.5 * FPS < congratulations_text_ticks <= 12 * FPS:
-                    congratulations_text = congratulations_font.render("made by Eugene Chau", False, GREEN)
-                    screen.blit(congratulations_text, [SCREEN_WIDTH / 2 - congratulations_text.get_width() / 2,
-						SCREEN_HEIGHT / 2])
-                pygame.display.flip()
-                clock.tick(FPS)
-                continue
-
-            for i in range(4):
-                if 2 * i * FPS < congratulations_text_ticks <= 2 * (i + 1) * FPS:
-                    congratulations_text = congratulations_font.render(game_over_messages[i], False, GREEN)
-                    screen.blit(congratulations_text, [SCREEN_WIDTH / 2 - congratulations_text.get_width() / 2,
-						SCREEN_HEIGHT / 2 - congratulations_text.get_height() / 2])
-                    pygame.display.flip()
-                    clock.tick(FPS)
-
-            continue
-
-        # From this line onward, current_level_index < len(levels_list).
-
-        # The player's x and y velocities must be reset to 0 every time, or else
-        # the player would go faster and faster as the arrow keys continue
-        # to be pressed.
-        current_level.player.velocity_x = 0
-        current_level.player.velocity_y = 0
-
-        if key_pressed[0]:
-            current_level.player.go_up()
-        if key_pressed[1]:
-            current_level.player.go_down()
-        if key_pressed[2]:
-            current_level.player.go_left()
-        if key_pressed[3]:
-            current_level.player.go_right()
-
-        # Text on the top-right corner telling the player which level they
-        # are on.
-        level_font = pygame.font.SysFont("Arial", 20, True)
-        level_text = level_font.render("Level " + str(current_level_index + 1), False, BLUE)
-        screen.blit(level_text, [SCREEN_WIDTH - level_text.get_width() - 10, 10])
-
-        # Checks if the player has reached the goal.
-        if current_level.player.reached_goal:
-            # Displays a message to the player saying they beat the level.
-            congratulations_text = congratulations_font.render("Level " + str(current_level_index + 1) + " complete!", False, GREEN)
-            screen.blit(congratulations_text, [SCREEN_WIDTH / 2 - congratulations_text.get_width() / 2,
-				SCREEN_HEIGHT / 2 - congratulations_text.get_height() / 2])
-            congratulations_text_showing = True
-            congratulations_text_ticks += 1
-
-            if congratulations_text_ticks > 2 * FPS: # Only show the congratulatory message for 1 second.
-                congratulations_text_showing = False
-
-            # Checks if the congratulatory message has stopped showing up
-            if not congratulations_text_showing:
-                congratulations_text_ticks = 0
+        poll_time = time.perf_counter()
+        frame_profiler.mark(profiler.EVENTS)
+
+        # Work out how many ticks are due. The accumulator is capped so that
+        # a machine that cannot keep up slows the game down instead of
+        # falling further and further behind.
+        now = time.perf_counter()
+        if simulation_process:
+            # The worker runs the ticks; these are the ones it has run since
+            # the previous frame.
+            ticks = game.sync()
+        elif lockstep:
+            ticks = 1
+        else:
+            accumulator = min(accumulator + now - previous_time, MAX_CATCH_UP_TICKS * TICK_SECONDS)
+            ticks = 0
+            while accumulator >= TICK_SECONDS - TICK_TOLERANCE_SECONDS:
+                accumulator -= TICK_SECONDS
+                ticks += 1
+        previous_time = now
+
+        if low_latency and ticks > 0 and game.playing():
+            # Read the keys as late as possible before the Player moves.
+            pygame.event.pump()
+            key_pressed = pressed_arrow_keys()
+            poll_time = time.perf_counter()
+
+        mask = input_mask(key_pressed)
+        if mask != seen_mask:
+            seen_mask = mask
+            seen_time = poll_time
+        if ticks > 0 and mask != applied_mask:
+            applied_mask = mask
+            frame_profiler.input_applied(seen_time)
+
+        if simulation_process:
+            game.send_input(mask)
+            if ticks > 0 and spectator_server is not None and game.playing():
+                spectator_server.publish(game)
+        else:
+            for _ in range(ticks):
+                if game.done:
+                    break
+                game.tick(mask)
+                if spectator_server is not None and game.playing():
+                    spectator_server.publish(game)
+
+        if ticks > 0 or frames == 0:
+            overlays = game.overlays()
+            if show_profile:
+                profile_lines = frame_profiler.overlay_lines()
+                for i, line in enumerate(profile_lines):
+                    profile_text = render_text("Arial", 14, False, line, BLACK)
+                    overlays.append((profile_text, [10, SCREEN_HEIGHT - 20 * (len(profile_lines) - i)]))
+            frame_profiler.mark(profiler.HUD)
+
+            # Only the parts of the screen that changed are sent to the display.
+            dirty_rects = renderer.draw(game.current_level, overlays)
+            frame_profiler.mark(profiler.DRAW)
+            pygame.display.update(dirty_rects)
+            frame_profiler.frame_shown()
+            frame_profiler.mark(profiler.DISPLAY)
+            if frame_profiler.startup_time is None:
+                frame_profiler.startup_time = time.perf_counter() - start_time
+
+        if low_latency and not lockstep and not simulation_process:
+            # Sleep until the next tick is due (but no less than the frame cap
+            # allows), measured from the time that the accumulator was updated.
+            deadline = previous_time + TICK_SECONDS - TICK_TOLERANCE_SECONDS - accumulator
+            if fps:
+                deadline = max(deadline, frame_profiler.frame_start + 1.0 / fps)
+            wait_until(deadline, busy_wait)
+        elif not fps and ticks == 0 and frames > 0:
+            # Nothing was drawn, and nothing will be until another tick has
+            # run, so sleep until then instead of spinning.
+            if simulation_process:
+                deadline = now + SIMULATION_POLL_SECONDS
+            else:
+                deadline = previous_time + TICK_SECONDS - TICK_TOLERANCE_SECONDS - accumulator
+            wait_until(deadline, busy_wait)
+        elif busy_wait:
+            clock.tick_busy_loop(fps)
+        else:
+            clock.tick(fps)
+        frame_profiler.mark(profiler.SLEEP)
+        frame_profiler.end_frame()
 
-                # At this point, it is safe to increment the current_level_index.
-                current_level_index += 1
+        frames += 1
+        if max_frames is not None and frames >= max_frames:
+            done = True
 
-                if current_level_index < len(levels_list): # The player has not beaten all of the levels
-                    # Changes the Level
-                    # The number of deaths that the Player has carries over to the next Level.
-                    current_deaths = current_level.player.deaths
-                    current_level = levels_list[current_level_index]
-                    current_level.player.deaths = current_deaths
-        else: # Only update the Level if the Player hasn't reached the goal.
-            current_level.update()
+    game.close()
+    if spectator_server is not None:
+        spectator_server.stop()
 
-        pygame.display.flip()
-        clock.tick(FPS)
+    if trace_path is not None:
+        frame_profiler.export_chrome_trace(trace_path)
+    if show_profile:
+        print("\n".join(frame_profiler.latency_report()))
 
+    clear_font_caches()
     pygame.quit()
 
+    return frame_profiler
+
 if __name__ == '__main__':
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description="World's Hardest Game Spin-off")
+    parser.add_argument("--record", metavar="FILE", help="record the session's inputs to a replay file")
+    parser.add_argument("--profile", action="store_true", help="show frame times (toggle with F3)")
+    parser.add_argument("--trace", metavar="FILE", help="save the last frames as a Chrome trace on exit")
+    parser.add_argument("--render-fps", type=int, default=FPS,
+                        help="most frames drawn per second, or 0 for no limit (the game always runs at {} ticks per second)".format(FPS))
+    parser.add_argument("--spectate", metavar="PORT", type=int, help="serve the game to spectators on this port")
+    parser.add_argument("--low-latency", action="store_true",
+                        help="read the arrow keys just before each tick and wake up exactly when ticks are due")
+    parser.add_argument("--busy-wait", action="store_true",
+                        help="spin instead of sleeping between frames (more precise, but uses a whole CPU core)")
+    parser.add_argument("--simulation-process", action="store_true",
+                        help="run the simulation in a separate process, so that drawing and simulating use a core each")
+    parser.add_argument("--telemetry", metavar="DIR",
+                        help="log where the player goes and dies to a session file in DIR (see telemetry.py)")
+    args = parser.parse_args()
+
+    # Run the game from the worlds_hardest_game module rather than from this
+    # script's __main__ module. The other modules (such as occupancy.py)
+    # import worlds_hardest_game, and they must see the same Level and
+    # EnemyBlock classes as the game, not a second copy of this file.
+    import worlds_hardest_game
+    worlds_hardest_game.main(args.record, fps=args.render_fps, show_profile=args.profile, trace_path=args.trace,
+                             spectate_port=args.spectate, low_latency=args.low_latency, busy_wait=args.busy_wait,
+                             simulation_process=args.simulation_process, telemetry_dir=args.telemetry)